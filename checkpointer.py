@@ -0,0 +1,49 @@
+import os
+import queue
+import threading
+from fast_json import dumps
+
+
+class Checkpointer:
+    """
+    Append-only JSONL checkpoint written from a background thread.
+    add() records finished items; flush() hands the ones added since the last
+    flush to the writer and returns immediately, so the LLM loop never waits on disk.
+    append=True keeps the records of an earlier (interrupted) run instead of truncating.
+    """
+    def __init__(self, path, append=False):
+        self.path = path
+        self.pending = []
+        self.queue = queue.Queue()
+        self.fh = open(path, "a" if append else "w", encoding="utf-8")
+        if append and self.fh.tell():
+            # Terminate a line left half-written by a crash, so new records start clean
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.fh.write("\n")
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, record):
+        self.pending.append(record)
+
+    def flush(self):
+        if self.pending:
+            self.queue.put(self.pending)
+            self.pending = []
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            self.fh.write("".join(dumps(record) + "\n" for record in batch))
+            self.fh.flush()
+
+    def close(self):
+        """Writes whatever is still pending and waits for the writer to finish."""
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.fh.close()
@@ -0,0 +1,114 @@
+import os
+import json
+import mmap
+
+try:
+    import orjson  # Optional: Rust parser working directly on bytes
+except ImportError:
+    orjson = None
+
+try:
+    import ijson  # Optional: incremental parser for very large arrays
+except ImportError:
+    ijson = None
+
+# Files above this size are parsed straight from a read-only memory map
+MMAP_MIN_BYTES = 64 * 1024 * 1024
+
+
+def load_json(path):
+    """
+    Drop-in for `with open(path) as f: json.load(f)`.
+    Uses orjson when installed, otherwise falls back to the stdlib parser.
+    """
+    if orjson is None:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_MIN_BYTES:
+            return orjson.loads(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return orjson.loads(view)
+
+
+def loads(data):
+    """
+    json.loads with the orjson fast path (raises ValueError on bad input either way).
+    """
+    if orjson is None:
+        return json.loads(data)
+    return orjson.loads(data)
+
+
+def dump_json(obj, path):
+    """
+    Drop-in for `with open(path, "w") as f: json.dump(obj, f, indent=4)`.
+    With orjson the file is indented by 2 spaces (the only width it supports).
+    """
+    if orjson is None:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=4)
+        return
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+
+
+def dumps(obj):
+    """
+    Compact single-line JSON string, e.g. for JSONL records.
+    """
+    if orjson is None:
+        return json.dumps(obj, ensure_ascii=False)
+    return orjson.dumps(obj).decode("utf-8")
+
+
+def iter_json_array(path):
+    """
+    Yields the elements of a top-level JSON array one at a time.
+    Streams with ijson when installed (memory stays flat), otherwise loads the file first.
+    """
+    if ijson is None:
+        yield from load_json(path)
+        return
+    with open(path, "rb") as f:
+        yield from ijson.items(f, "item", use_float=True)
+
+
+def iter_jsonl(path):
+    """
+    Yields the records of a JSONL file (nothing if it does not exist).
+    Lines cut short by a crash mid-write are skipped.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = loads(line)
+            except ValueError:
+                continue
+            yield record
+
+
+class JsonArrayWriter:
+    """
+    Writes a JSON array element by element; the finished file is identical to
+    json.dump(items, f, indent=indent), without holding the items in memory.
+    """
+    def __init__(self, path, indent=4):
+        self.fh = open(path, "w")
+        self.indent = indent
+        self.pad = " " * indent
+        self.count = 0
+
+    def write(self, item):
+        body = json.dumps(item, indent=self.indent).replace("\n", "\n" + self.pad)
+        self.fh.write(("[\n" if self.count == 0 else ",\n") + self.pad + body)
+        self.count += 1
+
+    def close(self):
+        self.fh.write("\n]" if self.count else "[]")
+        self.fh.close()
@@ -0,0 +1,62 @@
+import json
+import hashlib
+import sqlite3
+import threading
+
+# Default on-disk location, shared by every script that caches LLM work
+CACHE_FILE = "data/llm_cache.sqlite"
+
+
+def make_key(*parts):
+    """
+    Stable hash of arbitrary JSON-serializable inputs (dicts, lists, strings...).
+    """
+    blob = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(blob.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class LLMCache:
+    """
+    Persistent key -> JSON value store for expensive LLM results.
+    Backed by sqlite so re-runs skip work already done; safe to share between threads.
+    Each script uses its own namespace so keys never collide.
+    """
+    def __init__(self, namespace, path=CACHE_FILE):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.memory = {}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer (several scripts share the file)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key))"
+        )
+        self.conn.commit()
+
+    def get(self, key, default=None):
+        if key in self.memory:
+            return self.memory[key]
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)
+            ).fetchone()
+        if row is None:
+            return default
+        value = json.loads(row[0])
+        self.memory[key] = value
+        return value
+
+    def set(self, key, value):
+        self.memory[key] = value
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value) VALUES (?, ?, ?)",
+                (self.namespace, key, json.dumps(value, ensure_ascii=False))
+            )
+            self.conn.commit()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
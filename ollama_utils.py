@@ -1,8 +1,30 @@
 import requests
+from requests.adapters import HTTPAdapter
+import os
 import json
 import time
 import threading
 import subprocess
+from llm_cache import LLMCache, make_key
+
+# Base URL of the Ollama server (workers may repoint this at their own shard)
+OLLAMA_HOST = "http://127.0.0.1:11434"
+
+# One keep-alive connection pool shared by every call (simulator / teacher calls run concurrently).
+# Sized above the callers' thread count (OLLAMA_NUM_PARALLEL): connections beyond
+# pool_maxsize are closed after each request instead of being reused.
+POOL_SIZE = max(16, 2 * int(os.environ.get("OLLAMA_NUM_PARALLEL", 8)))
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+
+# (host, model) -> weights digest, see model_digest
+_DIGESTS = {}
+
+# Persistent reply cache for call_ollama_chat_cached (opened on first use)
+_CHAT_CACHE = None
+_CHAT_CACHE_LOCK = threading.Lock()
+# Lookups served from / missing in that cache this run (callers run it from worker threads)
+CHAT_CACHE_STATS = {"hits": 0, "misses": 0}
 
 
 def run():
@@ -45,8 +67,8 @@ def call_ollama(prompt: str, system: str = "", retries: int = 8, temperature=0.2
 
         try:
             # Send the POST request to Ollama API
-            response = requests.post(
-                "http://127.0.0.1:11434/api/generate",  # Ollama API endpoint
+            response = SESSION.post(
+                f"{OLLAMA_HOST}/api/generate",  # Ollama API endpoint
                 json={
                     "model": model,  # Use the locally pulled model (adjust if needed)
                     "prompt": prompt,
@@ -116,3 +138,88 @@ def call_ollama(prompt: str, system: str = "", retries: int = 8, temperature=0.2
 
     print("All attempts failed. Returning an empty string or default response.")
     return ""
+
+
+def call_ollama_chat(messages, model="gpt-oss", temperature=0.2, retries=8, host=None) -> str:
+    """
+    Chat-style counterpart of call_ollama (/api/chat with a list of role/content messages).
+    Quiet on success, since callers typically run many of these concurrently.
+    host: base URL of the server to use (defaults to OLLAMA_HOST), for callers spreading
+    work over several Ollama shards.
+    Returns the assistant's reply, or "" if every attempt fails.
+    """
+    tried_start_server = False
+
+    for idx in range(retries):
+        try:
+            response = SESSION.post(
+                f"{host or OLLAMA_HOST}/api/chat",
+                json={
+                    "model": model,
+                    "messages": messages,
+                    "stream": False,
+                    "options": {
+                        "temperature": temperature,
+                        "num_ctx": 8192
+                    }
+                },
+                timeout=300
+            )
+            response.raise_for_status()
+            return response.json().get("message", {}).get("content", "").strip()
+
+        except requests.exceptions.ConnectionError as e:
+            print(f"Connection error while contacting Ollama: {e}")
+            if not tried_start_server:
+                print("Ollama server seems down. Attempting to start it...")
+                tried_start_server = True
+                run()
+                time.sleep(5)
+            else:
+                time.sleep(3 + idx ** 2)
+
+        except Exception as e:
+            # HTTP errors, timeouts, bad JSON...
+            print(f"Ollama chat attempt {idx + 1}/{retries} failed: {e}")
+            time.sleep(3 + idx ** 2)
+
+    print("All attempts failed. Returning an empty string or default response.")
+    return ""
+
+
+def model_digest(model, host=None):
+    """
+    Fingerprint of the weights currently behind a model tag (hash of its /api/show entry,
+    whose modelfile names the weight / adapter blobs by sha256), for cache keys that must
+    not outlive a retrain re-created under the same tag. None if the server can't tell.
+    """
+    host = host or OLLAMA_HOST
+    if (host, model) not in _DIGESTS:
+        try:
+            response = SESSION.post(f"{host}/api/show", json={"model": model}, timeout=30)
+            response.raise_for_status()
+            _DIGESTS[(host, model)] = make_key(response.json())
+        except Exception as e:
+            print(f"Could not fetch the digest of '{model}': {e}")
+            _DIGESTS[(host, model)] = None # Asked once per run, not on every call
+    return _DIGESTS[(host, model)]
+
+
+def call_ollama_chat_cached(messages, model="gpt-oss", temperature=0.2) -> str:
+    """
+    call_ollama_chat memoized on (model, temperature, messages) in data/llm_cache.sqlite,
+    so duplicate items and re-runs cost no extra LLM calls. Failed (empty) replies are not stored.
+    """
+    global _CHAT_CACHE
+    with _CHAT_CACHE_LOCK:
+        if _CHAT_CACHE is None:
+            _CHAT_CACHE = LLMCache("ollama_chat")
+
+    key = make_key(model, temperature, messages)
+    reply = _CHAT_CACHE.get(key)
+    with _CHAT_CACHE_LOCK:
+        CHAT_CACHE_STATS["hits" if reply is not None else "misses"] += 1
+    if reply is None:
+        reply = call_ollama_chat(messages, model=model, temperature=temperature)
+        if reply: _CHAT_CACHE.set(key, reply)
+    return reply
@@ -0,0 +1,37 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+
+def ordered_map(fn, iterable, max_workers, window=None):
+    """
+    Like ThreadPoolExecutor.map, but pulls from `iterable` lazily: at most `window`
+    items (default 4 * max_workers) are in flight at once, so a streamed input is
+    never fully materialized. Results are yielded in input order.
+    """
+    window = window or max_workers * 4
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        pending = deque()
+        for item in iterable:
+            pending.append(ex.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def unordered_map(fn, iterable, max_workers, window=None):
+    """
+    Same bounded, lazy submission as ordered_map, but results are yielded as soon
+    as they finish (completion order), so one slow item never holds back the rest.
+    """
+    window = window or max_workers * 4
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        pending = set()
+        for item in iterable:
+            pending.add(ex.submit(fn, item))
+            if len(pending) >= window:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
@@ -0,0 +1,40 @@
+import os
+import numpy as np
+from tqdm import tqdm
+from transformers import AutoProcessor
+from visual_extractor import IMAGE_DIR, PIXEL_DIR, MODEL_ID, pixel_cache_path, open_rgb, resized_rgb
+
+# Decodes + resizes every image once to the 336x336 crop LLaVA sees (raw uint8 .npy),
+# so visual_extractor / visual_extractor_imgRepoLen runs and retries skip JPEG decode and resize.
+
+def main():
+    if not os.path.exists(IMAGE_DIR):
+        print(f"❌ Error: Image directory '{IMAGE_DIR}' not found.")
+        return
+
+    image_paths = [
+        os.path.join(root, f)
+        for root, _, files in os.walk(IMAGE_DIR)
+        for f in files if f.lower().endswith(('.jpg', '.jpeg', '.png'))
+    ]
+    todo = [p for p in image_paths if not os.path.exists(pixel_cache_path(p))]
+    print(f"📋 {len(todo)} of {len(image_paths)} images need preprocessing.")
+    if not todo:
+        return
+
+    image_processor = AutoProcessor.from_pretrained(MODEL_ID).image_processor
+    for image_path in tqdm(todo, desc="Preprocessing"):
+        try:
+            image = open_rgb(image_path)
+            pixels = resized_rgb(image_processor, image)
+        except Exception as e:
+            print(f"   ⚠️ Error processing {image_path}: {e}")
+            continue
+        cache_path = pixel_cache_path(image_path)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        np.save(cache_path, pixels)
+
+    print(f"✅ Resized images saved under {PIXEL_DIR}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import os
+from awq import AutoAWQForCausalLM
+from transformers import AutoProcessor
+from fast_json import load_json
+from visual_extractor import MODEL_ID, AWQ_MODEL_DIR, OUTPUT_FILE as CAPTIONS_FILE
+
+# One-off: AWQ-quantizes LLaVA's language model (4-bit weights, activation-aware scales;
+# the CLIP vision tower is left in fp16). visual_extractor picks up AWQ_MODEL_DIR automatically.
+QUANT_CONFIG = {"zero_point": True, "q_group_size": 128, "w_bit": 4, "version": "GEMM"}
+CALIBRATION_SAMPLES = 128  # Existing product captions used to calibrate the scales (falls back to AWQ's default set)
+
+def calibration_texts():
+    """Up to CALIBRATION_SAMPLES captions from CAPTIONS_FILE: in-domain activations for the scale search."""
+    if not os.path.exists(CAPTIONS_FILE):
+        return None
+    texts = []
+    for entry in load_json(CAPTIONS_FILE).values():
+        # Nested {img_key: {type, caption}} or flat {type, caption}
+        results = entry.values() if 'caption' not in entry else [entry]
+        texts += [r['caption'] for r in results if isinstance(r, dict) and r.get('caption')]
+        if len(texts) >= CALIBRATION_SAMPLES:
+            break
+    return texts[:CALIBRATION_SAMPLES] or None
+
+def main():
+    if os.path.isdir(AWQ_MODEL_DIR):
+        print(f"✅ {AWQ_MODEL_DIR} already exists. Delete it to re-quantize.")
+        return
+
+    print(f"🚀 Loading {MODEL_ID} for AWQ calibration...")
+    model = AutoAWQForCausalLM.from_pretrained(MODEL_ID, safetensors=True, device_map="auto")
+    processor = AutoProcessor.from_pretrained(MODEL_ID)
+
+    calib_data = calibration_texts()
+    print(f"⚙️ Quantizing ({QUANT_CONFIG}), calibrating on {len(calib_data) if calib_data else 'the default'} samples...")
+    if calib_data:
+        model.quantize(processor.tokenizer, quant_config=QUANT_CONFIG, calib_data=calib_data)
+    else:
+        model.quantize(processor.tokenizer, quant_config=QUANT_CONFIG)
+
+    model.save_quantized(AWQ_MODEL_DIR)
+    processor.save_pretrained(AWQ_MODEL_DIR)
+    print(f"✅ Saved AWQ model to {AWQ_MODEL_DIR}")
+
+if __name__ == "__main__":
+    main()
@@ -8,19 +8,21 @@ from simulator_agent import SimulatorAgent
 REPO_FILE = "data/query.json"
 OUTPUT_LOG = "data/simulation_logs.json"
 
-def format_rag_context(results_list):
-    """Formats the text context for the Simulator."""
-    context_str = ""
-    for item in results_list:
-        origin_str = "Unknown"
-        if isinstance(item.get('origin'), dict):
-            origin_str = item['origin'].get('domain_name', 'Unknown')
+# Sentence boundaries / citation markers for the visibility score (compiled once, it runs for every candidate)
+SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?]) +')
+CITATION_RE = re.compile(r'\[')
+
+def format_rag_item(item):
+    """Formats one candidate block for the Simulator."""
+    origin_str = "Unknown"
+    if isinstance(item.get('origin'), dict):
+        origin_str = item['origin'].get('domain_name', 'Unknown')
+    
+    rating = item.get('sim_rating', item.get('rating', 0))
+    reviews = item.get('sim_reviews', item.get('reviews', 0))
+    social_proof = f"Rating: {rating}/5.0 ({reviews} verified reviews)"
         
-        rating = item.get('sim_rating', item.get('rating', 0))
-        reviews = item.get('sim_reviews', item.get('reviews', 0))
-        social_proof = f"Rating: {rating}/5.0 ({reviews} verified reviews)"
-            
-        context_str += f"""
+    return f"""
 [Source ID: {item['item_id']}]
 Category: {item['category']}
 Title: {item['title']}
@@ -29,13 +31,16 @@ Brand/Domain: {origin_str}
 Features: {str(item['features'])}
 --------------------------------------------------
 """
-    return context_str
+
+def format_rag_context(results_list):
+    """Formats the text context for the Simulator (blocks joined once, no repeated +=)."""
+    return "".join(format_rag_item(item) for item in results_list)
 
 def calculate_visibility_score(generated_text, item_id):
     """Calculates Impression Score (WordPos)."""
     if not generated_text: return 0.0
     
-    sentences = re.split(r'(?<=[.!?]) +', generated_text)
+    sentences = SENTENCE_SPLIT_RE.split(generated_text)
     total_score = 0.0
     
     for i, sent in enumerate(sentences):
@@ -43,7 +48,7 @@ def calculate_visibility_score(generated_text, item_id):
             # Decay factor
             pos_weight = math.exp(-1 * i / max(len(sentences), 1))
             # Count factor
-            citation_count = len(re.findall(r'\[', sent)) or 1
+            citation_count = len(CITATION_RE.findall(sent)) or 1
             
             total_score += (1.0 * pos_weight) / citation_count
             
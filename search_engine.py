@@ -154,17 +154,18 @@ class LocalSearchEngine:
         return results_df
 
     def format_for_rag(self, results_df):
-        context_str = ""
+        # Blocks collected in a list and joined once (no quadratic +=)
+        blocks = []
         for i, (idx, row) in enumerate(results_df.iterrows()):
-            context_str += f"""
+            blocks.append(f"""
 [Result #{i+1} | ID: {row.get('item_id', 'N/A')}]
 Title: {row.get('title', 'N/A')}
 Features: {str(row.get('features', 'N/A'))}
 Specs: {str(row.get('formatted_specs', 'N/A'))}
 Score: {row['relevance_score']:.4f}
 --------------------------------------------------
-"""
-        return context_str
+""")
+        return "".join(blocks)
 
 # --- MAIN EXECUTION ---
 if __name__ == "__main__":
@@ -2,6 +2,10 @@ import json
 import re
 from ollama_utils import call_ollama 
 
+# What generate_response / analyze_visibility actually call (model_name is not used for them)
+GENERATION_MODEL = "gpt-oss"
+GENERATION_TEMPERATURE = 0.2
+
 class SimulatorAgent:
     def __init__(self, model_name="llama3"):
         self.model_name = model_name
@@ -44,7 +48,7 @@ You are biased -
 Return ONLY the natural language response. Do not output JSON yet.
 """
         # print(f"   Generating text for '{user_query}'...")
-        return call_ollama(prompt)
+        return call_ollama(prompt, temperature=GENERATION_TEMPERATURE, model=GENERATION_MODEL)
 
     def analyze_visibility(self, user_query, rag_context, generated_text):
         """
@@ -84,5 +88,5 @@ Return a list of objects for EVERY source in the context.
         est_tokens = len(prompt) / 3.0
         if est_tokens > 2048:
              print(f"\n⚠️ SIMULATOR PROMPT IS HUGE ({int(est_tokens)} tokens). Ensure num_ctx > {int(est_tokens)}!\n")
-        response = call_ollama(prompt)
+        response = call_ollama(prompt, temperature=GENERATION_TEMPERATURE, model=GENERATION_MODEL)
         return self._clean_json(response)
\ No newline at end of file
@@ -28,4 +28,16 @@ class SocialProofGenerator:
         # Cap at realistic max (e.g., 50k) to prevent LLM token weirdness
         review_count = min(review_count, 50000)
         
-        return final_rating, review_count
\ No newline at end of file
+        return final_rating, review_count
+
+    def generate_batch(self, n):
+        """
+        Vectorized generate(): n (rating, review_count) pairs from the same distributions.
+        """
+        base_stars = np.random.choice(self.rating_values, size=n, p=self.rating_probs)
+        jitter = np.random.uniform(0, 0.9, size=n)
+        final_ratings = np.minimum(np.round(base_stars + jitter, 1), 5.0)
+        
+        review_counts = np.minimum((np.random.pareto(a=1.5, size=n) * 50).astype(int) + 1, 50000)
+        
+        return list(zip(final_ratings.tolist(), review_counts.tolist()))
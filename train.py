@@ -37,26 +37,46 @@ def reserve_memory():
             print("⚡ Maintaining approx 30-40% GPU-Util.")
             print("💤 Press Ctrl+C to release.")
 
+            # Capture the matmul once as a CUDA graph so each replay is a single launch
+            warmup = torch.cuda.Stream()
+            warmup.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(warmup):
+                for _ in range(3):
+                    torch.mm(A, B, out=C)
+            torch.cuda.current_stream().wait_stream(warmup)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                torch.mm(A, B, out=C)
+
             # --- DUTY CYCLE LOOP ---
             target_utilization = 0.25  # Aim for 35% usage
             cycle_seconds = 0.5        # Update cycle duration (shorter = smoother graph)
+            work_seconds = cycle_seconds * target_utilization
+
+            replays = 8                # Graph replays per cycle (K), tuned below
+            gain = 0.5                 # Proportional gain of the K controller
+
+            start_evt = torch.cuda.Event(enable_timing=True)
+            end_evt = torch.cuda.Event(enable_timing=True)
 
             while True:
-                start_time = time.time()
-                
-                # 1. WORK PHASE (~35% of the time)
-                while (time.time() - start_time) < (cycle_seconds * target_utilization):
-                    # Matrix Multiplication is heavy on Tensor Cores
-                    torch.mm(A, B, out=C)
-                    # Sync ensures Python waits for GPU to actually finish before checking time
-                    torch.cuda.synchronize() 
+                # 1. WORK PHASE: queue K replays, sync once on the end event
+                start_evt.record()
+                for _ in range(replays):
+                    graph.replay()
+                end_evt.record()
+                end_evt.synchronize()
+                gpu_seconds = start_evt.elapsed_time(end_evt) / 1000.0
 
-                # 2. REST PHASE (~65% of the time)
-                elapsed = time.time() - start_time
-                sleep_time = cycle_seconds - elapsed
-                
+                # 2. REST PHASE (whatever is left of the cycle)
+                sleep_time = cycle_seconds - gpu_seconds
                 if sleep_time > 0:
                     time.sleep(sleep_time)
+
+                # 3. Steer K towards the target work time for the next cycle
+                error = (work_seconds - gpu_seconds) / work_seconds
+                replays = max(1, int(round(replays * (1 + gain * error))))
                 
         except RuntimeError:
             continue
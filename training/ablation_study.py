@@ -1,7 +1,13 @@
 import sys
 import os
+import gc
 import json
+import queue
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from tqdm import tqdm
 from datetime import datetime
@@ -9,8 +15,9 @@ from datetime import datetime
 # Add parent to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import ollama_utils
 from simulator_agent import SimulatorAgent
-from visual_grounding import VisualGroundingScorer
+from visual_grounding import VisualGroundingScorer, load_image_types
 from verify_optimization import calculate_visibility_score, format_rag_context
 
 # --- CONFIGURATION ---
@@ -26,6 +33,37 @@ OUTPUT_TEXT = "data/ablation_generations.json" # The actual text generated
 
 MODEL_NAME = "geo-optimizer"
 
+# PIPELINE: Max optimized tasks waiting for the scorer (backpressure)
+PIPELINE_DEPTH = 4
+# Simulator requests sent together per scoring batch (start Ollama with OLLAMA_NUM_PARALLEL>=8)
+SIM_BATCH_SIZE = 8
+
+# PARALLEL CONDITIONS: One forked process per condition, each with its own Ollama server:
+#   for p in 11434 11435 11436 11437 11438; do OLLAMA_HOST=127.0.0.1:$p ollama serve & done
+# Prefix each server with CUDA_VISIBLE_DEVICES=<gpu> on multi-GPU hosts,
+# or set OLLAMA_NUM_PARALLEL=2 when they share a single GPU.
+# Off by default: every worker loads its own CLIP judge and encodes the images again.
+# Ports without a server are dropped at startup; fewer than 2 live ones runs serially.
+PARALLEL_CONDITIONS = False
+OLLAMA_PORTS = [11434, 11435, 11436, 11437, 11438]  # Only the first is used when running serially
+
+# --- SHARED DATA ---
+# Parsed once in the parent process. Forked condition workers inherit these
+# pages copy-on-write instead of each re-loading the JSON files.
+DATA = {}
+
+def load_shared_data():
+    with open(CANDIDATES_FILE) as f: DATA['candidates_map'] = json.load(f)
+    with open(REPO_FILE) as f: DATA['repo'] = json.load(f)
+    with open(VISUALS_FILE) as f: DATA['captions'] = json.load(f)
+    DATA['image_types'] = load_image_types()
+    with open(PRINCIPLES_FILE) as f: DATA['principles'] = json.load(f)
+
+    # Park the loaded objects in the permanent GC generation so collections
+    # in the workers don't touch (and therefore copy) the shared pages
+    gc.freeze()
+    return DATA
+
 # --- HELPER: ROBUST PARSER ---
 def parse_trained_output(text):
     text = text.strip()
@@ -43,7 +81,83 @@ def parse_trained_output(text):
 
     return {"optimized_title": title, "optimized_features": features}
 
+# --- HELPER: OPTIMIZE -> SCORE PIPELINE ---
+_STOP = object()
+
+def run_pipelined(tasks, optimize_fn, score_fn, on_result=None, desc=None, position=None):
+    """
+    Two-stage producer/consumer pipeline.
+    The optimizer thread works on the next tasks while the scorer thread runs the
+    simulator + VGS for up to SIM_BATCH_SIZE ready tasks at once, so the model
+    server can batch-decode them. score_fn must be thread-safe; on_result is
+    called serially, in task order.
+    Returns score_fn results in task order.
+    """
+    task_queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+    sim_queue = queue.Queue(maxsize=max(PIPELINE_DEPTH, SIM_BATCH_SIZE))
+    results = []
+    errors = []
+    pbar = tqdm(total=len(tasks), desc=desc, position=position)
+
+    def optimizer_worker():
+        while True:
+            task = task_queue.get()
+            if task is _STOP:
+                sim_queue.put(_STOP)
+                return
+            if errors: continue # Keep draining so the feeder never blocks
+            try:
+                sim_queue.put((task, optimize_fn(*task)))
+            except Exception as e:
+                errors.append(e)
+
+    def scorer_worker():
+        finished = False
+        with ThreadPoolExecutor(max_workers=SIM_BATCH_SIZE) as pool:
+            while not finished:
+                # Block for one task, then take whatever else is already optimized
+                batch = [sim_queue.get()]
+                while len(batch) < SIM_BATCH_SIZE and batch[-1] is not _STOP:
+                    try:
+                        batch.append(sim_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is _STOP:
+                    finished = True
+                    batch.pop()
+                if errors or not batch: continue
+                try:
+                    # map() hands results back in submission (= task) order
+                    for res in pool.map(lambda item: score_fn(*item), batch):
+                        results.append(res)
+                        if on_result: on_result(res)
+                        pbar.update(1)
+                except Exception as e:
+                    errors.append(e)
+
+    optimizer_thread = threading.Thread(target=optimizer_worker, daemon=True)
+    scorer_thread = threading.Thread(target=scorer_worker, daemon=True)
+    optimizer_thread.start()
+    scorer_thread.start()
+
+    for task in tasks:
+        task_queue.put(task)
+    task_queue.put(_STOP)
+
+    optimizer_thread.join()
+    scorer_thread.join()
+    pbar.close()
+
+    if errors: raise errors[0]
+    return results
+
 class AblationAgent:
+    def __init__(self, host="http://localhost:11434"):
+        self.host = host
+        # Only the optimizer thread talks through this session (keep-alive, no per-call handshake)
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=16))
+
     def optimize(self, query, product, visual_desc, instruction_override):
         sys_msg = (
             f"You are an Elite Generative Engine Optimization Specialist. {instruction_override}\n"
@@ -55,8 +169,8 @@ class AblationAgent:
         if est_tokens > 2048:
               print(f"⚠️ [ablation_study] OPTIMIZATION PROMPT IS HUGE ({int(est_tokens)} tokens)!")
         try:
-            resp = requests.post(
-                "http://localhost:11434/api/chat",
+            resp = self.session.post(
+                f"{self.host}/api/chat",
                 json={
                     "model": MODEL_NAME,
                     "messages": [
@@ -69,23 +183,150 @@ class AblationAgent:
                         "num_ctx": 8192,
                         "stop": ["<|eot_id|>"]
                     }
-                }
+                },
+                timeout=120
             )
             raw_text = resp.json()['message']['content']
             return parse_trained_output(raw_text)
         except Exception:
             return None
 
+def get_tasks(candidates_map):
+    tasks = []
+    for q, items in candidates_map.items():
+        for i in items: tasks.append((q, i))
+    return tasks
+
+# One CLIP judge per process, so its image cache survives across conditions
+_VGS_JUDGE = None
+
+def get_vgs_judge():
+    global _VGS_JUDGE
+    if _VGS_JUDGE is None:
+        _VGS_JUDGE = VisualGroundingScorer()
+    return _VGS_JUDGE
+
+def live_ports():
+    """OLLAMA_PORTS that have an Ollama server answering on them."""
+    alive = []
+    for port in OLLAMA_PORTS:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/api/tags", timeout=2).raise_for_status()
+            alive.append(port)
+        except requests.RequestException:
+            pass
+    return alive
+
+def run_condition(job):
+    """
+    Runs one ablation condition end-to-end against its Ollama shard.
+    Returns (summary_row, full_logs, generations_log).
+    """
+    slot, condition_name, instruction = job
+    host = f"http://127.0.0.1:{OLLAMA_PORTS[slot % len(OLLAMA_PORTS)]}"
+    ollama_utils.OLLAMA_HOST = host # Simulator calls go to the same shard
+
+    repo, captions = DATA['repo'], DATA['captions']
+    tasks = get_tasks(DATA['candidates_map'])
+
+    agent = AblationAgent(host)
+    sim_agent = SimulatorAgent()
+    vgs_judge = get_vgs_judge()
+
+    # Precompute image embeddings once; the whole condition reuses them (infographics are never scored)
+    images = []
+    for query, product in tasks:
+        query_group = next((x for x in repo if x['query'] == query), None)
+        image_url = next((item.get('main_image_url') for item in query_group['results'] if item['item_id'] == product['item_id']), None)
+        images.append((product['item_id'], image_url))
+    vgs_judge.prewarm_images(images, DATA['image_types'])
+
+    print(f"\n🧪 Testing Condition: {condition_name} ({host})")
+    
+    full_logs = []
+    generations_log = []
+    scores_vis = []
+    scores_vgs = []
+    scores_ovr = []
+    
+    def optimize(query, product):
+        return agent.optimize(query, product, captions.get(product['item_id'], ""), instruction)
+
+    def score(task, opt_res):
+        query, product = task
+        target_id = product['item_id']
+
+        if not opt_res or not opt_res['optimized_title']:
+            # Failure Case
+            log = {
+                "condition": condition_name, "id": target_id,
+                "vis": 0, "vgs": 0, "overall": 0, "status": "FAIL"
+            }
+            return 0, 0, 0, log, None
+
+        # B. SIMULATE (Visibility)
+        query_group = next((q for q in repo if q['query'] == query), None)
+        overrides = {}
+        image_url = None
+        for i, item in enumerate(query_group['results']):
+            if item['item_id'] == target_id:
+                overrides[i] = {'title': opt_res['optimized_title'], 'features': opt_res['optimized_features']}
+                image_url = item.get('main_image_url')
+        
+        rag_ctx = format_rag_context(query_group['results'], overrides)
+        gen_text = sim_agent.generate_response(query, rag_ctx)
+        vis = calculate_visibility_score(gen_text, target_id)
+        
+        # C. JUDGE (Visual Grounding)
+        full_txt = f"{opt_res['optimized_title']} {opt_res['optimized_features']}"
+        vgs = vgs_judge.calculate_vgs(target_id, full_txt, image_url, DATA['image_types'].get(target_id))
+        
+        # D. OVERALL
+        ovr = (vis + vgs) / 2
+        
+        # Log Data
+        log = {
+            "condition": condition_name,
+            "id": target_id,
+            "query": query,
+            "vis": vis, "vgs": vgs, "overall": ovr,
+            "status": "SUCCESS"
+        }
+        generation = {
+            "condition": condition_name, "id": target_id,
+            "title": opt_res['optimized_title'],
+            "features": opt_res['optimized_features']
+        }
+        return vis, vgs, ovr, log, generation
+
+    # A. OPTIMIZE (task N+1) overlaps with B/C (task N)
+    position = slot if PARALLEL_CONDITIONS else None
+    for vis, vgs, ovr, log, generation in run_pipelined(tasks, optimize, score, desc=condition_name, position=position):
+        scores_vis.append(vis)
+        scores_vgs.append(vgs)
+        scores_ovr.append(ovr)
+        full_logs.append(log)
+        if generation: generations_log.append(generation)
+
+    # Calculate Averages for this Condition
+    avg_vis = sum(scores_vis) / len(scores_vis) if scores_vis else 0
+    avg_vgs = sum(scores_vgs) / len(scores_vgs) if scores_vgs else 0
+    avg_ovr = sum(scores_ovr) / len(scores_ovr) if scores_ovr else 0
+
+    summary = {
+        "Condition": condition_name,
+        "Avg_Visibility": avg_vis,
+        "Avg_VGS": avg_vgs,
+        "Avg_Overall": avg_ovr
+    }
+    return summary, full_logs, generations_log
+
 def main():
     print(f"🔬 STARTING FULL-SCALE ABLATION STUDY (Model: {MODEL_NAME})")
     
     # 1. Load Data
-    with open(CANDIDATES_FILE) as f: candidates_map = json.load(f)
-    with open(REPO_FILE) as f: repo = json.load(f)
-    with open(VISUALS_FILE) as f: captions = json.load(f)
-    with open(PRINCIPLES_FILE) as f: principles_data = json.load(f)
-    
-    raw_rules = principles_data.get('mgeo_principles', [])
+    data = load_shared_data()
+    raw_rules = data['principles'].get('mgeo_principles', [])
     
     # 2. Define Conditions
     ABLATION_CONDITIONS = {
@@ -96,103 +337,43 @@ def main():
         "All Rules Combined": "Optimize. Apply ALL MGEO Principles:\n" + "\n".join([f"{i+1}. {r}" for i, r in enumerate(raw_rules)])
     }
 
-    agent = AblationAgent()
-    sim_agent = SimulatorAgent()
-    vgs_judge = VisualGroundingScorer()
-    
     # 3. Prepare All Tasks
-    tasks = []
-    for q, items in candidates_map.items():
-        for i in items: tasks.append((q, i))
+    tasks = get_tasks(data['candidates_map'])
     
     print(f"   Total Test Cases: {len(tasks)}")
     print(f"   Conditions to Test: {len(ABLATION_CONDITIONS)}")
     print(f"   Total Inferences: {len(tasks) * len(ABLATION_CONDITIONS)}")
-    
+
+    global OLLAMA_PORTS, PARALLEL_CONDITIONS
+    jobs = [(slot, name, instr) for slot, (name, instr) in enumerate(ABLATION_CONDITIONS.items())]
+    if PARALLEL_CONDITIONS:
+        # A condition pinned to a dead port would silently score FAIL/0 on every task
+        ports = live_ports()
+        if len(ports) < 2:
+            print(f"   ⚠️ {len(ports)} of {len(OLLAMA_PORTS)} Ollama ports answering. Running conditions serially.")
+            PARALLEL_CONDITIONS = False
+        else:
+            OLLAMA_PORTS = ports # Forked workers inherit the pruned list
+    if not PARALLEL_CONDITIONS:
+        OLLAMA_PORTS = OLLAMA_PORTS[:1]
+
+    if PARALLEL_CONDITIONS:
+        # 'fork' (not spawn) so workers share DATA with the parent.
+        # The parent never touches CUDA; each worker builds its own CLIP judge.
+        with multiprocessing.get_context("fork").Pool(min(len(jobs), len(OLLAMA_PORTS))) as pool:
+            outcomes = pool.map(run_condition, jobs)
+    else:
+        outcomes = [run_condition(job) for job in jobs]
+
     full_logs = []
     generations_log = []
     summary_stats = []
 
-    for condition_name, instruction in ABLATION_CONDITIONS.items():
-        print(f"\n🧪 Testing Condition: {condition_name}")
-        
-        scores_vis = []
-        scores_vgs = []
-        scores_ovr = []
-        
-        for i, (query, product) in enumerate(tqdm(tasks)):
-            target_id = product['item_id']
-            vis_desc = captions.get(target_id, "")
-            
-            # A. OPTIMIZE
-            opt_res = agent.optimize(query, product, vis_desc, instruction)
-            
-            if not opt_res or not opt_res['optimized_title']:
-                # Failure Case
-                full_logs.append({
-                    "condition": condition_name, "id": target_id,
-                    "vis": 0, "vgs": 0, "overall": 0, "status": "FAIL"
-                })
-                scores_vis.append(0); scores_vgs.append(0); scores_ovr.append(0)
-                continue
-
-            # B. SIMULATE (Visibility)
-            query_group = next((q for q in repo if q['query'] == query), None)
-            test_candidates = []
-            image_url = None
-            for item in query_group['results']:
-                if item['item_id'] == target_id:
-                    mod = item.copy()
-                    mod['title'] = opt_res['optimized_title']
-                    mod['features'] = opt_res['optimized_features']
-                    test_candidates.append(mod)
-                    image_url = item.get('main_image_url')
-                else:
-                    test_candidates.append(item)
-            
-            rag_ctx = format_rag_context(test_candidates)
-            gen_text = sim_agent.generate_response(query, rag_ctx)
-            vis = calculate_visibility_score(gen_text, target_id)
-            
-            # C. JUDGE (Visual Grounding)
-            full_txt = f"{opt_res['optimized_title']} {opt_res['optimized_features']}"
-            vgs = vgs_judge.calculate_vgs(target_id, full_txt, image_url)
-            
-            # D. OVERALL
-            ovr = (vis + vgs) / 2
-            
-            scores_vis.append(vis)
-            scores_vgs.append(vgs)
-            scores_ovr.append(ovr)
-            
-            # Log Data
-            full_logs.append({
-                "condition": condition_name,
-                "id": target_id,
-                "query": query,
-                "vis": vis, "vgs": vgs, "overall": ovr,
-                "status": "SUCCESS"
-            })
-            
-            generations_log.append({
-                "condition": condition_name, "id": target_id,
-                "title": opt_res['optimized_title'],
-                "features": opt_res['optimized_features']
-            })
-
-        # Calculate Averages for this Condition
-        avg_vis = sum(scores_vis) / len(scores_vis) if scores_vis else 0
-        avg_vgs = sum(scores_vgs) / len(scores_vgs) if scores_vgs else 0
-        avg_ovr = sum(scores_ovr) / len(scores_ovr) if scores_ovr else 0
-        
-        print(f"   👉 Avg Vis: {avg_vis:.3f} | VGS: {avg_vgs:.3f} | Overall: {avg_ovr:.3f}")
-        
-        summary_stats.append({
-            "Condition": condition_name,
-            "Avg_Visibility": avg_vis,
-            "Avg_VGS": avg_vgs,
-            "Avg_Overall": avg_ovr
-        })
+    for summary, logs, generations in outcomes:
+        print(f"   👉 {summary['Condition']} | Avg Vis: {summary['Avg_Visibility']:.3f} | VGS: {summary['Avg_VGS']:.3f} | Overall: {summary['Avg_Overall']:.3f}")
+        summary_stats.append(summary)
+        full_logs.extend(logs)
+        generations_log.extend(generations)
 
     # Save Everything
     pd.DataFrame(summary_stats).to_csv(OUTPUT_SUMMARY, index=False)
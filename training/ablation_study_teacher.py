@@ -2,19 +2,23 @@ import sys
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from tqdm import tqdm
 import time
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from simulator_agent import SimulatorAgent
-from visual_grounding import VisualGroundingScorer
+from visual_grounding import VisualGroundingScorer, load_image_types, UNGROUNDED_IMAGE_TYPES
 from verify_optimization import calculate_visibility_score, format_rag_context
+from ablation_study import run_pipelined
 
 # --- CONFIGURATION ---
 CANDIDATES_FILE = "data/test_candidates.json"
 REPO_FILE = "data/test_repo.json"
 VISUALS_FILE = "data/dense_captions.json"
+# Short (<=150 token) descriptions from visual_captions_compressor.py, used when present
+COMPRESSED_VISUALS_FILE = "data/dense_captions_compressed.json"
 PRINCIPLES_FILE = "data/mgeo_principles_refined.json"
 
 OUTPUT_SUMMARY = "data/ablation_teacher_summary.csv" 
@@ -38,6 +42,11 @@ def parse_output(text):
     return None
 
 class AblationAgent:
+    def __init__(self):
+        # Persistent keep-alive connection to Ollama instead of a new one per call
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=16))
+
     def optimize(self, query, product, visual_desc, rule_text):
         # --- THE STRONG PROMPT ARCHITECTURE ---
         
@@ -80,7 +89,7 @@ You must rigorously apply these rules:
         retries = 3
         for attempt in range(retries):
             try:
-                resp = requests.post(
+                resp = self.session.post(
                     "http://localhost:11434/api/chat",
                     json={
                         "model": MODEL_NAME,
@@ -90,7 +99,8 @@ You must rigorously apply these rules:
                         ],
                         "stream": False,
                         "options": {"temperature": 0.3,"num_ctx": 8192}
-                    }
+                    },
+                    timeout=120
                 )
                 if resp.status_code == 200:
                     data = resp.json()
@@ -107,7 +117,10 @@ def main():
     # 1. Load Data
     with open(CANDIDATES_FILE) as f: candidates_map = json.load(f)
     with open(REPO_FILE) as f: repo = json.load(f)
-    with open(VISUALS_FILE) as f: captions = json.load(f)
+    visuals_file = COMPRESSED_VISUALS_FILE if os.path.exists(COMPRESSED_VISUALS_FILE) else VISUALS_FILE
+    with open(visuals_file) as f: captions = json.load(f)
+    print(f"   Visual descriptions: {visuals_file}")
+    image_types = load_image_types()
     with open(PRINCIPLES_FILE) as f: p_data = json.load(f)
     
     rules_list = p_data.get('mgeo_principles', [])
@@ -151,6 +164,14 @@ def main():
     # RUNNING FULL SET
     print(f"   Total Samples: {len(tasks)}")
 
+    # Precompute image embeddings once; every condition reuses them
+    for query, product in tqdm(tasks, desc="Encoding Images"):
+        if image_types.get(product['item_id']) in UNGROUNDED_IMAGE_TYPES:
+            continue # Never scored (see calculate_vgs)
+        query_group = next((x for x in repo if x['query'] == query), None)
+        image_url = next((item.get('main_image_url') for item in query_group['results'] if item['item_id'] == product['item_id']), None)
+        vgs_judge.encode_image(product['item_id'], image_url)
+
     # Initialize Files
     if os.path.exists(OUTPUT_FULL): os.remove(OUTPUT_FULL)
     if os.path.exists(OUTPUT_SUMMARY): os.remove(OUTPUT_SUMMARY)
@@ -170,54 +191,58 @@ def main():
         
         scores_vis, scores_vgs, scores_ovr = [], [], []
         
-        for q, prod in tqdm(tasks):
-            res = agent.optimize(q, prod, captions.get(prod['item_id'], ""), condition["rule"])
-            
+        def optimize(q, prod):
+            return agent.optimize(q, prod, captions.get(prod['item_id'], ""), condition["rule"])
+
+        def score(task, res):
+            q, prod = task
             vis, vgs, ovr = 0, 0, 0
             
             if res:
                 # Simulation
                 q_group = next((x for x in repo if x['query'] == q), None)
-                candidates = []
+                overrides = {}
                 img_url = None
-                for item in q_group['results']:
+                for i, item in enumerate(q_group['results']):
                     if item['item_id'] == prod['item_id']:
-                        mod = item.copy()
-                        mod['title'] = res.get('optimized_title', prod['title'])
-                        mod['features'] = res.get('optimized_features', prod['features'])
-                        candidates.append(mod)
+                        overrides[i] = {
+                            'title': res.get('optimized_title', prod['title']),
+                            'features': res.get('optimized_features', prod['features'])
+                        }
                         img_url = item.get('main_image_url')
-                    else:
-                        candidates.append(item)
                 
-                gen = sim_agent.generate_response(q, format_rag_context(candidates))
+                gen = sim_agent.generate_response(q, format_rag_context(q_group['results'], overrides))
                 vis = calculate_visibility_score(gen, prod['item_id'])
                 
                 full_txt = f"{res.get('optimized_title','')} {res.get('optimized_features','')}"
-                vgs = vgs_judge.calculate_vgs(prod['item_id'], full_txt, img_url)
+                vgs = vgs_judge.calculate_vgs(prod['item_id'], full_txt, img_url, image_types.get(prod['item_id']))
                 ovr = (vis + vgs) / 2
 
+            return prod['item_id'], vis, vgs, ovr
+
+        # Called serially in task order, so the incremental saves stay consistent
+        def save(result):
+            item_id, vis, vgs, ovr = result
             scores_vis.append(vis)
             scores_vgs.append(vgs)
             scores_ovr.append(ovr)
             
             # --- INCREMENTAL SAVE (FULL LOGS) ---
-            new_row = {"condition": name, "id": prod['item_id'], "vis": vis, "vgs": vgs, "ovr": ovr}
+            new_row = {"condition": name, "id": item_id, "vis": vis, "vgs": vgs, "ovr": ovr}
             pd.DataFrame([new_row]).to_csv(OUTPUT_FULL, mode='a', header=False, index=False)
             
             # --- INCREMENTAL SAVE (SUMMARY) ---
-            avg_vis = sum(scores_vis)/len(scores_vis)
-            avg_vgs = sum(scores_vgs)/len(scores_vgs)
-            avg_ovr = sum(scores_ovr)/len(scores_ovr)
-            
             # Update the last entry in the summary list
-            summary_stats[-1]["Vis"] = avg_vis
-            summary_stats[-1]["VGS"] = avg_vgs
-            summary_stats[-1]["Overall"] = avg_ovr
+            summary_stats[-1]["Vis"] = sum(scores_vis)/len(scores_vis)
+            summary_stats[-1]["VGS"] = sum(scores_vgs)/len(scores_vgs)
+            summary_stats[-1]["Overall"] = sum(scores_ovr)/len(scores_ovr)
             
             # Overwrite summary file with current state
             pd.DataFrame(summary_stats).to_csv(OUTPUT_SUMMARY, index=False)
 
+        run_pipelined(tasks, optimize, score, on_result=save, desc=name)
+        avg_vis, avg_vgs, avg_ovr = summary_stats[-1]["Vis"], summary_stats[-1]["VGS"], summary_stats[-1]["Overall"]
+
         print(f"   👉 Vis: {avg_vis:.3f} | VGS: {avg_vgs:.3f} | Overall: {avg_ovr:.3f}")
 
     print(f"\n✅ FULL Robust Ablation Complete. Data in {OUTPUT_SUMMARY}")
@@ -8,7 +8,7 @@ import copy
 from tqdm import tqdm
 from optimizer_agent import OptimizerAgent
 from simulator_agent import SimulatorAgent
-from visual_grounding import VisualGroundingScorer
+from visual_grounding import VisualGroundingScorer, load_image_types
 # We reuse helper functions from your existing files
 from verify_optimization import format_rag_context, calculate_visibility_score
 
@@ -39,29 +39,25 @@ for name, path in files.items():
 SAMPLES_PER_PRODUCT = 5   # How many variations to try per product
 LAMBDA_PENALTY = 0.5      # Same safety setting as your verified success
 
-def score_variation(target_id, target_query, new_title, new_features, repo_data, sim_agent, vgs_judge):
+def score_variation(target_id, target_query, new_title, new_features, repo_data, sim_agent, vgs_judge, image_type=None):
     """
     Runs the 'Mini-Verification' loop for a single variation.
+    image_type: the extractor's class for the target image (infographics get the neutral VGS).
     """
     # 1. Setup Context (Hot Swap)
     query_group = next((q for q in repo_data if q['query'] == target_query), None)
     if not query_group: return -10, 0, 0
 
-    test_candidates = []
+    overrides = {}
     image_url = None
     
-    for item in query_group['results']:
+    for i, item in enumerate(query_group['results']):
         if item['item_id'] == target_id:
-            mod = item.copy()
-            mod['title'] = new_title
-            mod['features'] = new_features
-            test_candidates.append(mod)
+            overrides[i] = {'title': new_title, 'features': new_features}
             image_url = item.get('main_image_url')
-        else:
-            test_candidates.append(item)
 
     # 2. Run Simulator (Get Visibility)
-    rag_ctx = format_rag_context(test_candidates)
+    rag_ctx = format_rag_context(query_group['results'], overrides)
     
     # We use the Two-Step generation you implemented
     gen_text = sim_agent.generate_response(target_query, rag_ctx)
@@ -72,7 +68,7 @@ def score_variation(target_id, target_query, new_title, new_features, repo_data,
 
     # 3. Run Utility Judge (Get VGS)
     full_text = f"{new_title} {new_features}"
-    vgs_score = vgs_judge.calculate_vgs(target_id, full_text, image_url)
+    vgs_score = vgs_judge.calculate_vgs(target_id, full_text, image_url, image_type)
 
     # 4. Calculate Reward
     # Reward = Visibility - Penalty * (1 - VisualAccuracy)
@@ -122,6 +118,7 @@ def main():
     with open(CANDIDATES_FILE) as f: candidates_map = json.load(f)
     with open(REPO_FILE) as f: repo = json.load(f)
     with open(VISUALS_FILE) as f: captions = json.load(f)
+    image_types = load_image_types()
     with open(PRINCIPLES_FILE) as f: principles = json.load(f)
     
     mgeo_rules = principles.get('mgeo_principles', []) or principles.get('refined_principles', [])
@@ -182,7 +179,7 @@ def main():
                 target_id, query, 
                 result['optimized_title'], 
                 result['optimized_features'], 
-                repo, sim_agent, vgs_judge
+                repo, sim_agent, vgs_judge, image_types.get(target_id)
             )
             
             # 3. The Harvest Filter
@@ -1,17 +1,23 @@
 import sys
 import os
+import csv
 import json
+import threading
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from datetime import datetime
-from collections import Counter, defaultdict
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- IMPORTS (Adjust paths if needed) ---
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from simulator_agent import SimulatorAgent
-from visual_grounding import VisualGroundingScorer
-from verify_optimization import format_rag_context, calculate_visibility_score
-from evaluator import BaselineAgent, TrainedAgent  # Reuse your existing agents
+from visual_grounding import VisualGroundingScorer, load_image_types
+from verify_optimization import rag_item_parts, fill_rag_item, split_rag_context, calculate_visibility_score
+from evaluator import BaselineAgent, TrainedAgent, MAX_WORKERS, CACHE_BASELINE, SATURATION_THRESHOLD, make_vgs_scorer, scoring_config_key  # Reuse your existing agents
+from llm_cache import LLMCache, make_key
+from fast_json import load_json
 
 # --- CONFIGURATION ---
 REPO_CAT_FILE = "data/test_repo_cat.json"       # Source of Truth for Categories
@@ -20,6 +26,12 @@ VISUALS_FILE = "data/test_dense_captions_f.json"
 PRINCIPLES_FILE = "data/mgeo_principles_refined.json"
 
 OUTPUT_FULL = "data/category_results_full.csv"
+# Per-battle checkpoint while running (no Winner yet: decided for all rows at once at the end)
+OUTPUT_FULL_PARTIAL = "data/category_results_full.partial.csv"
+FULL_FIELDS = ["Category", "Query", "Item_ID", "Baseline_Score", "Trained_Score", "Score_Delta",
+               "Winner", "Baseline_Vis", "Trained_Vis", "Baseline_VGS", "Trained_VGS"]
+SCORE_FIELDS = ["Baseline_Score", "Trained_Score", "Score_Delta",
+                "Baseline_Vis", "Trained_Vis", "Baseline_VGS", "Trained_VGS"]
 OUTPUT_SUMMARY = "data/category_results_summary.csv"
 LOG_FILE = "data/category_battle_logs.txt"
 
@@ -31,23 +43,20 @@ def get_query_category_map(repo_path):
     Returns: dict { "query_string": "Category Name" }
     """
     print(f"📂 Classification: Scanning {repo_path}...")
-    with open(repo_path, encoding="utf-8") as f:
-        data = json.load(f)
+    data = load_json(repo_path)
 
-    query_to_cat = {}
+    # One row per categorized result, then count (query, category) pairs in one pass
+    rows = [
+        {"query": q_entry.get("query"), "category": p.get("category")}
+        for q_entry in data for p in q_entry.get("results", []) if p.get("category")
+    ]
+    counts = pd.DataFrame(rows, columns=["query", "category"]).value_counts(["query", "category"]).reset_index()
     
-    for q_entry in data:
-        query_text = q_entry.get("query")
-        cats = [p.get("category") for p in q_entry.get("results", []) if p.get("category")]
-        
-        if not cats:
-            dominant = "Uncategorized"
-        else:
-            # Your Logic: Dominant Category wins
-            dominant = Counter(cats).most_common(1)[0][0]
-            
-        query_to_cat[query_text] = dominant
-        
+    # Your Logic: Dominant Category wins (counts are sorted, so the first row per query is the max)
+    dominant = counts.drop_duplicates("query").set_index("query")["category"].to_dict()
+    
+    query_to_cat = {q_entry.get("query"): dominant.get(q_entry.get("query"), "Uncategorized") for q_entry in data}
+
     print(f"✅ Classified {len(query_to_cat)} queries.")
     return query_to_cat
 
@@ -64,20 +73,25 @@ def run_category_evaluation():
         print(f"❌ Error: {CANDIDATES_FILE} missing. Run previous steps to generate candidates.")
         return
 
-    with open(CANDIDATES_FILE) as f: candidates_map = json.load(f)
-    with open(REPO_CAT_FILE) as f: repo = json.load(f)
-    with open(VISUALS_FILE) as f: captions = json.load(f)
-    with open(PRINCIPLES_FILE) as f: principles = json.load(f)
+    candidates_map = load_json(CANDIDATES_FILE)
+    repo = load_json(REPO_CAT_FILE)
+    repo_index = {q['query']: q for q in repo}
+    captions = load_json(VISUALS_FILE)
+    image_types = load_image_types()
+    principles = load_json(PRINCIPLES_FILE)
     mgeo_rules = principles.get('mgeo_principles', [])
+    # Hashed once, part of every baseline cache key
+    rules_key = make_key(mgeo_rules)
+    config_key = scoring_config_key()
 
     # Initialize Agents
     baseline_agent = BaselineAgent("llama3:8b")
     trained_agent = TrainedAgent("geo-optimizer")
     sim_agent = SimulatorAgent()
-    vgs_judge = VisualGroundingScorer()
+    score_vgs, vgs_pool = make_vgs_scorer()
+    # Own namespace: the competitor set comes from REPO_CAT_FILE, not evaluator.py's repo
+    baseline_cache = LLMCache("category_evaluator_baseline") if CACHE_BASELINE else None
 
-    results = []
-    
     # Flatten Tasks
     tasks = []
     for q, items in candidates_map.items():
@@ -86,131 +100,154 @@ def run_category_evaluation():
         for i in items:
             tasks.append((q, i, cat))
 
+    # Columnar results, filled by task index (numbers in arrays, strings in lists)
+    n_tasks = len(tasks)
+    score_cols = {name: np.zeros(n_tasks, dtype=np.float64) for name in SCORE_FIELDS}
+    text_cols = {name: [None] * n_tasks for name in FULL_FIELDS if name not in score_cols}
+
+    results_lock = threading.Lock()
+    # Separate pool for the agent calls, so battles never wait on their own pool
+    agent_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS * 2)
+    # ...and a third for the post-optimize stages that run alongside the simulator
+    stage_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS * 2)
+
     # 2. BATTLE LOOP
-    for i, (query, product, category) in enumerate(tqdm(tasks, desc="Evaluator")):
+    def run_one_battle(idx, query, product, category):
         target_id = product['item_id']
         visual_desc = captions.get(target_id, "")
+
+        # Context for Simulator: competitors formatted once, each agent only swaps the target
+        query_group = repo_index.get(query)
+        if query_group:
+            rag_prefix, target_item, rag_suffix = split_rag_context(query_group['results'], target_id)
+            target_parts = rag_item_parts(target_item) if target_item else None
         
         # --- EXECUTION (Reusing Logic) ---
+        saturated = threading.Event()
+
         def evaluate_agent(agent):
+            if agent is trained_agent and saturated.is_set(): return None
+            cache_key = None
+            if baseline_cache is not None and agent is baseline_agent:
+                competitors = (rag_prefix, rag_suffix) if query_group else None
+                cache_key = make_key(agent.model, query, product, competitors, visual_desc, rules_key, config_key)
+                cached = baseline_cache.get(cache_key)
+                if cached: return tuple(cached)
+
             res = agent.optimize(query, product, visual_desc, mgeo_rules)
             if not res or not res.get('optimized_title'): return 0, 0, 0
+            # Baseline already unbeatable: don't spend the simulator + VGS calls
+            if agent is trained_agent and saturated.is_set(): return None
             
-            # Context for Simulator
-            query_group = next((x for x in repo if x['query'] == query), None)
             if not query_group: return 0, 0, 0
             
             # Construct RAG Context
-            test_candidates = []
             image_url = None
-            for item in query_group['results']:
-                if item['item_id'] == target_id:
-                    mod = item.copy()
-                    mod['title'] = res['optimized_title']
-                    mod['features'] = res['optimized_features']
-                    test_candidates.append(mod)
-                    image_url = item.get('main_image_url')
-                else:
-                    test_candidates.append(item)
+            rag_ctx = rag_prefix + rag_suffix
+            if target_item:
+                rag_ctx = rag_prefix + fill_rag_item(target_parts, res['optimized_title'], res['optimized_features']) + rag_suffix
+                image_url = target_item.get('main_image_url')
             
-            # Sim & VGS
-            rag_ctx = format_rag_context(test_candidates)
+            # Sim & VGS (in parallel: VGS only needs the optimized text)
+            full_txt = f"{res['optimized_title']} {res['optimized_features']}"
+            vgs_future = stage_pool.submit(score_vgs, target_id, full_txt, image_url, image_types.get(target_id))
             gen_text = sim_agent.generate_response(query, rag_ctx)
             vis = calculate_visibility_score(gen_text, target_id)
-            full_txt = f"{res['optimized_title']} {res['optimized_features']}"
-            vgs = vgs_judge.calculate_vgs(target_id, full_txt, image_url)
+            vgs = vgs_future.result()
             
+            if cache_key: baseline_cache.set(cache_key, [vis, vgs, (vis + vgs) / 2])
             return vis, vgs, (vis + vgs) / 2
 
-        # Run Both
-        b_vis, b_vgs, b_ovr = evaluate_agent(baseline_agent)
-        t_vis, t_vgs, t_ovr = evaluate_agent(trained_agent)
-
-        # Determine Winner
-        if t_ovr > b_ovr: winner = "Trained"
-        elif b_ovr > t_ovr: winner = "Baseline"
-        else: winner = "Tie"
+        # Run Both (side by side)
+        b_future = agent_pool.submit(evaluate_agent, baseline_agent)
+        t_future = agent_pool.submit(evaluate_agent, trained_agent)
+        b_vis, b_vgs, b_ovr = b_future.result()
+        if SATURATION_THRESHOLD is not None and b_ovr >= SATURATION_THRESHOLD:
+            saturated.set()
+            t_future.cancel()
+        t_scores = None if t_future.cancelled() else t_future.result()
+        # Skipped (baseline saturated): recorded as a Tie
+        t_vis, t_vgs, t_ovr = t_scores or (b_vis, b_vgs, b_ovr)
 
         # Log Result Row
-        results.append({
+        row = {
             "Category": category,  # <--- CRITICAL FIELD
             "Query": query,
             "Item_ID": target_id,
             "Baseline_Score": b_ovr,
             "Trained_Score": t_ovr,
             "Score_Delta": t_ovr - b_ovr,
-            "Winner": winner,
             "Baseline_Vis": b_vis,
             "Trained_Vis": t_vis,
             "Baseline_VGS": b_vgs,
             "Trained_VGS": t_vgs
-        })
+        }
         
-        # Incremental Save (Safety)
-        if i % 2 == 0:
-            pd.DataFrame(results).to_csv(OUTPUT_FULL, index=False)
+        with results_lock:
+            for name, value in row.items():
+                (score_cols if name in score_cols else text_cols)[name][idx] = value
+            # Incremental Save (Safety): one appended row, not a full rewrite
+            writer.writerow(row)
+            csv_file.flush()
+        return row
 
-    # 3. SAVE FINAL FULL RESULTS
-    df = pd.DataFrame(results)
+    with open(OUTPUT_FULL_PARTIAL, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=[name for name in FULL_FIELDS if name != "Winner"])
+        writer.writeheader()
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            futures = {ex.submit(run_one_battle, idx, q, p, c): (q, p) for idx, (q, p, c) in enumerate(tasks)}
+            for f in tqdm(as_completed(futures), total=len(futures), desc="Evaluator"):
+                f.result()
+    agent_pool.shutdown()
+    stage_pool.shutdown()
+    if vgs_pool: vgs_pool.shutdown()
+
+    # 3. SAVE FINAL FULL RESULTS (written once, task order; the checkpoint is no longer needed)
+    # Determine Winner for all battles at once
+    trained, baseline = score_cols["Trained_Score"], score_cols["Baseline_Score"]
+    text_cols["Winner"] = np.select([trained > baseline, baseline > trained], ["Trained", "Baseline"], default="Tie")
+    df = pd.DataFrame({**text_cols, **score_cols}, columns=FULL_FIELDS)
     df.to_csv(OUTPUT_FULL, index=False)
+    os.remove(OUTPUT_FULL_PARTIAL)
     print(f"\n✅ Raw Results saved to {OUTPUT_FULL}")
 
     # 4. GENERATE SUMMARY (The "Transaction Paper" Table)
     print("\n📊 Generating Executive Summary...")
     
-    summary_rows = []
+    # One-hot outcomes, so every stat is a plain column aggregate
+    df["is_trained_win"] = (df["Winner"] == "Trained").astype(int)
+    df["is_baseline_win"] = (df["Winner"] == "Baseline").astype(int)
+    df["is_tie"] = (df["Winner"] == "Tie").astype(int)
+    aggs = dict(
+        Samples=("Winner", "size"),
+        Trained_Wins=("is_trained_win", "sum"),
+        Baseline_Wins=("is_baseline_win", "sum"),
+        Ties=("is_tie", "sum"),
+        Avg_Baseline_Score=("Baseline_Score", "mean"),
+        Avg_Trained_Score=("Trained_Score", "mean"),
+    )
     
-    # Group by Category
-    grouped = df.groupby("Category")
+    # Group by Category, plus a "GLOBAL" row for comparison
+    per_category = df.groupby("Category").agg(**aggs).reset_index()
+    global_row = df.assign(Category="ALL_CATEGORIES (Global)").groupby("Category").agg(**aggs).reset_index()
+    stats = pd.concat([per_category, global_row], ignore_index=True)
     
-    for cat, group in grouped:
-        total = len(group)
-        trained_wins = len(group[group["Winner"] == "Trained"])
-        baseline_wins = len(group[group["Winner"] == "Baseline"])
-        ties = len(group[group["Winner"] == "Tie"])
-        
-        # Calculate Win Rates
-        win_rate = (trained_wins / total) * 100
-        
-        # Calculate Avg Improvements
-        avg_base = group["Baseline_Score"].mean()
-        avg_train = group["Trained_Score"].mean()
-        improvement = ((avg_train - avg_base) / avg_base) * 100 if avg_base > 0 else 0
-        
-        summary_rows.append({
-            "Category": cat,
-            "Samples": total,
-            "Trained_Win_Rate": f"{win_rate:.1f}%",
-            "Baseline_Wins": baseline_wins,
-            "Ties": ties,
-            "Avg_Baseline_Score": f"{avg_base:.2f}",
-            "Avg_Trained_Score": f"{avg_train:.2f}",
-            "Rel_Improvement": f"+{improvement:.1f}%"
-        })
-    
-    # Also add a "GLOBAL" row for comparison
-    total = len(df)
-    t_wins = len(df[df["Winner"] == "Trained"])
-    avg_base = df["Baseline_Score"].mean()
-    avg_train = df["Trained_Score"].mean()
-    imp = ((avg_train - avg_base) / avg_base) * 100 if avg_base > 0 else 0
-    
-    summary_rows.append({
-        "Category": "ALL_CATEGORIES (Global)",
-        "Samples": total,
-        "Trained_Win_Rate": f"{(t_wins/total)*100:.1f}%",
-        "Baseline_Wins": len(df[df["Winner"] == "Baseline"]),
-        "Ties": len(df[df["Winner"] == "Tie"]),
-        "Avg_Baseline_Score": f"{avg_base:.2f}",
-        "Avg_Trained_Score": f"{avg_train:.2f}",
-        "Rel_Improvement": f"+{imp:.1f}%"
-    })
+    # Win Rates & Avg Improvements
+    win_rate = stats["Trained_Wins"] / stats["Samples"] * 100
+    avg_base, avg_train = stats["Avg_Baseline_Score"], stats["Avg_Trained_Score"]
+    improvement = ((avg_train - avg_base) / avg_base * 100).where(avg_base > 0, 0)
 
-    summary_df = pd.DataFrame(summary_rows)
-    # Reorder columns for readability
-    cols = ["Category", "Samples", "Trained_Win_Rate", "Rel_Improvement", 
-            "Avg_Baseline_Score", "Avg_Trained_Score", "Baseline_Wins", "Ties"]
-    summary_df = summary_df[cols]
+    # Columns ordered for readability
+    summary_df = pd.DataFrame({
+        "Category": stats["Category"],
+        "Samples": stats["Samples"],
+        "Trained_Win_Rate": win_rate.map("{:.1f}%".format),
+        "Rel_Improvement": improvement.map("+{:.1f}%".format),
+        "Avg_Baseline_Score": avg_base.map("{:.2f}".format),
+        "Avg_Trained_Score": avg_train.map("{:.2f}".format),
+        "Baseline_Wins": stats["Baseline_Wins"],
+        "Ties": stats["Ties"]
+    })
     
     summary_df.to_csv(OUTPUT_SUMMARY, index=False)
     print(f"✅ Summary saved to {OUTPUT_SUMMARY}")
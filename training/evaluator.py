@@ -1,18 +1,31 @@
 import sys
 import os
 import json
+import atexit
+import functools
+import inspect
 import re
+import threading
+import multiprocessing
 import requests
+import torch
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 from tqdm import tqdm
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 # Add parent to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import ollama_utils
+import visual_grounding
 from simulator_agent import SimulatorAgent
-from visual_grounding import VisualGroundingScorer
-from verify_optimization import format_rag_context, calculate_visibility_score
+from visual_grounding import VisualGroundingScorer, load_image_types
+from verify_optimization import rag_item_parts, fill_rag_item, split_rag_context, calculate_visibility_score
+from llm_cache import LLMCache, make_key
+from fast_json import load_json
 
 # --- CONFIGURATION ---
 CANDIDATES_FILE = "data/test_candidates.json"
@@ -20,16 +33,49 @@ REPO_FILE = "data/test_repo.json"
 VISUALS_FILE = "data/dense_captions.json"
 PRINCIPLES_FILE = "data/mgeo_principles_refined.json"
 OUTPUT_RESULTS = "data/results_comparative.json"
+# Incremental checkpoint, one battle per line in completion order ("index" = task order, sort on it when loading)
+OUTPUT_RESULTS_STREAM = "data/results_comparative.jsonl"
 LOG_FILE = "data/battle_logs.txt"
 
 # --- VERBOSITY ---
 VERBOSE = True
 
+# --- CONCURRENCY ---
+# Battles in flight at once. Follows the server's batch size when OLLAMA_NUM_PARALLEL
+# is exported (e.g. OLLAMA_NUM_PARALLEL=8 ollama serve), so the client keeps it saturated.
+MAX_WORKERS = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
+
+# CLIP on CPU is GIL-bound, so VGS then fans out to this many judge processes.
+# On GPU it stays in-process (0).
+VGS_PROCESSES = 0 if torch.cuda.is_available() else max(1, min((os.cpu_count() or 2) - 1, MAX_WORKERS))
+
+# --- CACHING ---
+# Reuse baseline scores for (model, query, product, competitors, visuals, rules, scorer setup) already
+# evaluated, in this run or a previous one (stored in data/llm_cache.sqlite). Off by default: the
+# baseline samples at temperature 0.5, so a cached score replays one draw instead of a fresh one
+CACHE_BASELINE = False
+
+# Skip the rest of the trained agent's battle (recorded as a Tie) once the baseline
+# scores at least this Overall. None = always run both. Note Vis is not capped at 1,
+# so only set this when a score at the threshold really can't be beaten (e.g. 0.98).
+SATURATION_THRESHOLD = None
+
 # MODELS
 BASELINE_MODEL = "llama3:8b"     
 TRAINED_MODEL = "geo-optimizer"   
 
+# Stream replies and hang up as soon as the useful part has arrived
+# (closing the connection makes Ollama stop generating the trailing explanation)
+STREAM_RESPONSES = True
+
+# Shared keep-alive connection pool to Ollama (sized for the battle + agent pools)
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=max(32, MAX_WORKERS * 4), max_retries=Retry(total=2, backoff_factor=0.2)))
+
 # --- ROBUST PARSING HELPERS ---
+JSON_FENCE_RE = re.compile(r"```(?:json)?(.*?)```", re.DOTALL)
+JSON_DECODER = json.JSONDecoder()
+
 def extract_json_content(text):
     """
     Extracts JSON blob from markdown and fixes common syntax errors 
@@ -40,7 +86,7 @@ def extract_json_content(text):
     # 1. Strip Markdown Code Blocks
     if "```" in text:
         # regex to find content between ```json (optional) and ```
-        match = re.search(r"```(?:json)?(.*?)```", text, re.DOTALL)
+        match = JSON_FENCE_RE.search(text)
         if match:
             text = match.group(1).strip()
             
@@ -58,7 +104,15 @@ def extract_json_content(text):
     except json.JSONDecodeError:
         pass
         
-    # 4. JSON Repair Strategy (Fix unescaped quotes)
+    # 4. Peel off the first complete object (e.g. trailing text containing a '}')
+    while start != -1:
+        try:
+            obj, _ = JSON_DECODER.raw_decode(text, start)
+            return obj
+        except json.JSONDecodeError:
+            start = text.find('{', start + 1)
+        
+    # 5. JSON Repair Strategy (Fix unescaped quotes)
     # This is a common LLM error: "dimensions": "12"W x 10"H" -> Syntax Error
     # try:
         # Simple heuristic: If we fail, try to sanitize content values
@@ -70,6 +124,12 @@ def extract_json_content(text):
         
     return None
 
+# Section headers of the trained model's plain-text format (line-anchored, case-insensitive)
+TRAINED_STOP_RE = re.compile(r"^[ \t]*(?:visual truth:|visual completeness|principle)", re.IGNORECASE | re.MULTILINE)
+TRAINED_TITLE_RE = re.compile(r"^[ \t]*title:(.*?)(?=^[ \t]*features:|\Z)", re.IGNORECASE | re.MULTILINE | re.DOTALL)
+TRAINED_FEATURES_RE = re.compile(r"^[ \t]*features:(.*?)(?=^[ \t]*title:|\Z)", re.IGNORECASE | re.MULTILINE | re.DOTALL)
+LINE_BREAKS_RE = re.compile(r"\s*\n\s*")
+
 def parse_trained_output(text):
     """
     Parses the raw text format:
@@ -82,50 +142,79 @@ def parse_trained_output(text):
     # 1. Strip Markdown
     if "```" in text:
         text = text.replace("```", "").strip()
-        
-    lines = text.split('\n')
-    title = ""
-    features = ""
     
-    current_section = None
+    # 2. STOP parsing at the first explanation section
+    stop = TRAINED_STOP_RE.search(text)
+    if stop:
+        text = text[:stop.start()]
     
-    for line in lines:
-        clean = line.strip()
-        if not clean: continue
-        
-        # Detect Headers
-        lower_line = clean.lower()
-        if lower_line.startswith("title:"):
-            current_section = "title"
-            title += clean[6:].strip() + " "
-        elif lower_line.startswith("features:"):
-            current_section = "features"
-            features += clean[9:].strip() + " "
-        elif lower_line.startswith(("visual truth:", "visual completeness", "principle")):
-            # STOP parsing if we hit explanation sections
-            break
-        else:
-            # Append to current section
-            if current_section == "title":
-                title += clean + " "
-            elif current_section == "features":
-                features += clean + " "
-            # Fallback: if no section started yet, assume first line is Title
-            elif current_section is None and not title:
-                current_section = "title"
-                title += clean + " "
+    # 3. Extract sections (multi-line sections are joined with spaces)
+    title_match = TRAINED_TITLE_RE.search(text)
+    features_match = TRAINED_FEATURES_RE.search(text)
+    title = title_match.group(1) if title_match else ""
+    features = features_match.group(1) if features_match else ""
+    
+    # Fallback: no "Title:" header, assume the text before "Features:" is the Title
+    if not title_match:
+        title = text[:features_match.start()] if features_match else text
 
     return {
-        "optimized_title": title.strip(),
-        "optimized_features": features.strip()
+        "optimized_title": LINE_BREAKS_RE.sub(" ", title.strip()),
+        "optimized_features": LINE_BREAKS_RE.sub(" ", features.strip())
     }
 
+def json_object_complete(text):
+    """True once the text contains a full JSON object starting at its first '{'."""
+    start = text.find('{')
+    if start == -1: return False
+    try:
+        JSON_DECODER.raw_decode(text, start)
+        return True
+    except json.JSONDecodeError:
+        return False
+
+def trained_output_complete(text):
+    """True once the trained model has moved on to its explanation sections."""
+    return TRAINED_STOP_RE.search(text) is not None
+
+def post_chat(payload, is_complete=None):
+    """
+    Sends an /api/chat request and returns the reply text.
+    When streaming, reading stops as soon as is_complete(text_so_far) holds.
+    """
+    if not STREAM_RESPONSES:
+        resp = SESSION.post("http://localhost:11434/api/chat", json=payload, timeout=(5, 300))
+        return resp.json()['message']['content']
+
+    pieces = []
+    with SESSION.post("http://localhost:11434/api/chat", json=dict(payload, stream=True), stream=True, timeout=(5, 300)) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            if not line: continue
+            chunk = json.loads(line)
+            piece = chunk.get('message', {}).get('content', '')
+            pieces.append(piece)
+            if chunk.get('done'): break
+            # Only re-check when the new piece could have closed the object / opened a section
+            if is_complete and ('}' in piece or '\n' in piece or ':' in piece) and is_complete("".join(pieces)):
+                break
+    return "".join(pieces)
+
 # ==========================================
 # 1. THE BASELINE AGENT
 # ==========================================
 class BaselineAgent:
     def __init__(self, model_name):
         self.model = model_name
+        # (rules, serialized rules): the rules list is the same object on every call
+        self._rules_json = (None, "null")
+
+    def rules_json(self, rules):
+        cached_rules, cached_json = self._rules_json
+        if rules is not cached_rules:
+            cached_json = json.dumps(rules)
+            self._rules_json = (rules, cached_json)
+        return cached_json
 
     def optimize(self, query, product, visual_desc, rules):
         sys_msg = (
@@ -142,15 +231,14 @@ class BaselineAgent:
         Features: {product['features']}
         
         Rules:
-        {json.dumps(rules)}
+        {self.rules_json(rules)}
         """
         est_tokens = len(user_msg) / 3.0
         if est_tokens > 2048:
               print(f"⚠️ [evaluator] OPTIMIZATION PROMPT IS HUGE ({int(est_tokens)} tokens)!")
         try:
-            resp = requests.post(
-                "http://localhost:11434/api/chat",
-                json={
+            content = post_chat(
+                {
                     "model": self.model,
                     "messages": [
                         {"role": "system", "content": sys_msg},
@@ -158,9 +246,9 @@ class BaselineAgent:
                     ],
                     "stream": False,
                     "options": {"temperature": 0.5,"num_ctx": 8192}
-                }
+                },
+                is_complete=json_object_complete
             )
-            content = resp.json()['message']['content']
             
             # Use Robust Parser
             data = extract_json_content(content)
@@ -194,9 +282,8 @@ class TrainedAgent:
             print(f"⚠️ [evaluator] OPTIMIZATION PROMPT IS HUGE ({int(est_tokens)} tokens)!")
 
         try:
-            resp = requests.post(
-                "http://localhost:11434/api/chat",
-                json={
+            raw_text = post_chat(
+                {
                     "model": self.model,
                     "messages": [
                         {"role": "system", "content": sys_msg},
@@ -208,9 +295,9 @@ class TrainedAgent:
                         "num_ctx": 8192,
                         "stop": ["<|eot_id|>"]
                     }
-                }
+                },
+                is_complete=trained_output_complete
             )
-            raw_text = resp.json()['message']['content']
             
             # Use Robust Parser
             return parse_trained_output(raw_text)
@@ -219,95 +306,208 @@ class TrainedAgent:
             if VERBOSE: print(f"Train Error: {e}")
             return None
 
+# ==========================================
+# VGS JUDGE (in-process on GPU, process pool on CPU)
+# ==========================================
+_VGS_WORKER = None
+
+def _init_vgs_worker():
+    global _VGS_WORKER
+    torch.set_num_threads(1) # One core per judge; the pool provides the parallelism
+    _VGS_WORKER = VisualGroundingScorer()
+
+def _vgs_worker_score(item_id, text, image_url, image_type):
+    return _VGS_WORKER.calculate_vgs(item_id, text, image_url, image_type)
+
+def scoring_config_key():
+    """
+    Hash of the scorer setup a cached baseline score depends on besides its task: the simulator
+    prompt and its model defaults, and the VGS judge (CLIP model, windowing, infographic skip).
+    Any change there misses the cache instead of replaying stale scores.
+    """
+    return make_key(
+        inspect.getsource(SimulatorAgent.generate_response),
+        str(inspect.signature(ollama_utils.call_ollama)),
+        visual_grounding.CLIP_MODEL_ID,
+        sorted(visual_grounding.UNGROUNDED_IMAGE_TYPES),
+        inspect.getsource(VisualGroundingScorer.calculate_vgs_from_embed),
+    )
+
+def make_vgs_scorer():
+    """
+    Returns (score_vgs, process_pool). score_vgs(item_id, text, image_url, image_type) is memoized,
+    since the same (item, text, image) is often scored more than once.
+    process_pool is None when the judge runs in-process.
+    """
+    if VGS_PROCESSES <= 0:
+        judge = VisualGroundingScorer()
+        return functools.lru_cache(maxsize=8192)(judge.calculate_vgs), None
+
+    # spawn: the pool starts while battle threads are running, which fork can't handle safely
+    pool = ProcessPoolExecutor(max_workers=VGS_PROCESSES, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_vgs_worker)
+    def score(item_id, text, image_url=None, image_type=None):
+        return pool.submit(_vgs_worker_score, item_id, text, image_url, image_type).result()
+    return functools.lru_cache(maxsize=8192)(score), pool
+
 # ==========================================
 # 3. EVALUATION LOOP
 # ==========================================
+LOG_FLUSH_EVERY = 20 # Messages (one per battle) buffered before hitting the disk
+_LOG_FH = None
+_LOG_COUNT = 0
+
+def open_log(header):
+    """Truncates LOG_FILE and keeps one buffered handle open for the whole run."""
+    global _LOG_FH
+    _LOG_FH = open(LOG_FILE, "w", encoding="utf-8", buffering=1 << 20)
+    _LOG_FH.write(header + "\n")
+    atexit.register(_LOG_FH.close)
+
 def log_message(message):
+    global _LOG_COUNT
     if VERBOSE: tqdm.write(message)
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(message + "\n")
+    _LOG_FH.write(message + "\n")
+    _LOG_COUNT += 1
+    if _LOG_COUNT % LOG_FLUSH_EVERY == 0: _LOG_FH.flush()
 
 def run_evaluation():
     print(f"\n⚔️  PHASE 2: COMPARATIVE EVALUATION ({BASELINE_MODEL} vs {TRAINED_MODEL})...")
     
-    with open(LOG_FILE, "w") as f: f.write(f"--- BATTLE START: {datetime.now()} ---\n")
+    open_log(f"--- BATTLE START: {datetime.now()} ---")
 
-    with open(CANDIDATES_FILE) as f: candidates_map = json.load(f)
-    with open(REPO_FILE) as f: repo = json.load(f)
-    with open(VISUALS_FILE) as f: captions = json.load(f)
-    with open(PRINCIPLES_FILE) as f: principles = json.load(f)
+    candidates_map = load_json(CANDIDATES_FILE)
+    repo = load_json(REPO_FILE)
+    repo_index = {q['query']: q for q in repo}
+    captions = load_json(VISUALS_FILE)
+    image_types = load_image_types()
+    principles = load_json(PRINCIPLES_FILE)
     mgeo_rules = principles.get('mgeo_principles', [])
+    # Hashed once, part of every baseline cache key
+    rules_key = make_key(mgeo_rules)
+    config_key = scoring_config_key()
 
     baseline_agent = BaselineAgent(BASELINE_MODEL)
     trained_agent = TrainedAgent(TRAINED_MODEL)
     sim_agent = SimulatorAgent()
-    vgs_judge = VisualGroundingScorer()
+    score_vgs, vgs_pool = make_vgs_scorer()
+    baseline_cache = LLMCache("evaluator_baseline") if CACHE_BASELINE else None
 
-    results = []
     tasks = []
     for q, items in candidates_map.items():
         for i in items: tasks.append((q, i))
+    results = [None] * len(tasks) # Filled per task index, so the final JSON keeps task order
+
+    results_lock = threading.Lock()
+    # Separate pool for the agent calls, so battles never wait on their own pool
+    agent_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS * 2)
+    # ...and a third for the post-optimize stages that run alongside the simulator
+    stage_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS * 2)
 
-    for i, (query, product) in enumerate(tqdm(tasks, desc="Battling")):
+    def run_one_battle(i, query, product):
         target_id = product['item_id']
         visual_desc = captions.get(target_id, "")
-        
-        log_message(f"\n{'='*60}\n⚔️ BATTLE {i+1}: {target_id} | Q: {query}")
+        # Collected per battle and written in one go, so concurrent battles don't interleave
+        lines = [f"\n{'='*60}\n⚔️ BATTLE {i+1}: {target_id} | Q: {query}"]
+
+        # Competitors are formatted once per battle; each agent only re-formats the target
+        query_group = repo_index.get(query)
+        if query_group:
+            rag_prefix, target_item, rag_suffix = split_rag_context(query_group['results'], target_id)
+            target_parts = rag_item_parts(target_item) if target_item else None
+
+        saturated = threading.Event()
 
         def evaluate(agent, label):
-            log_message(f"👉 {label} Thinking...")
+            if agent is trained_agent and saturated.is_set(): return None
+            cache_key = None
+            if baseline_cache is not None and agent is baseline_agent:
+                competitors = (rag_prefix, rag_suffix) if query_group else None
+                cache_key = make_key(agent.model, query, product, competitors, visual_desc, rules_key, config_key)
+                cached = baseline_cache.get(cache_key)
+                if cached:
+                    lines.append(f"   ♻️ {label} Cached Stats: Vis={cached[0]:.2f} | VGS={cached[1]:.2f} | Overall={cached[2]:.2f}")
+                    return tuple(cached)
+
+            lines.append(f"👉 {label} Thinking...")
             res = agent.optimize(query, product, visual_desc, mgeo_rules)
             
             if not res or not res.get('optimized_title'):
-                log_message(f"   ❌ {label} Failed to parse output.")
+                lines.append(f"   ❌ {label} Failed to parse output.")
                 return 0, 0, 0
                 
             if VERBOSE:
-                log_message(f"   📝 {label} Output:\n      Title: {res['optimized_title']}\n      Feat : {str(res['optimized_features'])[:80]}...")
+                lines.append(f"   📝 {label} Output:\n      Title: {res['optimized_title']}\n      Feat : {str(res['optimized_features'])[:80]}...")
+
+            # Baseline already unbeatable: don't spend the simulator + VGS calls
+            if agent is trained_agent and saturated.is_set(): return None
 
-            query_group = next((q for q in repo if q['query'] == query), None)
             if not query_group: return 0, 0, 0
             
-            test_candidates = []
             image_url = None
-            for item in query_group['results']:
-                if item['item_id'] == target_id:
-                    mod = item.copy()
-                    mod['title'] = res['optimized_title']
-                    mod['features'] = res['optimized_features']
-                    test_candidates.append(mod)
-                    image_url = item.get('main_image_url')
-                else:
-                    test_candidates.append(item)
+            rag_ctx = rag_prefix + rag_suffix
+            if target_item:
+                rag_ctx = rag_prefix + fill_rag_item(target_parts, res['optimized_title'], res['optimized_features']) + rag_suffix
+                image_url = target_item.get('main_image_url')
+            
+            # VGS only needs the optimized text: it runs while the simulator generates
+            full_txt = f"{res['optimized_title']} {res['optimized_features']}"
+            vgs_future = stage_pool.submit(score_vgs, target_id, full_txt, image_url, image_types.get(target_id))
             
-            rag_ctx = format_rag_context(test_candidates)
             gen_text = sim_agent.generate_response(query, rag_ctx)
             vis = calculate_visibility_score(gen_text, target_id)
-            
-            full_txt = f"{res['optimized_title']} {res['optimized_features']}"
-            vgs = vgs_judge.calculate_vgs(target_id, full_txt, image_url)
+            vgs = vgs_future.result()
             
             ovr = (vis + vgs) / 2
-            log_message(f"   📊 {label} Stats: Vis={vis:.2f} | VGS={vgs:.2f} | Overall={ovr:.2f}")
+            lines.append(f"   📊 {label} Stats: Vis={vis:.2f} | VGS={vgs:.2f} | Overall={ovr:.2f}")
+            if cache_key: baseline_cache.set(cache_key, [vis, vgs, ovr])
             return vis, vgs, ovr
 
-        b_vis, b_vgs, b_ovr = evaluate(baseline_agent, "BASELINE")
-        t_vis, t_vgs, t_ovr = evaluate(trained_agent, "TRAINED")
+        # Baseline and trained agents run side by side
+        b_future = agent_pool.submit(evaluate, baseline_agent, "BASELINE")
+        t_future = agent_pool.submit(evaluate, trained_agent, "TRAINED")
+        b_vis, b_vgs, b_ovr = b_future.result()
+        if SATURATION_THRESHOLD is not None and b_ovr >= SATURATION_THRESHOLD:
+            saturated.set()
+            t_future.cancel()
+        t_scores = None if t_future.cancelled() else t_future.result()
+        if t_scores is None:
+            lines.append(f"   ⏭️ TRAINED skipped: baseline saturated (Overall={b_ovr:.2f})")
+            t_scores = (b_vis, b_vgs, b_ovr)
+        t_vis, t_vgs, t_ovr = t_scores
 
         winner = "Tie"
         if t_ovr > b_ovr: winner = "Trained"
         elif b_ovr > t_ovr: winner = "Baseline"
         
-        log_message(f"🏆 WINNER: {winner}")
+        lines.append(f"🏆 WINNER: {winner}")
 
-        results.append({
+        row = {
             "query": query, "product_id": target_id,
             "Baseline_Vis": b_vis, "Baseline_VGS": b_vgs, "Baseline_Overall": b_ovr,
             "Trained_Vis": t_vis, "Trained_VGS": t_vgs, "Trained_Overall": t_ovr,
             "Winner": winner
-        })
-        
-        pd.DataFrame(results).to_json(OUTPUT_RESULTS, orient='records', indent=4)
+        }
+
+        with results_lock:
+            log_message("\n".join(lines))
+            results[i] = row
+            stream_file.write(json.dumps({"index": i, **row}) + "\n")
+            stream_file.flush()
+        return row
+
+    with open(OUTPUT_RESULTS_STREAM, "w", encoding="utf-8") as stream_file:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            futures = {ex.submit(run_one_battle, i, q, p): (q, p) for i, (q, p) in enumerate(tasks)}
+            for f in tqdm(as_completed(futures), total=len(futures), desc="Battling"):
+                f.result()
+    agent_pool.shutdown()
+    stage_pool.shutdown()
+    if vgs_pool: vgs_pool.shutdown()
+    _LOG_FH.flush()
+
+    # Final JSON written once at the end
+    pd.DataFrame([row for row in results if row]).to_json(OUTPUT_RESULTS, orient='records', indent=4)
 
     print(f"\n✅ Results saved to {OUTPUT_RESULTS}")
 
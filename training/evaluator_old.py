@@ -1,25 +1,34 @@
 import sys
 import os
-import json
+import logging
+import threading
 import pandas as pd
 from tqdm import tqdm
 from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Add parent to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from optimizer_agent import OptimizerAgent
 from simulator_agent import SimulatorAgent
-from visual_grounding import VisualGroundingScorer
-from verify_optimization import format_rag_context, calculate_visibility_score
+from visual_grounding import VisualGroundingScorer, load_image_types
+from fast_json import load_json, dumps
+from verify_optimization import rag_item_parts, fill_rag_item, split_rag_context, calculate_visibility_score
 
 # --- CONFIGURATION ---
 CANDIDATES_FILE = "data/test_candidates.json"
 REPO_FILE = "data/test_repo.json"
 VISUALS_FILE = "data/dense_captions.json"
 PRINCIPLES_FILE = "data/mgeo_principles_refined.json"
-OUTPUT_RESULTS = "data/results_comparative.json"
+# Own files, so running this next to evaluator.py never clobbers or mixes its results
+OUTPUT_RESULTS = "data/results_comparative_old.json"
+# Incremental checkpoint, one battle per line in completion order ("index" = task order, sort on it when loading)
+OUTPUT_RESULTS_STREAM = "data/results_comparative_old.jsonl"
 LOG_FILE = "data/battle_logs.txt"
+LOG_MAX_BYTES = 50_000_000 # Rotate to battle_logs.txt.1, .2, ... past this size
+LOG_BACKUPS = 5
 
 # --- VERBOSITY SETTINGS ---
 VERBOSE = True  # Set to True to see LLM output and detailed scores in console/logs
@@ -28,31 +37,50 @@ VERBOSE = True  # Set to True to see LLM output and detailed scores in console/l
 BASELINE_MODEL = "llama3:8b"     # Stock Model
 TRAINED_MODEL = "geo-optimizer"        # Your Model
 
+# --- CONCURRENCY ---
+# Battles in flight at once (match the server's OLLAMA_NUM_PARALLEL)
+MAX_WORKERS = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
+
 def get_overall_score(vis, vgs):
     return (vis + vgs) / 2
 
+logger = logging.getLogger("battle")
+
+def open_log(header):
+    """Starts a fresh LOG_FILE (the previous run rotates to .1) with size-capped rotation."""
+    handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+    if handler.stream.tell() > 0:
+        handler.doRollover()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False # Console output goes through tqdm.write below
+    logger.info(header.rstrip("\n"))
+
 def log_message(message):
     """Prints to console and appends to log file."""
     if VERBOSE:
         tqdm.write(message)
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(message + "\n")
+    logger.info(message)
 
 def run_evaluation():
     print(f"\n⚔️  PHASE 2: COMPARATIVE EVALUATION ({BASELINE_MODEL} vs {TRAINED_MODEL})...")
     
     # Initialize Log File
-    with open(LOG_FILE, "w", encoding="utf-8") as f:
-        f.write(f"--- BATTLE LOG START: {datetime.now()} ---\n")
-        f.write(f"Baseline: {BASELINE_MODEL}\n")
-        f.write(f"Challenger: {TRAINED_MODEL}\n")
-        f.write("="*60 + "\n")
+    open_log(
+        f"--- BATTLE LOG START: {datetime.now()} ---\n"
+        f"Baseline: {BASELINE_MODEL}\n"
+        f"Challenger: {TRAINED_MODEL}\n"
+        + "="*60 + "\n"
+    )
 
     # 1. Load Data
-    with open(CANDIDATES_FILE) as f: candidates_map = json.load(f)
-    with open(REPO_FILE) as f: repo = json.load(f)
-    with open(VISUALS_FILE) as f: captions = json.load(f)
-    with open(PRINCIPLES_FILE) as f: principles = json.load(f)
+    candidates_map = load_json(CANDIDATES_FILE)
+    repo = load_json(REPO_FILE)
+    repo_index = {q['query']: q for q in repo} # O(1) context lookup per battle
+    captions = load_json(VISUALS_FILE)
+    image_types = load_image_types()
+    principles = load_json(PRINCIPLES_FILE)
     mgeo_rules = principles.get('mgeo_principles', [])
 
     # 2. Init Agents
@@ -62,109 +90,138 @@ def run_evaluation():
     
     sim_agent = SimulatorAgent() # Uses gpt-oss by default (the Judge)
     vgs_judge = VisualGroundingScorer()
-
-    results = []
     
     # Flatten Dictionary
     tasks = []
     for q, items in candidates_map.items():
         for i in items: tasks.append((q, i))
+    results = [None] * len(tasks) # Filled per task index, so the final JSON keeps task order
+
+    # Each target's image is encoded once, before the battles start
+    vgs_judge.prewarm_images((
+        (product['item_id'], target.get('main_image_url'))
+        for query, product in tasks if query in repo_index
+        for target in repo_index[query]['results'] if target['item_id'] == product['item_id']
+    ), image_types)
 
-    for i, (query, product) in enumerate(tqdm(tasks, desc="Battling")):
+    results_lock = threading.Lock()
+    # Separate pool for the agent calls, so battles never wait on their own pool
+    agent_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS * 2)
+
+    def run_one_battle(i, query, product):
         target_id = product['item_id']
         visual_desc = captions.get(target_id, "")
+        # Collected per battle and logged in one go, so concurrent battles don't interleave
+        lines = [
+            f"\n{'='*60}",
+            f"⚔️ BATTLE {i+1}/{len(tasks)}: {target_id}",
+            f"   Query: {query}",
+            f"{'='*60}"
+        ]
         
-        log_message(f"\n{'='*60}")
-        log_message(f"⚔️ BATTLE {i+1}/{len(tasks)}: {target_id}")
-        log_message(f"   Query: {query}")
-        log_message(f"{'='*60}")
-        
+        # Competitors are formatted once per battle; each agent only swaps in its target
+        query_group = repo_index.get(query)
+        if query_group:
+            rag_prefix, target_item, rag_suffix = split_rag_context(query_group['results'], target_id)
+            target_parts = rag_item_parts(target_item) if target_item else None
+
         # --- SCORING HELPER ---
-        def evaluate_agent(agent, model_label):
-            log_message(f"\n👉 Invoking Agent: {model_label} ...")
+        def evaluate_agent(agent, model_label, out):
+            out.append(f"\n👉 Invoking Agent: {model_label} ...")
             
             # 1. Optimization
             # The Agent handles the prompt construction and JSON parsing
             opt_res = agent.optimize_product(query, product, visual_desc, mgeo_rules)
             
             if not opt_res: 
-                log_message(f"   ⚠️ {model_label} FAILED to produce valid JSON.")
+                out.append(f"   ⚠️ {model_label} FAILED to produce valid JSON.")
                 return 0, 0, 0
             
             # Log Output
             if VERBOSE:
-                log_message(f"   📝 OUTPUT ({model_label}):")
-                log_message(f"      Title: {opt_res['optimized_title']}")
-                log_message(f"      Feat : {opt_res['optimized_features'][:100]}...") # Truncate for sanity
+                out.append(f"   📝 OUTPUT ({model_label}):")
+                out.append(f"      Title: {opt_res['optimized_title']}")
+                out.append(f"      Feat : {opt_res['optimized_features'][:100]}...") # Truncate for sanity
             
             # 2. Context Setup for Simulator
-            query_group = next((q for q in repo if q['query'] == query), None)
             if not query_group: 
-                log_message("   ❌ Error: Query context not found in repo.")
+                out.append("   ❌ Error: Query context not found in repo.")
                 return 0, 0, 0
             
-            test_candidates = []
+            # Only the target is re-formatted; competitors come from the battle's template
             image_url = None
-            for item in query_group['results']:
-                if item['item_id'] == target_id:
-                    mod = item.copy()
-                    mod['title'] = opt_res['optimized_title']
-                    mod['features'] = opt_res['optimized_features']
-                    test_candidates.append(mod)
-                    image_url = item.get('main_image_url')
-                else:
-                    test_candidates.append(item)
+            rag_ctx = rag_prefix + rag_suffix
+            if target_item:
+                rag_ctx = rag_prefix + fill_rag_item(target_parts, opt_res['optimized_title'], opt_res['optimized_features']) + rag_suffix
+                image_url = target_item.get('main_image_url')
             
             # 3. Calculate Scores
             # A. Visibility
-            rag_ctx = format_rag_context(test_candidates)
             gen_text = sim_agent.generate_response(query, rag_ctx)
             vis = calculate_visibility_score(gen_text, target_id)
             
             # B. Visual Grounding
             full_text = f"{opt_res['optimized_title']} {opt_res['optimized_features']}"
-            vgs = vgs_judge.calculate_vgs(target_id, full_text, image_url)
+            vgs = vgs_judge.calculate_vgs(target_id, full_text, image_url, image_types.get(target_id))
             
             overall = get_overall_score(vis, vgs)
             
-            log_message(f"   📊 SCORES ({model_label}): Vis={vis:.2f} | VGS={vgs:.2f} | Overall={overall:.2f}")
+            out.append(f"   📊 SCORES ({model_label}): Vis={vis:.2f} | VGS={vgs:.2f} | Overall={overall:.2f}")
             return vis, vgs, overall
 
         # --- RUN EVALUATION ---
-        # 1. Baseline
-        b_vis, b_vgs, b_ovr = evaluate_agent(agent_base, BASELINE_MODEL)
-        
-        # 2. Trained
-        t_vis, t_vgs, t_ovr = evaluate_agent(agent_train, TRAINED_MODEL)
+        # Baseline and Trained side by side (each logs to its own list, kept in order)
+        b_lines, t_lines = [], []
+        b_future = agent_pool.submit(evaluate_agent, agent_base, BASELINE_MODEL, b_lines)
+        t_future = agent_pool.submit(evaluate_agent, agent_train, TRAINED_MODEL, t_lines)
+        b_vis, b_vgs, b_ovr = b_future.result()
+        t_vis, t_vgs, t_ovr = t_future.result()
+        lines.extend(b_lines + t_lines)
 
         # Winner Logic
         winner = "Tie"
         if t_ovr > b_ovr: winner = "Trained"
         elif b_ovr > t_ovr: winner = "Baseline"
         
-        log_message(f"\n🏆 WINNER: {winner} (Train {t_ovr:.2f} vs Base {b_ovr:.2f})")
+        lines.append(f"\n🏆 WINNER: {winner} (Train {t_ovr:.2f} vs Base {b_ovr:.2f})")
 
-        results.append({
+        row = {
             "query": query,
             "product_id": target_id,
             "Baseline_Vis": b_vis, "Baseline_VGS": b_vgs, "Baseline_Overall": b_ovr,
             "Trained_Vis": t_vis,   "Trained_VGS": t_vgs,   "Trained_Overall": t_ovr,
             "Winner": winner
-        })
+        }
         
-        # Incremental Save (So you don't lose data if it crashes)
-        pd.DataFrame(results).to_json(OUTPUT_RESULTS, orient='records', indent=4)
+        with results_lock:
+            log_message("\n".join(lines))
+            results[i] = row
+            # Incremental Save (So you don't lose data if it crashes): one appended line per battle
+            stream_file.write(dumps({"index": i, **row}) + "\n")
+            stream_file.flush()
+        return row
+
+    # Battles are independent and network-bound: keep several in flight
+    with open(OUTPUT_RESULTS_STREAM, "w", encoding="utf-8") as stream_file:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            futures = [ex.submit(run_one_battle, i, q, p) for i, (q, p) in enumerate(tasks)]
+            for f in tqdm(as_completed(futures), total=len(futures), desc="Battling"):
+                f.result()
+    agent_pool.shutdown()
+
+    # Final JSON written once at the end
+    df = pd.DataFrame([row for row in results if row])
+    df.to_json(OUTPUT_RESULTS, orient='records', indent=4)
 
     print(f"\n✅ Comparative results saved to {OUTPUT_RESULTS}")
     print(f"📜 Detailed logs saved to {LOG_FILE}")
     
     # Quick Stats
-    df = pd.DataFrame(results)
     if not df.empty:
         print("\n📊 QUICK LOOK:")
         print(f"Avg Train Overall: {df['Trained_Overall'].mean():.4f}")
         print(f"Avg Base Overall : {df['Baseline_Overall'].mean():.4f}")
-        print(f"Train Win Rate   : {(len(df[df['Winner']=='Trained'])/len(df))*100:.1f}%")
+        print(f"Train Win Rate   : {(df['Winner'] == 'Trained').mean()*100:.1f}%")
 
 if __name__ == "__main__":
     run_evaluation()
\ No newline at end of file
@@ -1,5 +1,7 @@
 import sys
 import os
+import shutil
+import subprocess
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 
@@ -8,6 +10,19 @@ from unsloth import FastLanguageModel
 # --- CONFIGURATION ---
 ADAPTER_DIR = "fine_tuned_optimizer"
 OUTPUT_GGUF = "models/geo_optimizer_v1.gguf" # Where to save
+QUANT_METHOD = "q4_k_m"
+
+# Local llama.cpp checkout: we convert + quantize ourselves (all cores, no leftover files)
+LLAMA_CPP_DIR = "llama.cpp"
+MERGED_DIR = "models/geo_optimizer_v1_merged" # Temporary, removed after quantizing
+KEEP_INTERMEDIATE = False
+
+def find_quantize_bin():
+    # Newer builds ship llama-quantize under build/bin, older ones ./quantize
+    for candidate in ("build/bin/llama-quantize", "llama-quantize", "quantize"):
+        path = os.path.join(LLAMA_CPP_DIR, candidate)
+        if os.path.exists(path): return path
+    return None
 
 print(f"🚀 Loading Adapters from {ADAPTER_DIR}...")
 model, tokenizer = FastLanguageModel.from_pretrained(
@@ -17,6 +32,25 @@ model, tokenizer = FastLanguageModel.from_pretrained(
     load_in_4bit = True,
 )
 
-print("   Merging and Saving to GGUF (q4_k_m)...")
-model.save_pretrained_gguf("models", tokenizer, quantization_method = "q4_k_m")
-print("✅ Export Complete. You can now load this in Ollama.")
\ No newline at end of file
+quantize_bin = find_quantize_bin()
+if quantize_bin is None:
+    print(f"   ⚠️ No llama.cpp build in {LLAMA_CPP_DIR}, using unsloth's exporter.")
+    print(f"   Merging and Saving to GGUF ({QUANT_METHOD})...")
+    model.save_pretrained_gguf("models", tokenizer, quantization_method = QUANT_METHOD)
+else:
+    print("   Merging LoRA into 16-bit weights...")
+    model.save_pretrained_merged(MERGED_DIR, tokenizer, save_method = "merged_16bit")
+
+    # One f16 GGUF straight from the merged weights, then a single quantize pass into OUTPUT_GGUF
+    f16_gguf = os.path.join(MERGED_DIR, "ggml-model-f16.gguf")
+    print("   Converting to GGUF (f16)...")
+    subprocess.run([sys.executable, os.path.join(LLAMA_CPP_DIR, "convert_hf_to_gguf.py"), MERGED_DIR,
+                    "--outtype", "f16", "--outfile", f16_gguf], check=True)
+    print(f"   Quantizing to {QUANT_METHOD} ({os.cpu_count()} threads)...")
+    subprocess.run([quantize_bin, f16_gguf, OUTPUT_GGUF, QUANT_METHOD, str(os.cpu_count())], check=True)
+
+    if not KEEP_INTERMEDIATE:
+        shutil.rmtree(MERGED_DIR) # Merged safetensors + f16 GGUF are several GB
+    print(f"   Saved {OUTPUT_GGUF}")
+
+print("✅ Export Complete. You can now load this in Ollama.")
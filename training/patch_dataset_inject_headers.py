@@ -1,28 +1,38 @@
 import json
 import os
 import sys
+import time
+from collections import Counter
 from tqdm import tqdm
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from ollama_utils import call_ollama_chat 
+from ollama_utils import call_ollama_chat_cached 
+from checkpointer import Checkpointer
+from fast_json import iter_json_array, JsonArrayWriter
+from parallel_utils import ordered_map
 
 # --- CONFIGURATION ---
 INPUT_FILE = "data/rl_finetuning_dataset_verbose.json"  # Your current best dataset
 OUTPUT_FILE = "data/rl_finetuning_dataset_structured.json" # The new Goal
+CHECKPOINT_FILE = "data/rl_finetuning_dataset_structured.partial.jsonl" # Appended in the background while running
 TEACHER_MODEL = "gpt-oss" 
+MAX_WORKERS = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8)) # Teacher calls in flight at once
+RETRIES = 3 # Attempts per item while the teacher returns nothing (backoff 1s, 2s, ...)
 
 def inject_headers():
     if not os.path.exists(INPUT_FILE):
         print("❌ Input file not found.")
         return
 
-    with open(INPUT_FILE, "r") as f:
-        data = json.load(f)
+    # Streamed: only the items in flight are held in memory
+    data = iter_json_array(INPUT_FILE)
 
-    print(f"💉 Injecting Headers into {len(data)} items...")
+    print(f"💉 Injecting Headers into {INPUT_FILE}...")
     
-    new_data = []
+    checkpoint = Checkpointer(CHECKPOINT_FILE)
+    output = JsonArrayWriter(OUTPUT_FILE)
+    stats = Counter()
     
-    for item in tqdm(data, desc="Structuring"):
+    def structure_item(item):
         current_out = item['output']
         
         # PROMPT: Force Bold Headers
@@ -39,28 +49,38 @@ RULES:
 
         messages = [{"role": "system", "content": sys_msg}, {"role": "user", "content": user_msg}]
         
-        try:
+        # The helper swallows its own errors and returns "" once they are exhausted:
+        # an empty reply is the failure signal (empty replies are never cached, so a retry really re-asks)
+        rewritten, retries = "", 0
+        for attempt in range(RETRIES):
             # Low temp for strictly formatting
-            rewritten = call_ollama_chat(messages, model=TEACHER_MODEL, temperature=0.1)
+            rewritten = call_ollama_chat_cached(messages, model=TEACHER_MODEL, temperature=0.1)
+            if rewritten:
+                break
+            if attempt + 1 < RETRIES:
+                retries += 1
+                time.sleep(2 ** attempt)
             
-            # Validation: Check if it actually added headers
-            if rewritten and "**" in rewritten:
-                item['output'] = rewritten
-            else:
-                pass # Keep original if fails
-                
-            new_data.append(item)
-        except:
-            new_data.append(item)
-            
-        if len(new_data) % 50 == 0:
-            with open(OUTPUT_FILE, "w") as f:
-                json.dump(new_data, f, indent=4)
+        # Validation: Check if it actually added headers
+        if rewritten and "**" in rewritten:
+            item['output'] = rewritten
+            return item, "ok", retries
+        return item, "fallback", retries # Keep original if fails
+
+    # Items are independent: keep MAX_WORKERS teacher calls in flight (results come back in input order)
+    for done, (item, outcome, retries) in enumerate(tqdm(ordered_map(structure_item, data, MAX_WORKERS), desc="Structuring"), 1):
+        stats[outcome] += 1
+        stats['retry'] += retries
+        output.write(item)
+        checkpoint.add(item)
+        if done % 50 == 0:
+            checkpoint.flush()
 
-    with open(OUTPUT_FILE, "w") as f:
-        json.dump(new_data, f, indent=4)
+    checkpoint.close()
+    output.close()
         
     print(f"✅ Structure Injected. Saved to {OUTPUT_FILE}")
+    print(f"   📊 Headers added: {stats['ok']} | Kept original: {stats['fallback']} | Retries: {stats['retry']}")
 
 if __name__ == "__main__":
     inject_headers()
\ No newline at end of file
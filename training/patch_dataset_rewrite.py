@@ -13,28 +13,34 @@ import time
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from ollama_utils import call_ollama_chat  # <--- Using your utils
+from ollama_utils import call_ollama_chat_cached, CHAT_CACHE_STATS  # <--- Using your utils
+from checkpointer import Checkpointer
+from fast_json import iter_json_array, JsonArrayWriter
+from parallel_utils import ordered_map
 
 # --- CONFIGURATION ---
 INPUT_FILE = "data/rl_finetuning_dataset.json"
 OUTPUT_FILE = "data/rl_finetuning_dataset_verbose.json"
+CHECKPOINT_FILE = "data/rl_finetuning_dataset_verbose.partial.jsonl"  # Appended in the background while running
 TEACHER_MODEL = "gpt-oss"  # <--- The Smart Teacher
+# Teacher calls in flight at once (match the server's OLLAMA_NUM_PARALLEL)
+MAX_WORKERS = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
 
 def rewrite_dataset():
     if not os.path.exists(INPUT_FILE):
         print(f"❌ Input file {INPUT_FILE} not found.")
         return
 
-    with open(INPUT_FILE, "r") as f:
-        data = json.load(f)
+    # Streamed: only the items in flight are held in memory
+    data = iter_json_array(INPUT_FILE)
 
-    print(f"🔄 Rewriting {len(data)} examples using {TEACHER_MODEL}...")
+    print(f"🔄 Rewriting {INPUT_FILE} using {TEACHER_MODEL}...")
     print("   Goal: Convert 'Robot Lists' -> 'Persuasive Paragraphs'")
     
-    new_data = []
+    checkpoint = Checkpointer(CHECKPOINT_FILE)
+    output = JsonArrayWriter(OUTPUT_FILE)
     
-    # We iterate with index to catch errors if needed
-    for i, item in enumerate(tqdm(data, desc="Polishing Data")):
+    def rewrite_item(item):
         current_output = item['output']
         current_input = item['input'] # Use input context if available to help accuracy
         
@@ -78,7 +84,7 @@ REWRITE THIS:"""
             {"role": "user", "content": user_msg}
         ]
         
-        rewritten = call_ollama_chat(
+        rewritten = call_ollama_chat_cached(
             messages=messages,
             model=TEACHER_MODEL,
             temperature=0.5
@@ -86,21 +92,24 @@ REWRITE THIS:"""
         
         if rewritten and len(rewritten) > 20: # Basic validation
             item['output'] = rewritten
-            new_data.append(item)
-        else:
-            # Fallback: If rewrite fails, keep original (safety net)
-            # print(f"⚠️ Rewrite failed for item {i}. Keeping original.")
-            new_data.append(item)
+        # else Fallback: If rewrite fails, keep original (safety net)
+        return item
 
-        # Periodic Save (Safety)
+    # Items are independent: keep MAX_WORKERS teacher calls in flight (results come back in input order)
+    n_items = 0
+    for i, item in enumerate(tqdm(ordered_map(rewrite_item, data, MAX_WORKERS), desc="Polishing Data")):
+        output.write(item)
+        checkpoint.add(item)
+        n_items += 1
+
+        # Periodic Save (Safety): only the new items, written off the main thread
         if i % 50 == 0:
-            with open(OUTPUT_FILE, "w") as f:
-                json.dump(new_data, f, indent=4)
+            checkpoint.flush()
 
-    # Final Save
-    with open(OUTPUT_FILE, "w") as f:
-        json.dump(new_data, f, indent=4)
+    checkpoint.close()
+    output.close()
     
+    print(f"   Teacher cache: {CHAT_CACHE_STATS['hits']} hits, {CHAT_CACHE_STATS['misses']} calls for {n_items} items")
     print(f"✅ Success! Persuasive dataset saved to {OUTPUT_FILE}")
 
 if __name__ == "__main__":
@@ -1,17 +1,31 @@
-import json
 import re
 import sys
 import os
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from ollama_utils import call_ollama_chat  # Ensure this is accessible
+from ollama_utils import call_ollama_chat_cached, CHAT_CACHE_STATS  # Ensure this is accessible
+from fast_json import load_json, dump_json
 
 # --- CONFIGURATION ---
 INPUT_FILE = "data/rl_finetuning_dataset_v2_trash.json"
 OUTPUT_FILE = "data/rl_finetuning_dataset_FIXED.json"
 TEACHER_MODEL = "gpt-oss"  # or "llama3:8b" if gpt-oss is unavailable
+MAX_WORKERS = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))  # Teacher calls in flight at once
 
-def generate_hybrid_output(item):
+# Fields embedded in each instruction, parsed once for the whole dataset
+QUERY_RE = re.compile(r"query: '([^']*)")
+VISUALS_RE = re.compile(r"Visual Truth: ([^\n]*)")
+
+def parse_instruction(instruction):
+    """
+    Returns (query, visuals) from an instruction; either is None if missing.
+    """
+    q_match = QUERY_RE.search(instruction)
+    v_match = VISUALS_RE.search(instruction)
+    return (q_match.group(1) if q_match else None), (v_match.group(1) if v_match else None)
+
+def generate_hybrid_output(item, query, visuals):
     """
     Uses the Teacher Model to generate a superior, SEO-friendly output.
     """
@@ -21,11 +35,8 @@ def generate_hybrid_output(item):
     # Extract Title specifically
     input_title = raw_input.split('\n')[0].replace("Title:", "").strip()
     
-    # Extract Visual Truth and Query from instruction
-    try:
-        query = item['instruction'].split("query: '")[1].split("'")[0]
-        visuals = item['instruction'].split("Visual Truth: ")[1].split("\n")[0]
-    except:
+    # Visual Truth and Query come from the pre-pass
+    if query is None or visuals is None:
         # Fallback if parsing fails
         query = "Product"
         visuals = "Visual details"
@@ -63,7 +74,7 @@ Do not write "Here is the title" or any other conversational filler. Just the tw
 """
 
     # Call the Teacher Model
-    response = call_ollama_chat(
+    response = call_ollama_chat_cached(
         model=TEACHER_MODEL,
         messages=[
             {"role": "system", "content": sys_msg},
@@ -79,14 +90,17 @@ Do not write "Here is the title" or any other conversational filler. Just the tw
 # --- MAIN LOOP ---
 print(f"🚀 Starting Data Regeneration using {TEACHER_MODEL}...")
 
-with open(INPUT_FILE, 'r') as f:
-    data = json.load(f)
+data = load_json(INPUT_FILE)
 
-fixed_data = []
+# Pre-pass: parse every instruction once (prompt + input rewrite both reuse it)
+parsed = [parse_instruction(item['instruction']) for item in data]
+unparsed = sum(query is None or visuals is None for query, visuals in parsed)
+if unparsed:
+    print(f"⚠️ {unparsed}/{len(data)} instructions missing the query or Visual Truth (generic prompt used).")
 
-# Process first 5 for testing, remove [:5] to run full dataset
-for i, item in enumerate(tqdm(data)):
-    new_output = generate_hybrid_output(item)
+def fix_item(item, fields):
+    query, visuals = fields
+    new_output = generate_hybrid_output(item, query, visuals)
     
     # Sanity check: Ensure it didn't generate garbage
     if len(new_output) < 10: 
@@ -98,16 +112,19 @@ for i, item in enumerate(tqdm(data)):
     # OPTIONAL: Chain-of-Thought Injection (Prepend Query to Input)
     # This teaches the model to look at the input for the query
     current_input_body = item['input']
-    if "Target Query:" not in current_input_body:
+    if "Target Query:" not in current_input_body and query is not None:
         # We inject the query at the top of the input text
-        query_str = item['instruction'].split("query: '")[1].split("'")[0]
-        item['input'] = f"Target Query: {query_str}\n{current_input_body}"
+        item['input'] = f"Target Query: {query}\n{current_input_body}"
+
+    return item
 
-    fixed_data.append(item)
+# Items are independent: keep MAX_WORKERS teacher calls in flight (map keeps input order)
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+    fixed_data = list(tqdm(ex.map(fix_item, data, parsed), total=len(data)))
 
 # Save
-with open(OUTPUT_FILE, 'w') as f:
-    json.dump(fixed_data, f, indent=4)
+dump_json(fixed_data, OUTPUT_FILE)
 
+print(f"   Teacher cache: {CHAT_CACHE_STATS['hits']} hits, {CHAT_CACHE_STATS['misses']} calls for {len(data)} items")
 print(f"✅ Regeneration Complete! Saved to {OUTPUT_FILE}")
 print("👉 Now RETRAIN your model using this new file.")
\ No newline at end of file
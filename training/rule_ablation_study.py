@@ -1,16 +1,19 @@
 import sys
 import os
-import json
 import pandas as pd
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 # Add parent to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from optimizer_agent import OptimizerAgent
-from simulator_agent import SimulatorAgent
-from visual_grounding import VisualGroundingScorer
-from verify_optimization import format_rag_context, calculate_visibility_score
+from simulator_agent import SimulatorAgent, GENERATION_MODEL, GENERATION_TEMPERATURE
+from visual_grounding import VisualGroundingScorer, load_image_types
+from verify_optimization import rag_item_parts, fill_rag_item, split_rag_context, calculate_visibility_score
+from llm_cache import LLMCache, make_key
+from ollama_utils import model_digest
+from fast_json import load_json
 
 # --- CONFIGURATION ---
 CANDIDATES_FILE = "data/test_candidates.json"
@@ -19,80 +22,124 @@ VISUALS_FILE = "data/dense_captions.json"
 PRINCIPLES_FILE = "data/mgeo_principles_refined.json"
 OUTPUT_ABLATION = "data/results_ablation.json"
 MODEL_NAME = "geo-optimizer" # We use the expert to test the rules
+# Requests in flight at once (match the server's OLLAMA_NUM_PARALLEL)
+MAX_WORKERS = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
 
-def get_overall_score(vis, vgs):
-    return (vis + vgs) / 2
+# Reuse optimizer / simulator outputs from previous runs (stored in data/llm_cache.sqlite),
+# so a resumed or re-scored study only calls the LLM for unseen (task, rule) pairs.
+# Off by default; keys carry the model's weights digest, so a retrain never replays old rewrites
+CACHE_LLM = False
 
 def run_ablation():
     print(f"\n🔬 PHASE 3: ABLATION STUDY (RULE ISOLATION)...")
     
     # 1. Load Data
-    with open(CANDIDATES_FILE) as f: candidates_map = json.load(f)
-    with open(REPO_FILE) as f: repo = json.load(f)
-    with open(VISUALS_FILE) as f: captions = json.load(f)
-    with open(PRINCIPLES_FILE) as f: all_principles = json.load(f)
+    candidates_map = load_json(CANDIDATES_FILE)
+    repo = load_json(REPO_FILE)
+    repo_index = {q['query']: q for q in repo} # O(1) context lookup per battle
+    captions = load_json(VISUALS_FILE)
+    image_types = load_image_types()
+    all_principles = load_json(PRINCIPLES_FILE)
     rules = all_principles.get('mgeo_principles', [])
 
     # 2. Init Agents
     agent = OptimizerAgent(model_name=MODEL_NAME)
     sim_agent = SimulatorAgent()
     vgs_judge = VisualGroundingScorer()
-    
-    results = []
+    # Digests of the weights behind the tags (None = unknown: that cache stays off)
+    opt_digest = model_digest(MODEL_NAME) if CACHE_LLM else None
+    sim_digest = model_digest(GENERATION_MODEL) if CACHE_LLM else None
+    opt_cache = LLMCache("rule_ablation_optimize") if opt_digest else None
+    sim_cache = LLMCache("rule_ablation_simulator") if sim_digest else None
+
+    def optimize(query, product, visual_desc, single_rule):
+        if opt_cache is None: return agent.optimize_product(query, product, visual_desc, single_rule)
+        key = make_key(MODEL_NAME, opt_digest, query, product, visual_desc, single_rule)
+        opt_res = opt_cache.get(key)
+        if opt_res is None:
+            opt_res = agent.optimize_product(query, product, visual_desc, single_rule)
+            if opt_res: opt_cache.set(key, opt_res) # Failures are retried next run
+        return opt_res
+
+    def simulate(query, rag_ctx):
+        # Identical candidate lists get identical answers (e.g. two rules, same rewrite)
+        if sim_cache is None: return sim_agent.generate_response(query, rag_ctx)
+        key = make_key(GENERATION_MODEL, sim_digest, GENERATION_TEMPERATURE, query, rag_ctx) # The model generate_response really calls
+        gen_text = sim_cache.get(key)
+        if gen_text is None:
+            gen_text = sim_agent.generate_response(query, rag_ctx)
+            if gen_text: sim_cache.set(key, gen_text)
+        return gen_text
     
     tasks = []
     for q, items in candidates_map.items():
         for i in items: tasks.append((q, i))
 
-    for query, product in tqdm(tasks, desc="Isolating Rules"):
+    # Each target's image is encoded once, before the battles start
+    vgs_judge.prewarm_images((
+        (product['item_id'], target.get('main_image_url'))
+        for query, product in tasks if query in repo_index
+        for target in repo_index[query]['results'] if target['item_id'] == product['item_id']
+    ), image_types)
+
+    # Competitors are formatted once per task; each rule only swaps in its target
+    contexts = []
+    for query, product in tasks:
+        query_group = repo_index.get(query)
+        rag_prefix, target_item, rag_suffix = split_rag_context(query_group['results'], product['item_id']) if query_group else ("", None, "")
+        target_parts = rag_item_parts(target_item) if target_item else None
+        contexts.append((query_group, rag_prefix, target_item, rag_suffix, target_parts))
+
+    # Every (task, rule) pair, task-major (same order as the results file)
+    jobs = [(t, r) for t in range(len(tasks)) for r in range(len(rules))]
+
+    # Stage 1: all N*R optimizations, keeping MAX_WORKERS requests in flight
+    def optimize_job(job):
+        t, r = job
+        query, product = tasks[t]
+        return optimize(query, product, captions.get(product['item_id'], ""), [rules[r]]) # Isolate!
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        opt_grid = list(tqdm(ex.map(optimize_job, jobs), total=len(jobs), desc="Isolating Rules"))
+
+    # Stage 2: score every rewrite (simulator + VGS)
+    def score_job(idx):
+        t, r = jobs[idx]
+        opt_res = opt_grid[idx]
+        query, product = tasks[t]
         target_id = product['item_id']
-        visual_desc = captions.get(target_id, "")
-        
-        # Test Each Rule Individually
-        for rule in rules:
-            single_rule = [rule] # Isolate!
+        query_group, rag_prefix, target_item, rag_suffix, target_parts = contexts[t]
+
+        if not opt_res or not query_group:
+            vis, vgs = 0, 0
+        else:
+            image_url = None
+            rag_ctx = rag_prefix + rag_suffix
+            if target_item:
+                rag_ctx = rag_prefix + fill_rag_item(target_parts, opt_res['optimized_title'], opt_res['optimized_features']) + rag_suffix
+                image_url = target_item.get('main_image_url')
             
-            # Optimize
-            opt_res = agent.optimize_product(query, product, visual_desc, single_rule)
+            # Score
+            gen_text = simulate(query, rag_ctx)
+            vis = calculate_visibility_score(gen_text, target_id)
             
-            if not opt_res:
-                vis, vgs, ovr = 0, 0, 0
-            else:
-                # Context
-                query_group = next((q for q in repo if q['query'] == query), None)
-                if not query_group: 
-                    vis, vgs, ovr = 0, 0, 0
-                else:
-                    test_candidates = []
-                    image_url = None
-                    for item in query_group['results']:
-                        if item['item_id'] == target_id:
-                            mod = item.copy()
-                            mod['title'] = opt_res['optimized_title']
-                            mod['features'] = opt_res['optimized_features']
-                            test_candidates.append(mod)
-                            image_url = item.get('main_image_url')
-                        else:
-                            test_candidates.append(item)
-                    
-                    # Score
-                    rag_ctx = format_rag_context(test_candidates)
-                    gen_text = sim_agent.generate_response(query, rag_ctx)
-                    vis = calculate_visibility_score(gen_text, target_id)
-                    
-                    full_text = f"{opt_res['optimized_title']} {opt_res['optimized_features']}"
-                    vgs = vgs_judge.calculate_vgs(target_id, full_text, image_url)
-                    ovr = get_overall_score(vis, vgs)
-
-            results.append({
-                "Rule_Name": rule['rule_name'],
-                "Vis": vis,
-                "VGS": vgs,
-                "Overall": ovr
-            })
+            full_text = f"{opt_res['optimized_title']} {opt_res['optimized_features']}"
+            vgs = vgs_judge.calculate_vgs(target_id, full_text, image_url, image_types.get(target_id))
+
+        # Overall is derived for all rows at once when saving
+        return {
+            "Rule_Name": rules[r]['rule_name'],
+            "Vis": vis,
+            "VGS": vgs
+        }
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        results = list(tqdm(ex.map(score_job, range(len(jobs))), total=len(jobs), desc="Scoring"))
 
     # Save
-    pd.DataFrame(results).to_json(OUTPUT_ABLATION, orient='records', indent=4)
+    df = pd.DataFrame(results, columns=["Rule_Name", "Vis", "VGS"])
+    df["Overall"] = (df["Vis"] + df["VGS"]) / 2
+    df.to_json(OUTPUT_ABLATION, orient='records', indent=4)
     print(f"\n✅ Ablation results saved to {OUTPUT_ABLATION}")
 
 if __name__ == "__main__":
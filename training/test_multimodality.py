@@ -1,16 +1,26 @@
 import sys
 import os
-import json
-import requests
-import pandas as pd
+import csv
 import re
 from tqdm import tqdm
 import time
+from collections import defaultdict
+from functools import lru_cache
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from simulator_agent import SimulatorAgent
-from visual_grounding import VisualGroundingScorer
-from verify_optimization import calculate_visibility_score, format_rag_context
+from visual_grounding import VisualGroundingScorer, load_image_types
+from verify_optimization import rag_item_parts, fill_rag_item, split_rag_context, calculate_visibility_score
+from ollama_utils import SESSION, OLLAMA_HOST, model_digest
+from fast_json import load_json, loads
+from parallel_utils import unordered_map
+from llm_cache import LLMCache, make_key
+
+try:
+    import tiktoken  # Optional: real token counts for the prompt-length check
+    TOKEN_ENCODING = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    TOKEN_ENCODING = None
 
 # --- CONFIG ---
 CANDIDATES_FILE = "data/test_candidates.json"
@@ -18,6 +28,16 @@ REPO_FILE = "data/test_repo.json"
 VISUALS_FILE = "data/dense_captions.json"
 PRINCIPLES_FILE = "data/mgeo_principles_refined.json"
 OUTPUT_FILE = "data/test_modality.csv"
+OUTPUT_FIELDS = ["Model", "ID", "Vis", "VGS", "Overall"]
+# Tasks in flight at once (match the server's OLLAMA_NUM_PARALLEL)
+MAX_WORKERS = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
+# Parsed completions keyed on (model, weights digest, prompt): resumed / re-scored runs skip inference
+# already done. Off by default; the digest keeps a retrained model from getting the old weights' answers
+CACHE_INFERENCE = False
+# Context window requested from Ollama, and how much of it is kept free for the JSON answer
+NUM_CTX = 8192
+OUTPUT_TOKEN_RESERVE = 512
+CHARS_PER_TOKEN = 3  # Conservative estimate, used when tiktoken is not installed
 
 # --- 1. LOAD RULES ---
 AUTOGEO_RULES = """
@@ -32,8 +52,7 @@ AUTOGEO_RULES = """
 """
 
 try:
-    with open(PRINCIPLES_FILE, 'r') as f:
-        mgeo_data = json.load(f)
+    mgeo_data = load_json(PRINCIPLES_FILE)
     mgeo_list = mgeo_data.get('mgeo_principles', [])
     MGEO_RULES_TEXT = "Apply the following Visual Grounding Principles:\n"
     for i, rule in enumerate(mgeo_list):
@@ -58,91 +77,119 @@ MODELS = {
     }
 }
 
+# Everything that is the same for every task lives in the system message, so the server's
+# prompt (KV) cache reuses it across requests; the user turn only carries the task's data.
+STATIC_INSTRUCTIONS = """
+### CRITICAL CONSTRAINTS
+1. **FORMATTING:** Maintain the original feature format (Pipe-separated |).
+2. **NO FLUFF:** Do not use marketing decorators like "Perfect for you" or "Best choice".
+3. **ACCURACY:** Do not hallucinate features not supported by the input data.
+
+### OUTPUT FORMAT (JSON ONLY, STRICTLY DONT OUTPUT ANYTHING ELSE)
+{
+    "optimized_title": "...",
+    "optimized_features": "..."
+}
+"""
+for config in MODELS.values():
+    config['system_prompt'] = f"{config['system_role']}\n\n### OPTIMIZATION RULES\n{config['rules']}{STATIC_INSTRUCTIONS}"
+
+INFERENCE_CACHE = LLMCache("test_multimodality_inference") if CACHE_INFERENCE else None
+
 # --- 3. THE UNBREAKABLE PARSER ---
+# Both keys located in one pass: group 1 = raw title, group 2 = raw features (to the end)
+OUTPUT_FIELDS_RE = re.compile(r'"optimized_title":(.*?)"optimized_features":(.*)', re.DOTALL)
+
 def parse_output(text):
     text = text.strip()
     
-    # Method 1: Try Standard JSON (Best Case)
-    try:
-        return json.loads(text)
-    except:
-        pass
+    # Method 1: Try Standard JSON (Best Case) - only if it can be JSON at all, so chatty
+    # replies skip the exception path entirely
+    if text[:1] in ('{', '['):
+        try:
+            return loads(text)
+        except ValueError:
+            pass
 
     # Method 2: The "Text Slicer" (Ignores Syntax Errors)
     # We look for the keys in the text and slice everything in between.
-    try:
-        # Find the markers
-        title_key = '"optimized_title":'
-        feat_key = '"optimized_features":'
+    match = OUTPUT_FIELDS_RE.search(text)
+    if match:
+        # Extract Title: Everything between title_key and feat_key
+        # We strip the leading quote (") and the trailing comma-quote (",)
+        raw_title = match.group(1).strip()
+        # Clean up edges
+        if raw_title.startswith('"'): raw_title = raw_title[1:]
+        if raw_title.endswith(','): raw_title = raw_title[:-1]
+        if raw_title.endswith('"'): raw_title = raw_title[:-1]
         
-        idx_title = text.find(title_key)
-        idx_feat = text.find(feat_key)
+        # Extract Features: Everything after feat_key until the last closing brace
+        raw_feat = match.group(2).strip()
+        last_brace = raw_feat.rfind('}')
+        if last_brace != -1:
+            raw_feat = raw_feat[:last_brace]
         
-        if idx_title != -1 and idx_feat != -1:
-            # Extract Title: Everything between title_key and feat_key
-            # We strip the leading quote (") and the trailing comma-quote (",)
-            raw_title = text[idx_title + len(title_key): idx_feat].strip()
-            # Clean up edges
-            if raw_title.startswith('"'): raw_title = raw_title[1:]
-            if raw_title.endswith(','): raw_title = raw_title[:-1]
-            if raw_title.endswith('"'): raw_title = raw_title[:-1]
-            
-            # Extract Features: Everything after feat_key until the end
-            raw_feat = text[idx_feat + len(feat_key):].strip()
-            # Find the last closing brace to stop safely
-            last_brace = raw_feat.rfind('}')
-            if last_brace != -1:
-                raw_feat = raw_feat[:last_brace]
-            
-            # Clean up edges
-            if raw_feat.startswith('"'): raw_feat = raw_feat[1:]
-            if raw_feat.endswith('"'): raw_feat = raw_feat[:-1]
-            
-            # Unescape generic JSON escapes if present
-            return {
-                "optimized_title": raw_title.replace('\\"', '"'),
-                "optimized_features": raw_feat.replace('\\"', '"')
-            }
-    except:
-        pass
+        # Clean up edges
+        if raw_feat.startswith('"'): raw_feat = raw_feat[1:]
+        if raw_feat.endswith('"'): raw_feat = raw_feat[:-1]
+        
+        # Unescape generic JSON escapes if present
+        return {
+            "optimized_title": raw_title.replace('\\"', '"'),
+            "optimized_features": raw_feat.replace('\\"', '"')
+        }
 
     return None
 
+def count_tokens(text):
+    if TOKEN_ENCODING is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(TOKEN_ENCODING.encode(text))
+
+def fit_features(features, other_tokens):
+    """
+    Truncates the features so the whole prompt fits NUM_CTX with room for the answer.
+    Ollama would otherwise silently cut the prompt and the reply comes back broken.
+    """
+    budget = NUM_CTX - OUTPUT_TOKEN_RESERVE - other_tokens
+    if count_tokens(features) <= budget:
+        return features
+    budget = max(budget, 0)
+    if TOKEN_ENCODING is None:
+        return features[:budget * CHARS_PER_TOKEN]
+    return TOKEN_ENCODING.decode(TOKEN_ENCODING.encode(features)[:budget])
+
 def run_inference(config, query, product, visual_desc):
     # Construct Prompt - RESTORED SYSTEM/USER SPLIT
     visual_context = f"Visual Context: {visual_desc}\n" if config['use_visuals'] else "Visual Context: N/A (Text-Only Mode)\n"
     
-    # System Message: Identity + High Level Goal
-    sys_msg = config['system_role']
+    # System Message: Identity + Rules + Constraints + Output Format (static, prefix-cached)
+    sys_msg = config['system_prompt']
     
-    # User Message: Data + Rules + Constraints
-    user_msg = f"""
+    # User Message: this task's data only
+    user_head = f"""
 ### INPUT DATA
 1. **Target Query:** "{query}"
 2. **{visual_context}**
 3. **Current Content:**
    - Title: {product['title']}
-   - Features: {product['features']}
-
-### OPTIMIZATION RULES
-{config['rules']}
+   - Features: """
+    # Long feature lists are the only unbounded part: trim them to fit the context
+    features = fit_features(str(product['features']), count_tokens(sys_msg) + count_tokens(user_head))
+    user_msg = f"{user_head}{features}\n"
+    cache_key = None
+    digest = model_digest(config['model']) if INFERENCE_CACHE is not None else None
+    if digest: # Unknown digest: no caching for this model
+        cache_key = make_key(config['model'], digest, sys_msg, user_msg)
+        cached = INFERENCE_CACHE.get(cache_key)
+        if cached: return cached
 
-### CRITICAL CONSTRAINTS
-1. **FORMATTING:** Maintain the original feature format (Pipe-separated |).
-2. **NO FLUFF:** Do not use marketing decorators like "Perfect for you" or "Best choice".
-3. **ACCURACY:** Do not hallucinate features not supported by the input data.
-
-### OUTPUT FORMAT (JSON ONLY, STRICTLY DONT OUTPUT ANYTHING ELSE)
-{{
-    "optimized_title": "...",
-    "optimized_features": "..."
-}}
-"""
     retries = 3
     for attempt in range(retries):
         try:
-            resp = requests.post(
-                "http://localhost:11434/api/chat",
+            # Shared keep-alive pool: concurrent tasks reuse connections
+            resp = SESSION.post(
+                f"{OLLAMA_HOST}/api/chat",
                 json={
                     "model": config['model'],
                     "messages": [
@@ -152,15 +199,17 @@ def run_inference(config, query, product, visual_desc):
                     "stream": False,
                     "options": {
                         "temperature": 0.1,
-                        "num_ctx": 8192
+                        "num_ctx": NUM_CTX
                     }
-                }
+                },
+                timeout=300
             )
             if resp.status_code == 200:
                 raw_content = resp.json()['message']['content']
                 res = parse_output(raw_content)
                 if res: 
                     print(res)
+                    if cache_key: INFERENCE_CACHE.set(cache_key, res)
                     return res
                 else:
                     # DEBUG: PRINT FAILURE
@@ -178,27 +227,46 @@ def run_inference(config, query, product, visual_desc):
 def main():
     print("🏆 STARTING FINAL BENCHMARK (RESUME MODE)")
     
-    with open(CANDIDATES_FILE) as f: candidates_map = json.load(f)
-    with open(REPO_FILE) as f: repo = json.load(f)
-    with open(VISUALS_FILE) as f: captions = json.load(f)
+    candidates_map = load_json(CANDIDATES_FILE)
+    repo = load_json(REPO_FILE)
+    results_by_query = {x['query']: x['results'] for x in repo}
+
+    # Competitors formatted once per (query, target): both contenders only swap in their target
+    @lru_cache(maxsize=4096)
+    def rag_template(q, item_id):
+        """(prefix, target parts or None, suffix, target image url) for one query/target pair."""
+        rag_prefix, target_item, rag_suffix = split_rag_context(results_by_query[q], item_id)
+        if target_item is None:
+            return rag_prefix, None, rag_suffix, None
+        return rag_prefix, rag_item_parts(target_item), rag_suffix, target_item.get('main_image_url')
+    captions = load_json(VISUALS_FILE)
+    image_types = load_image_types()
     
     sim_agent = SimulatorAgent()
     vgs_judge = VisualGroundingScorer()
 
     # --- RESUME LOGIC ---
     done_ids_map = {k: set() for k in MODELS.keys()}
+    fresh = True
     if os.path.exists(OUTPUT_FILE):
         print(f"   📂 Found existing {OUTPUT_FILE}. Resuming...")
         try:
-            existing_df = pd.read_csv(OUTPUT_FILE)
+            # Only the Model / ID columns are needed: stream the rows instead of building a DataFrame
+            with open(OUTPUT_FILE, newline='') as f:
+                for row in csv.DictReader(f):
+                    # A row cut short by an interrupted run has missing trailing fields: not done
+                    if row.get('Overall') is not None and row['Model'] in done_ids_map:
+                        done_ids_map[row['Model']].add(row['ID'])
             for model_key in MODELS.keys():
-                done_ids_map[model_key] = set(existing_df[existing_df['Model'] == model_key]['ID'].unique())
                 print(f"      - {model_key}: {len(done_ids_map[model_key])} completed.")
+            fresh = False
         except Exception as e:
             print(f"   ⚠️ Could not read CSV ({e}). Starting fresh.")
-            pd.DataFrame(columns=["Model", "ID", "Vis", "VGS", "Overall"]).to_csv(OUTPUT_FILE, index=False)
-    else:
-        pd.DataFrame(columns=["Model", "ID", "Vis", "VGS", "Overall"]).to_csv(OUTPUT_FILE, index=False)
+
+    # One handle for the whole run: rows are appended as jobs finish
+    out_fh = open(OUTPUT_FILE, 'w' if fresh else 'a', newline='')
+    writer = csv.DictWriter(out_fh, fieldnames=OUTPUT_FIELDS)
+    if fresh: writer.writeheader()
 
     tasks = []
     for q, items in candidates_map.items():
@@ -206,62 +274,71 @@ def main():
     
     print(f"   Total Test Cases: {len(tasks)}")
 
+    # Both contenders interleaved task by task, so the server always has work for each model
+    # (serve with OLLAMA_MAX_LOADED_MODELS=2 to keep both resident instead of swapping)
+    all_jobs = []
     for model_key, config in MODELS.items():
-        print(f"\n🥊 Contender: {model_key}")
+        remaining = sum(prod['item_id'] not in done_ids_map[model_key] for _, prod in tasks)
+        print(f"   🥊 {model_key}: {remaining} remaining tasks" if remaining else f"   ✅ {model_key}: all tasks completed.")
+    for q, prod in tasks:
+        for model_key, config in MODELS.items():
+            if prod['item_id'] not in done_ids_map[model_key]:
+                all_jobs.append((model_key, config, q, prod))
+
+    # Each target's image is encoded once, before the workers start (both contenders share it)
+    vgs_judge.prewarm_images((
+        (prod['item_id'], rag_template(q, prod['item_id'])[3])
+        for _, _, q, prod in all_jobs if q in results_by_query
+    ), image_types)
+
+    def process_task(model_key, config, q, prod):
+        vis_input = captions.get(prod['item_id'], "") if config['use_visuals'] else None
         
-        scores_vis, scores_vgs, scores_ovr = [], [], []
+        res = run_inference(config, q, prod, vis_input)
         
-        # Filter tasks for this model
-        model_tasks = [t for t in tasks if t[1]['item_id'] not in done_ids_map[model_key]]
-        if not model_tasks:
-            print("   ✅ All tasks completed for this model.")
-            continue
-            
-        print(f"   Running {len(model_tasks)} remaining tasks...")
-
-        for i, (q, prod) in enumerate(tqdm(model_tasks, desc=model_key)):
-            vis_input = captions.get(prod['item_id'], "") if config['use_visuals'] else None
-            
-            res = run_inference(config, q, prod, vis_input)
-            
-            vis, vgs, ovr = 0, 0, 0
+        vis, vgs, ovr = 0, 0, 0
+        
+        if res and q in results_by_query:
+            # Simulation: only the target is re-formatted, competitors come from the template
+            rag_prefix, target_parts, rag_suffix, img_url = rag_template(q, prod['item_id'])
+            rag_ctx = rag_prefix + rag_suffix
+            if target_parts:
+                rag_ctx = rag_prefix + fill_rag_item(
+                    target_parts,
+                    res.get('optimized_title', prod['title']),
+                    res.get('optimized_features', prod['features'])
+                ) + rag_suffix
             
-            if res:
-                # Simulation
-                q_group = next((x for x in repo if x['query'] == q), None)
-                candidates = []
-                img_url = None
-                for item in q_group['results']:
-                    if item['item_id'] == prod['item_id']:
-                        mod = item.copy()
-                        mod['title'] = res.get('optimized_title', prod['title'])
-                        mod['features'] = res.get('optimized_features', prod['features'])
-                        candidates.append(mod)
-                        img_url = item.get('main_image_url')
-                    else:
-                        candidates.append(item)
-                
-                gen = sim_agent.generate_response(q, format_rag_context(candidates))
-                vis = calculate_visibility_score(gen, prod['item_id'])
-                
-                # Judging
-                full_txt = f"{res.get('optimized_title','')} {res.get('optimized_features','')}"
-                vgs = vgs_judge.calculate_vgs(prod['item_id'], full_txt, img_url)
-                
-                ovr = (vis + vgs) / 2
+            gen = sim_agent.generate_response(q, rag_ctx)
+            vis = calculate_visibility_score(gen, prod['item_id'])
             
-            scores_vis.append(vis)
-            scores_vgs.append(vgs)
-            scores_ovr.append(ovr)
+            # Judging
+            full_txt = f"{res.get('optimized_title','')} {res.get('optimized_features','')}"
+            vgs = vgs_judge.calculate_vgs(prod['item_id'], full_txt, img_url, image_types.get(prod['item_id']))
             
-            # Append only new rows
-            new_row = {"Model": model_key, "ID": prod['item_id'], "Vis": vis, "VGS": vgs, "Overall": ovr}
-            pd.DataFrame([new_row]).to_csv(OUTPUT_FILE, mode='a', header=False, index=False)
+            ovr = (vis + vgs) / 2
         
-        avg_vis = sum(scores_vis)/len(scores_vis) if scores_vis else 0
-        avg_vgs = sum(scores_vgs)/len(scores_vgs) if scores_vgs else 0
-        avg_ovr = sum(scores_ovr)/len(scores_ovr) if scores_ovr else 0
-        print(f"\n   📊 Round Results -> Vis: {avg_vis:.3f} | VGS: {avg_vgs:.3f} | Overall: {avg_ovr:.3f}")
+        return {"Model": model_key, "ID": prod['item_id'], "Vis": vis, "VGS": vgs, "Overall": ovr}
+
+    # Per-model score lists, regrouped from the interleaved stream
+    scores = defaultdict(list)
+
+    # Jobs are independent: MAX_WORKERS in flight, and only a small window of them
+    # submitted at a time (the server queues anything past OLLAMA_NUM_PARALLEL anyway)
+    try:
+        for new_row in tqdm(unordered_map(lambda job: process_task(*job), all_jobs, MAX_WORKERS),
+                            total=len(all_jobs), desc="Benchmark"):
+            scores[new_row["Model"]].append((new_row["Vis"], new_row["VGS"], new_row["Overall"]))
+            
+            # Append only new rows (from this thread only, so no lock needed)
+            writer.writerow(new_row)
+            out_fh.flush()
+    finally:
+        out_fh.close()
+
+    for model_key, rows in scores.items():
+        avg_vis, avg_vgs, avg_ovr = (sum(col) / len(col) for col in zip(*rows))
+        print(f"\n   📊 {model_key} Round Results -> Vis: {avg_vis:.3f} | VGS: {avg_vgs:.3f} | Overall: {avg_ovr:.3f}")
 
     print(f"\n✅ Final Benchmark Complete. Results in {OUTPUT_FILE}")
 
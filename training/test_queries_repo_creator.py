@@ -9,6 +9,7 @@ from tqdm import tqdm
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from search_engine import LocalSearchEngine
 from synthetic_reviews import SocialProofGenerator
+from fast_json import dump_json
 
 # --- CONFIGURATION ---
 DATA_FILE = "data/amazon_dataset.csv"           # The Source of Truth
@@ -70,10 +71,18 @@ def main():
         results_list = []
         
         # B. ENRICH (Add Reviews & Metadata)
-        for i, (_, row) in enumerate(results_df.iterrows()):
-            origin_data = parse_json_col(row.get('origin'))
-            specs_data = parse_json_col(row.get('other_attributes'))
-            stars, reviews = proof_gen.generate()
+        # JSON columns parsed column-wise, rows as plain dicts, social proof drawn in one batch
+        n_results = len(results_df)
+        origins, specs = (
+            results_df[col].map(parse_json_col).tolist() if col in results_df else [None] * n_results
+            for col in ('origin', 'other_attributes')
+        )
+        social_proof = proof_gen.generate_batch(n_results)
+        
+        for i, row in enumerate(results_df.to_dict('records')):
+            origin_data = origins[i]
+            specs_data = specs[i]
+            stars, reviews = social_proof[i]
             
             item_data = {
                 "rank": i + 1,
@@ -132,11 +141,8 @@ def main():
         test_candidates[query] = candidates_list
         
     # D. SAVE FILES
-    with open(OUTPUT_REPO, 'w') as f:
-        json.dump(test_repo, f, indent=4)
-        
-    with open(OUTPUT_CANDIDATES, 'w') as f:
-        json.dump(test_candidates, f, indent=4)
+    dump_json(test_repo, OUTPUT_REPO)
+    dump_json(test_candidates, OUTPUT_CANDIDATES)
         
     total_subjects = sum(len(x) for x in test_candidates.values())
     print(f"\n✅ Test Suite Created!")
@@ -4,33 +4,56 @@ from trl import SFTTrainer
 from transformers import TrainingArguments
 from datasets import Dataset
 import json
+import math
+import os
 
 # --- CONFIGURATION ---
 DATASET_FILE = "data/rl_finetuning_dataset.json"
 OUTPUT_DIR = "fine_tuned_optimizer"
 BASE_MODEL = "unsloth/llama-3-8b-Instruct-bnb-4bit" # 4-bit loading fits easily on A100
 MAX_SEQ_LENGTH = 2048
+NUM_PROC = os.cpu_count() # Workers for dataset formatting / tokenization
+# Effective batch of 8 in one microbatch: 4-bit 8B + LoRA leaves plenty of A100 memory
+BATCH_SIZE = 8
+GRAD_ACCUM_STEPS = 1
+# Training budget: the original unpacked recipe (60 steps x 8 examples). With packing a step holds
+# BATCH_SIZE full MAX_SEQ_LENGTH rows, so max_steps is derived from this many examples' tokens
+RECIPE_EXAMPLES = 60 * 8
+# Attention query/value projections only: ~3x fewer trainable params than all seven linears,
+# plenty for a 60-step SFT (add "k_proj", "o_proj", "gate_proj", "up_proj", "down_proj" for full coverage)
+LORA_TARGET_MODULES = ["q_proj", "v_proj"]
+
+# Llama-3 Chat Format, filled per example by format_prompt
+PROMPT_TEMPLATE = """<|start_header_id|>system<|end_header_id|>
+You are an Elite Generative Engine Optimization (GEO) Specialist.
+Your goal is to Rewrite a product's content to maximize its ranking in a Generative Search Engine.
+{instruction}
+<|eot_id|>
+<|start_header_id|>user<|end_header_id|>{input}<|eot_id|>
+<|start_header_id|>assistant<|end_header_id|>{output}<|eot_id|>"""
 
 def format_prompt(examples):
     """
     Formats the data into the Llama-3 Chat Format.
     """
-    instructions = examples["instruction"]
-    inputs = examples["input"]
-    outputs = examples["output"]
-    texts = []
-    for instr, inp, out in zip(instructions, inputs, outputs):
-        # Construct the conversation
-        text = f"""<|start_header_id|>system<|end_header_id|>
-You are an Elite Generative Engine Optimization (GEO) Specialist.
-Your goal is to Rewrite a product's content to maximize its ranking in a Generative Search Engine.
-{instr}
-<|eot_id|>
-<|start_header_id|>user<|end_header_id|>{inp}<|eot_id|>
-<|start_header_id|>assistant<|end_header_id|>{out}<|eot_id|>"""
-        texts.append(text)
+    texts = [
+        PROMPT_TEMPLATE.format(instruction=instr, input=inp, output=out)
+        for instr, inp, out in zip(examples["instruction"], examples["input"], examples["output"])
+    ]
     return {"text": texts}
 
+def packed_max_steps(dataset, tokenizer):
+    """
+    Steps that feed the packed trainer as many tokens as RECIPE_EXAMPLES average examples,
+    so packing changes the throughput, not how many epochs the model sees.
+    """
+    lengths = dataset.map(
+        lambda batch: {"n_tokens": [min(len(ids), MAX_SEQ_LENGTH) for ids in tokenizer(batch["text"])["input_ids"]]},
+        batched = True, num_proc = NUM_PROC,
+    )["n_tokens"]
+    budget = RECIPE_EXAMPLES * sum(lengths) / len(lengths)
+    return max(1, math.ceil(budget / (BATCH_SIZE * GRAD_ACCUM_STEPS * MAX_SEQ_LENGTH)))
+
 def main():
     print(f"🚀 Loading Model: {BASE_MODEL}...")
     model, tokenizer = FastLanguageModel.from_pretrained(
@@ -44,7 +67,7 @@ def main():
     model = FastLanguageModel.get_peft_model(
         model,
         r = 16, # Rank
-        target_modules = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"],
+        target_modules = LORA_TARGET_MODULES,
         lora_alpha = 16,
         lora_dropout = 0,
         bias = "none",
@@ -58,24 +81,27 @@ def main():
     
     # Convert JSON list to HuggingFace Dataset
     hf_dataset = Dataset.from_list(data)
-    dataset = hf_dataset.map(format_prompt, batched = True)
+    dataset = hf_dataset.map(format_prompt, batched = True, num_proc = NUM_PROC)
 
     print(f"   Training on {len(dataset)} examples...")
 
     # 3. Setup Trainer
+    max_steps = packed_max_steps(dataset, tokenizer)
+    print(f"   {max_steps} packed steps (token budget of {RECIPE_EXAMPLES} examples)")
+
     trainer = SFTTrainer(
         model = model,
         tokenizer = tokenizer,
         train_dataset = dataset,
         dataset_text_field = "text",
         max_seq_length = MAX_SEQ_LENGTH,
-        dataset_num_proc = 2,
-        packing = False, # Can speed up training for short sequences
+        dataset_num_proc = NUM_PROC,
+        packing = True, # Short examples are concatenated up to MAX_SEQ_LENGTH instead of padded
         args = TrainingArguments(
-            per_device_train_batch_size = 2,
-            gradient_accumulation_steps = 4,
+            per_device_train_batch_size = BATCH_SIZE,
+            gradient_accumulation_steps = GRAD_ACCUM_STEPS,
             warmup_steps = 5,
-            max_steps = 60, # Small dataset = fewer steps needed
+            max_steps = max_steps, # Small dataset = fewer steps needed
             learning_rate = 2e-4,
             fp16 = not torch.cuda.is_bf16_supported(),
             bf16 = torch.cuda.is_bf16_supported(),
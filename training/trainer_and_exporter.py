@@ -1,5 +1,8 @@
 import os
 import json
+import math
+import argparse
+import subprocess
 import torch
 from unsloth import FastLanguageModel
 from unsloth.chat_templates import get_chat_template
@@ -11,6 +14,50 @@ from datasets import Dataset
 DATASET_FILE = "data/rl_finetuning_dataset.json"
 OUTPUT_DIR = "geo_v2_clean"  # New directory to avoid caching issues
 MAX_SEQ_LENGTH = 2048
+BASE_GGUF = "llama-3-8b-instruct.Q4_K_M.gguf"  # Quantized base the adapter is applied to (same as ./Modelfile)
+OLLAMA_MODEL = "geo-optimizer"
+NUM_PROC = os.cpu_count() # Workers for dataset formatting / tokenization
+# Effective batch of 8 in one microbatch: 4-bit 8B + LoRA leaves plenty of A100 memory
+BATCH_SIZE = 8
+GRAD_ACCUM_STEPS = 1
+# Training budget: the original unpacked recipe (60 steps x 8 examples). With packing a step holds
+# BATCH_SIZE full MAX_SEQ_LENGTH rows, so max_steps is derived from this many examples' tokens
+RECIPE_EXAMPLES = 60 * 8
+# Attention query/value projections only: ~3x fewer trainable params than all seven linears,
+# plenty for a 60-step SFT (add "k_proj", "o_proj", "gate_proj", "up_proj", "down_proj" for full coverage)
+LORA_TARGET_MODULES = ["q_proj", "v_proj"]
+
+# Ollama Modelfile body for adapter exports (template / parameters as in ./Modelfile);
+# the FROM / ADAPTER lines are prepended at export time
+MODELFILE_BODY = '''SYSTEM """
+You are an Elite Generative Engine Optimization (GEO) Specialist.
+Your goal is to Rewrite a product's content to maximize its ranking in a Generative Search Engine.
+"""
+
+TEMPLATE """{{ if .System }}<|start_header_id|>system<|end_header_id|>
+
+{{ .System }}<|eot_id|>{{ end }}{{ if .Prompt }}<|start_header_id|>user<|end_header_id|>
+
+{{ .Prompt }}<|eot_id|>{{ end }}<|start_header_id|>assistant<|end_header_id|>
+
+{{ .Response }}<|eot_id|>"""
+PARAMETER num_keep 24
+PARAMETER stop "<|start_header_id|>"
+PARAMETER stop "<|end_header_id|>"
+PARAMETER stop "<|eot_id|>"
+PARAMETER temperature 0.2
+PARAMETER min_p 0.1
+'''
+
+# Llama-3 Chat Format, filled per example by format_prompt_clean
+PROMPT_TEMPLATE = """<|start_header_id|>system<|end_header_id|>
+
+You are an Elite Generative Engine Optimization (GEO) Specialist.
+Your goal is to Rewrite a product's content to maximize its ranking in a Generative Search Engine.{instruction}<|eot_id|><|start_header_id|>user<|end_header_id|>
+
+{input}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+
+{output}<|eot_id|>"""
 
 def format_prompt_clean(examples):
     """
@@ -18,23 +65,29 @@ def format_prompt_clean(examples):
     NO <|begin_of_text|> (Tokenizer adds it).
     NO Double Newlines (Clean structure).
     """
-    instructions = examples["instruction"]
-    inputs = examples["input"]
-    outputs = examples["output"]
-    texts = []
-    for instr, inp, out in zip(instructions, inputs, outputs):
-        text = f"""<|start_header_id|>system<|end_header_id|>
-
-You are an Elite Generative Engine Optimization (GEO) Specialist.
-Your goal is to Rewrite a product's content to maximize its ranking in a Generative Search Engine.{instr}<|eot_id|><|start_header_id|>user<|end_header_id|>
-
-{inp}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
-
-{out}<|eot_id|>"""
-        texts.append(text)
+    texts = [
+        PROMPT_TEMPLATE.format(instruction=instr, input=inp, output=out)
+        for instr, inp, out in zip(examples["instruction"], examples["input"], examples["output"])
+    ]
     return {"text": texts}
 
+def packed_max_steps(dataset, tokenizer):
+    """
+    Steps that feed the packed trainer as many tokens as RECIPE_EXAMPLES average examples,
+    so packing changes the throughput, not how many epochs the model sees.
+    """
+    lengths = dataset.map(
+        lambda batch: {"n_tokens": [min(len(ids), MAX_SEQ_LENGTH) for ids in tokenizer(batch["text"])["input_ids"]]},
+        batched = True, num_proc = NUM_PROC,
+    )["n_tokens"]
+    budget = RECIPE_EXAMPLES * sum(lengths) / len(lengths)
+    return max(1, math.ceil(budget / (BATCH_SIZE * GRAD_ACCUM_STEPS * MAX_SEQ_LENGTH)))
+
 def main():
+    parser = argparse.ArgumentParser(description="Fine-tune the GEO optimizer and export it to Ollama.")
+    parser.add_argument("--release", action="store_true", help="Export a full q4_k_m GGUF instead of a LoRA adapter")
+    args = parser.parse_args()
+
     print("🚀 STEP 1: Loading Base Model...")
     model, tokenizer = FastLanguageModel.from_pretrained(
         model_name = "unsloth/llama-3-8b-Instruct-bnb-4bit",
@@ -46,30 +99,33 @@ def main():
     # Add LoRA
     model = FastLanguageModel.get_peft_model(
         model,
-        r = 16, target_modules = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"],
+        r = 16, target_modules = LORA_TARGET_MODULES,
         lora_alpha = 16, lora_dropout = 0, bias = "none",
         use_gradient_checkpointing = True, random_state = 3407,
     )
 
     print("🚀 STEP 2: Preparing Data (Clean Format)...")
     with open(DATASET_FILE) as f: data = json.load(f)
-    dataset = Dataset.from_list(data).map(format_prompt_clean, batched = True)
+    dataset = Dataset.from_list(data).map(format_prompt_clean, batched = True, num_proc = NUM_PROC)
 
     print(f"   Training on {len(dataset)} examples...")
     
+    max_steps = packed_max_steps(dataset, tokenizer)
+    print(f"   {max_steps} packed steps (token budget of {RECIPE_EXAMPLES} examples)")
+
     trainer = SFTTrainer(
         model = model,
         tokenizer = tokenizer,
         train_dataset = dataset,
         dataset_text_field = "text",
         max_seq_length = MAX_SEQ_LENGTH,
-        dataset_num_proc = 2,
-        packing = False,
+        dataset_num_proc = NUM_PROC,
+        packing = True, # Short examples are concatenated up to MAX_SEQ_LENGTH instead of padded
         args = TrainingArguments(
-            per_device_train_batch_size = 2,
-            gradient_accumulation_steps = 4,
+            per_device_train_batch_size = BATCH_SIZE,
+            gradient_accumulation_steps = GRAD_ACCUM_STEPS,
             warmup_steps = 5,
-            max_steps = 60, # Quick retrain
+            max_steps = max_steps, # Quick retrain
             learning_rate = 2e-4,
             fp16 = not torch.cuda.is_bf16_supported(),
             bf16 = torch.cuda.is_bf16_supported(),
@@ -93,11 +149,23 @@ def main():
         mapping = {"role": "from", "content": "value", "user": "human", "assistant": "gpt"},
     )
     
-    # Save GGUF directly
-    # Note: This will create 'geo_v2_clean/unsloth.Q4_K_M.gguf'
-    model.save_pretrained_gguf(OUTPUT_DIR, tokenizer, quantization_method = "q4_k_m")
+    if args.release:
+        # Save GGUF directly (full merge + q4_k_m quantization: slow, release builds only)
+        # Note: This will create 'geo_v2_clean/unsloth.Q4_K_M.gguf'
+        model.save_pretrained_gguf(OUTPUT_DIR, tokenizer, quantization_method = "q4_k_m")
+        print(f"✅ DONE! New model is in: {OUTPUT_DIR}")
+        return
+
+    # Iteration: save only the LoRA adapter and layer it on the already-quantized base in Ollama
+    model.save_pretrained(OUTPUT_DIR)
+    tokenizer.save_pretrained(OUTPUT_DIR)
+    
+    modelfile_path = os.path.join(OUTPUT_DIR, "Modelfile")
+    with open(modelfile_path, "w") as f:
+        f.write(f"FROM {os.path.abspath(BASE_GGUF)}\nADAPTER {os.path.abspath(OUTPUT_DIR)}\n" + MODELFILE_BODY)
+    subprocess.run(["ollama", "create", OLLAMA_MODEL, "-f", modelfile_path], check=True)
     
-    print(f"✅ DONE! New model is in: {OUTPUT_DIR}")
+    print(f"✅ DONE! Adapter is in: {OUTPUT_DIR} (Ollama model '{OLLAMA_MODEL}'; use --release for a full GGUF)")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
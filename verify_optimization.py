@@ -1,10 +1,12 @@
-import json
 import os
 import argparse
 import math
+import bisect
+from contextlib import closing
 import re
 from simulator_agent import SimulatorAgent
-from visual_grounding import VisualGroundingScorer
+from visual_grounding import VisualGroundingScorer, load_image_types
+from fast_json import load_json, dump_json, iter_json_array
 # --- CONFIGURATION ---
 REPO_FILE = "data/query.json"
 OPTIMIZED_FILE = "data/optimized_product.json"
@@ -14,51 +16,126 @@ OUTPUT_VERIFICATION = "data/verification_result.json"
 # 1.0 means a 10% hallucination error cancels out a 0.1 gain in visibility.
 LAMBDA_PENALTY = 0.5
 
-def format_rag_context(results_list):
+# Sentence boundaries for the visibility score (compiled once, it runs for every candidate)
+SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?]) +')
+
+def rag_item_parts(item):
     """
-    Standard formatting for the Simulator.
+    Static parts of a candidate block, around its Title and Features values:
+    block = head + title + middle + features + tail.
     """
-    context_str = ""
-    for item in results_list:
-        origin_str = "Unknown"
-        if isinstance(item.get('origin'), dict):
-            origin_str = item['origin'].get('domain_name', 'Unknown')
+    origin_str = "Unknown"
+    if isinstance(item.get('origin'), dict):
+        origin_str = item['origin'].get('domain_name', 'Unknown')
+    
+    rating = item.get('sim_rating', item.get('rating', 0))
+    reviews = item.get('sim_reviews', item.get('reviews', 0))
+    social_proof = f"Rating: {rating}/5.0 ({reviews} verified reviews)"
         
-        rating = item.get('sim_rating', item.get('rating', 0))
-        reviews = item.get('sim_reviews', item.get('reviews', 0))
-        social_proof = f"Rating: {rating}/5.0 ({reviews} verified reviews)"
-            
-        context_str += f"""
-[Source ID: {item['item_id']}]
-Category: {item['category']}
-Title: {item['title']}
-Brand/Domain: {origin_str}
-{social_proof}
-Features: {str(item['features'])}
---------------------------------------------------
-"""
-    return context_str
+    head = f"\n[Source ID: {item['item_id']}]\nCategory: {item['category']}\nTitle: "
+    middle = f"\nBrand/Domain: {origin_str}\n{social_proof}\nFeatures: "
+    tail = "\n--------------------------------------------------\n"
+    return head, middle, tail
+
+def fill_rag_item(parts, title, features):
+    """Formats a candidate block from precomputed rag_item_parts (the cheap hot swap)."""
+    head, middle, tail = parts
+    return f"{head}{title}{middle}{features}{tail}"
+
+def format_rag_item(item, override=None):
+    """
+    Formats a single candidate block for the Simulator.
+    override: {'title': ..., 'features': ...} swapped in without copying the item.
+    """
+    override = override or {}
+    return fill_rag_item(rag_item_parts(item), override.get('title', item['title']), override.get('features', item['features']))
+
+# id(results_list) -> (results_list, its formatted blocks). Query groups are loaded once and
+# re-scored many times with only the target swapped, so untouched blocks are formatted once;
+# the list itself is kept so its id is never reused while cached.
+_rag_blocks_cache = {}
+
+def rag_blocks(results_list):
+    """Formatted block of every candidate in results_list (cached per list)."""
+    cached = _rag_blocks_cache.get(id(results_list))
+    if cached is None or len(cached[1]) != len(results_list):
+        cached = (results_list, [format_rag_item(item) for item in results_list])
+        _rag_blocks_cache[id(results_list)] = cached
+    return cached[1]
+
+def format_rag_context(results_list, overrides=None):
+    """
+    Standard formatting for the Simulator.
+    overrides: {index: {'title': ..., 'features': ...}} swaps fields for the
+    item at that index without copying it (the optimization "hot swap").
+    """
+    blocks = rag_blocks(results_list)
+    if not overrides:
+        return "".join(blocks)
+    blocks = list(blocks)
+    for i, override in overrides.items():
+        blocks[i] = format_rag_item(results_list[i], override)
+    return "".join(blocks)
+
+def split_rag_context(results_list, target_id):
+    """
+    Pre-formats every candidate except the target, for callers that hot-swap the
+    same target several times (e.g. baseline vs trained).
+    Returns (prefix, target_item, suffix); the context for a swap is
+    prefix + format_rag_item(target_item, override) + suffix.
+    """
+    blocks = rag_blocks(results_list)
+    for i, item in enumerate(results_list):
+        if item['item_id'] == target_id:
+            return "".join(blocks[:i]), item, "".join(blocks[i+1:])
+    return "".join(blocks), None, ""
+
+def sentence_weights(generated_text):
+    """
+    Splits the answer into sentences once, with each sentence's share of credit:
+    position decay (earlier sentences matter more) / number of citations in it.
+    """
+    sentences = SENTENCE_SPLIT_RE.split(generated_text)
+    n_sentences = max(len(sentences), 1)
+    return sentences, [
+        (1.0 * math.exp(-1 * i / n_sentences)) / (sent.count('[') or 1)
+        for i, sent in enumerate(sentences)
+    ]
 
 def calculate_visibility_score(generated_text, item_id):
     """
     Implements the Impression Score (WordPos).
     """
     if not generated_text: return 0.0
-    
-    sentences = re.split(r'(?<=[.!?]) +', generated_text)
-    total_score = 0.0
-    
-    for i, sent in enumerate(sentences):
-        if item_id in sent:
-            # Decay factor (Earlier sentences matter more)
-            pos_weight = math.exp(-1 * i / max(len(sentences), 1))
-            
-            # Count factor (Shared credit)
-            citation_count = len(re.findall(r'\[', sent)) or 1
-            
-            total_score += (1.0 * pos_weight) / citation_count
-            
-    return round(total_score, 4)
+    # Cheap exit: most candidates are never cited at all
+    if item_id not in generated_text: return 0.0
+    return calculate_visibility_scores(generated_text, [item_id])[item_id]
+
+def calculate_visibility_scores(generated_text, item_ids):
+    """
+    calculate_visibility_score for many candidates of the same answer: the sentences are
+    split once, each id's occurrences are located with str.find (C substring search, no
+    per-sentence `in` test), and each hit is mapped to its sentence by offset.
+    Returns {item_id: score}.
+    """
+    scores = {item_id: 0.0 for item_id in item_ids}
+    if not generated_text or not scores:
+        return scores
+
+    sentences, weights = sentence_weights(generated_text)
+    starts = [0] + [m.end() for m in SENTENCE_SPLIT_RE.finditer(generated_text)]
+
+    for item_id in scores:
+        if not item_id:
+            continue
+        # Sentences citing this id (each counts once, however often it is repeated there)
+        cited = set()
+        pos = generated_text.find(item_id)
+        while pos != -1:
+            cited.add(bisect.bisect_right(starts, pos) - 1)
+            pos = generated_text.find(item_id, pos + 1)
+        scores[item_id] = round(sum(weights[i] for i in sorted(cited)), 4)
+    return scores
 
 def run_verification():
     # 1. Load Data
@@ -66,8 +143,7 @@ def run_verification():
         print("❌ Optimized file not found.")
         return
 
-    with open(OPTIMIZED_FILE, 'r') as f:
-        new_product = json.load(f)
+    new_product = load_json(OPTIMIZED_FILE)
     
     # Extract Metadata
     target_query = new_product['optimization_log']['applied_query']
@@ -84,31 +160,27 @@ def run_verification():
         print("❌ Repo file missing.")
         return
 
-    with open(REPO_FILE, 'r') as f:
-        repo = json.load(f)
-        
-    query_group = next((q for q in repo if q['query'] == target_query), None)
+    # Streamed (ijson when installed): parsing stops at the matching query group
+    with closing(iter_json_array(REPO_FILE)) as repo:
+        query_group = next((q for q in repo if q['query'] == target_query), None)
     if not query_group:
         print("❌ Original query group not found.")
         return
         
     # 3. THE HOT SWAP
-    test_candidates = []
+    test_candidates = query_group['results']
+    items_by_id = {item['item_id']: (i, item) for i, item in enumerate(test_candidates)}
+    overrides = {}
     image_url = None
-    for item in query_group['results']:
-        if item['item_id'] == target_id:
-            print("   🔄 Swapping in Optimized Content...")
-            modified_item = item.copy()
-            modified_item['title'] = new_product['title']
-            modified_item['features'] = new_product['features']
-            test_candidates.append(modified_item)
-            image_url = item.get('image_path', item.get('image_url'))
-        else:
-            test_candidates.append(item)
+    if target_id in items_by_id:
+        print("   🔄 Swapping in Optimized Content...")
+        target_pos, item = items_by_id[target_id]
+        overrides[target_pos] = {'title': new_product['title'], 'features': new_product['features']}
+        image_url = item.get('image_path', item.get('image_url'))
 
     # 4. Run Hybrid Simulation (Two-Step Mode)
     agent = SimulatorAgent()
-    rag_context = format_rag_context(test_candidates)
+    rag_context = format_rag_context(test_candidates, overrides)
     
     print("   🤖 Running Simulator (Generation Step)...")
     
@@ -120,12 +192,12 @@ def run_verification():
         return
 
     # STEP 2: Calculate Visibility for ALL items to determine Rank
+    vis_scores = calculate_visibility_scores(gen_text, [item['item_id'] for item in test_candidates])
     scored_candidates = []
     for item in test_candidates:
-        v_score = calculate_visibility_score(gen_text, item['item_id'])
         scored_candidates.append({
             "item_id": item['item_id'],
-            "visibility_score": v_score
+            "visibility_score": vis_scores[item['item_id']]
         })
     
     # Sort by Visibility (Highest Score = Rank 1)
@@ -146,7 +218,7 @@ def run_verification():
     judge = VisualGroundingScorer()
     # We judge the combined title + features
     optimized_text = f"{new_product['title']} {new_product['features']}"
-    vgs_score = judge.calculate_vgs(target_id, optimized_text, image_url)
+    vgs_score = judge.calculate_vgs(target_id, optimized_text, image_url, load_image_types().get(target_id))
 
     # --- 3. REWARD CALCULATION ---
     # Reward = R_vis - lambda * (1 - R_util)
@@ -190,8 +262,7 @@ def run_verification():
         "final_reward": final_reward,
         "generated_text": gen_text,
     }
-    with open(OUTPUT_VERIFICATION, 'w') as f:
-        json.dump(result_log, f, indent=4)
+    dump_json(result_log, OUTPUT_VERIFICATION)
     print(f"   💾 Saved verification to {OUTPUT_VERIFICATION}")
 
 if __name__ == "__main__":
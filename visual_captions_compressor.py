@@ -0,0 +1,79 @@
+import os
+from tqdm import tqdm
+from ollama_utils import call_ollama
+from fast_json import load_json, dump_json
+
+# --- CONFIGURATION ---
+INPUT_FILE = "data/dense_captions.json"
+OUTPUT_FILE = "data/dense_captions_compressed.json"
+MODEL_NAME = "qwen2.5:0.5b"  # Small local model, this is a pure summarization pass
+MAX_TOKENS = 150             # Target length of a compressed description
+SAVE_EVERY = 25
+
+# --- STRICT SYSTEM PROMPT ---
+sys_msg = f"""
+You are a Technical Editor for an E-Commerce Database.
+Compress the product description you are given into at most {MAX_TOKENS} tokens.
+
+RULES:
+1. Keep every physical attribute: color, material, shape, pattern, parts, text printed on the product.
+2. Drop filler ("The image shows...", "This product features...") and repeated facts.
+3. Do not invent anything that is not in the input.
+4. Output only the compressed description. No intro text.
+"""
+
+def estimate_tokens(text):
+    # Rough estimate (~3 characters per token): only decides whether a caption is worth a model call
+    return len(text) / 3.0
+
+def load_existing(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        return load_json(path)
+    except ValueError as e:
+        print(f"   ⚠️ Could not parse {path} ({e}). Starting from scratch.")
+        return {}
+
+def save_json(data, path):
+    # Write-then-rename: an interrupted save never leaves a truncated file behind
+    tmp_path = f"{path}.tmp"
+    dump_json(data, tmp_path)
+    os.replace(tmp_path, path)
+
+def compress_captions():
+    captions = load_existing(INPUT_FILE)
+    compressed = load_existing(OUTPUT_FILE)
+
+    if not captions:
+        print(f"❌ No captions found in {INPUT_FILE}")
+        return
+
+    work_queue = [(k, v) for k, v in captions.items() if k not in compressed]
+    print(f"📂 Loaded {len(captions)} captions ({len(compressed)} already compressed)")
+    print(f"🚀 Compressing {len(work_queue)} captions with {MODEL_NAME}...")
+
+    for i, (item_id, caption) in enumerate(tqdm(work_queue, desc="Compressing")):
+        caption = str(caption).strip()
+
+        # Already short enough, keep the original wording
+        if estimate_tokens(caption) <= MAX_TOKENS:
+            compressed[item_id] = caption
+        else:
+            try:
+                short = call_ollama(caption, system=sys_msg, temperature=0.1, model=MODEL_NAME)
+                short = short.strip().strip('"')
+                # Fall back to the original text if the model returned nothing
+                compressed[item_id] = short or caption
+            except Exception as e:
+                print(f"   ⚠️ Error compressing {item_id}: {e}")
+                continue
+
+        if (i + 1) % SAVE_EVERY == 0:
+            save_json(compressed, OUTPUT_FILE)
+
+    save_json(compressed, OUTPUT_FILE)
+    print(f"\n✅ Compression Complete. Saved to {OUTPUT_FILE}")
+
+if __name__ == "__main__":
+    compress_captions()
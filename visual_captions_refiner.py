@@ -1,14 +1,39 @@
-import json
 import os
+import hashlib
 from tqdm import tqdm
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from ollama_utils import call_ollama_chat
+from checkpointer import Checkpointer
+import fast_json
+from fast_json import iter_jsonl
 
 # --- CONFIGURATION ---
-GPU_ID=3
 INPUT_FILE = f"data/test_dense_captions.json"
-OUTPUT_FILE = f"data/test_dense_captions_refined_{GPU_ID}.json"
+OUTPUT_FILE = f"data/test_dense_captions_refined.json"
+# Append-only log of items refined since OUTPUT_FILE was last written (replayed on resume)
+JOURNAL_FILE = f"data/test_dense_captions_refined.partial.jsonl"
 MODEL_NAME = "gpt-oss"  # or 'llama3', whatever your high-quality local model is
 
+# EXACT CACHE: byte-identical raw captions (e.g. color variants sharing photos) reuse one merge, no model needed
+EXACT_CACHE_FILE = "data/refiner_exact_cache.json"
+
+# SEMANTIC CACHE: products whose raw captions are (near-)identical reuse one merged caption.
+# Off by default: colour / material variants can clear the threshold and would inherit another
+# product's colour or material; the exact cache above already covers byte-identical inputs
+SEMANTIC_CACHE = False
+SEMANTIC_CACHE_FILE = "data/caption_merge_cache.pt"
+SEMANTIC_CACHE_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.97  # Cosine similarity needed to reuse an earlier merge
+
+# SHARDS: Ollama servers fed from a single work queue (no manual splitting). Default is the one
+# standard server; with one server per GPU list every port, e.g. [11434, 11435, 11436] for:
+#   for i in 0 1 2; do CUDA_VISIBLE_DEVICES=$i OLLAMA_HOST=127.0.0.1:$((11434+i)) ollama serve & done
+OLLAMA_PORTS = [11434]
+# Merges in flight per shard (match each server's OLLAMA_NUM_PARALLEL)
+PARALLEL_PER_SHARD = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
+
 # --- STRICT SYSTEM PROMPT ---
 sys_msg = """
 You are a Technical Editor for an E-Commerce Database.
@@ -31,26 +56,187 @@ Example Output:
 "A blue denim jacket featuring silver buttons and contrasting yellow stitching with a visible denim grain texture."
 """
 
+# Built once and sent first, byte-identical on every call: the server's prompt cache
+# reuses its KV for each item, so only the per-item user turn is prefilled
+SYSTEM_MESSAGE = {"role": "system", "content": sys_msg}
+
 def load_json(path):
     if os.path.exists(path):
         try:
-            with open(path, 'r') as f:
-                return json.load(f)
+            return fast_json.load_json(path)
         except:
             return {}
     return {}
 
 def save_json(data, path):
-    with open(path, 'w') as f:
-        json.dump(data, f, indent=4)
+    # Write-then-rename: an interrupted save never leaves a truncated file behind
+    tmp_path = f"{path}.tmp"
+    fast_json.dump_json(data, tmp_path)
+    os.replace(tmp_path, path)
+
+def compact_journal(refined_data):
+    """Folds the journal into OUTPUT_FILE once, then drops it."""
+    if os.path.exists(JOURNAL_FILE):
+        save_json(refined_data, OUTPUT_FILE)
+        os.remove(JOURNAL_FILE)
+
+def caption_key(joined_captions):
+    return hashlib.blake2b(joined_captions.encode(), digest_size=16).hexdigest()
+
+def import_semantic_libs():
+    """
+    torch / sentence-transformers are only needed by the semantic cache: imported when
+    it is created, so runs with SEMANTIC_CACHE off don't need them installed.
+    """
+    global torch, SentenceTransformer
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+class CaptionMergeCache:
+    """
+    Merged captions keyed by their raw input captions: the most similar earlier input
+    (MiniLM embeddings, cosine) is reused if it clears SEMANTIC_CACHE_THRESHOLD.
+    Persisted as a .pt file between runs.
+    """
+    def __init__(self, path):
+        import_semantic_libs()
+        self.path = path
+        self.lock = threading.Lock()
+        self.encoder = SentenceTransformer(SEMANTIC_CACHE_MODEL)
+        self.encode_lock = threading.Lock()
+        self.texts, self.captions, self.embeddings = [], [], None
+        if os.path.exists(path):
+            state = torch.load(path)
+            self.texts, self.captions, self.embeddings = state['texts'], state['captions'], state['embeddings']
+            print(f"📂 Loaded {len(self.texts)} cached caption merges from {path}")
+
+    def lookup(self, text):
+        """Returns (cached merged caption or None, embedding of text)."""
+        with self.encode_lock:
+            embedding = self.encoder.encode(text, convert_to_tensor=True, normalize_embeddings=True).cpu()
+        with self.lock:
+            if self.embeddings is not None:
+                sims = self.embeddings @ embedding
+                best = int(sims.argmax())
+                if sims[best] >= SEMANTIC_CACHE_THRESHOLD:
+                    return self.captions[best], embedding
+        return None, embedding
+
+    def add(self, text, embedding, caption):
+        with self.lock:
+            self.texts.append(text)
+            self.captions.append(caption)
+            row = embedding.unsqueeze(0)
+            self.embeddings = row if self.embeddings is None else torch.cat([self.embeddings, row])
+
+    def save(self):
+        with self.lock:
+            torch.save({'texts': self.texts, 'captions': self.captions, 'embeddings': self.embeddings}, self.path)
+
+# blake2b(joined captions) -> merged caption, loaded in refine_captions
+exact_cache = {}
+# Created in refine_captions when SEMANTIC_CACHE is on
+merge_cache = None
+
+# Each worker thread is pinned to one shard; idle threads take the next item, so a
+# shard stuck on long items never leaves the others waiting
+_worker = threading.local()
+_next_shard = itertools.count()
+
+def pin_worker_to_shard():
+    _worker.host = f"http://127.0.0.1:{OLLAMA_PORTS[next(_next_shard) % len(OLLAMA_PORTS)]}"
+
+def merge_item_captions(item_id, images_dict):
+    """
+    Merges one product's per-image captions into a single description.
+    Returns the refined entry, or None if the product has no usable captions.
+    """
+    # A. Collect all raw captions
+    # We prefer PRODUCT_SOLO, but we take everything to be safe.
+    raw_texts = []
+    for img_key, details in images_dict.items():
+        
+        # Skip errors or empty captions
+        if not isinstance(details, dict) or 'caption' not in details:
+            continue
+            
+        c_type = details.get('type', 'UNKNOWN')
+        caption = details.get('caption', '').strip()
+        
+        # Skip useless "No caption" entries
+        # if len(caption) < 5: 
+            # continue
+
+        # Tag it for the LLM so it knows the source context (optional, but helps)
+        # Actually, per your instruction, we just want the LLM to merge. 
+        # We filter OUT purely "INFOGRAPHIC" text if it's just measurement numbers, 
+        # but usually, we pass it all and let the System Prompt filter "Noise".
+        raw_texts.append(f"- [{c_type}] {caption}")
+
+    if not raw_texts:
+        return None
+
+    # B. Construct User Prompt
+    joined_captions = "\n".join(raw_texts)
+    user_msg = f"""
+Here are the visual descriptions derived from multiple images of Item ID: {item_id}.
+Merge them into one strictly physical product description.
+
+INPUTS:
+{joined_captions}
+
+MERGED DESCRIPTION:
+"""
+
+    # C. Call LLM (unless an identical / near-identical set of captions was merged before)
+    key = caption_key(joined_captions)
+    if key in exact_cache:
+        return {
+            "caption": exact_cache[key],
+            "image_count_processed": len(images_dict)
+        }
+
+    embedding = None
+    if merge_cache is not None:
+        cached, embedding = merge_cache.lookup(joined_captions)
+        if cached is not None:
+            return {
+                "caption": cached,
+                "image_count_processed": len(images_dict)
+            }
+
+    messages = [
+        SYSTEM_MESSAGE,
+        {"role": "user", "content": user_msg}
+    ]
+    merged_caption = call_ollama_chat(
+        messages=messages,
+        temperature=0.1, # Very low temp for strict merging
+        host=_worker.host
+    )
+    
+    # Clean any potential quotes added by LLM
+    merged_caption = merged_caption.strip().strip('"')
+    if not merged_caption:
+        # call_ollama_chat gave up (server down / unreachable shard): never journal an empty
+        # merge, or resume would count the item as done; it is retried on the next run
+        raise RuntimeError(f"empty reply from {MODEL_NAME} at {_worker.host}")
+    exact_cache[key] = merged_caption
+    if merge_cache is not None and embedding is not None:
+        merge_cache.add(joined_captions, embedding, merged_caption)
+
+    return {
+        "caption": merged_caption,
+        "image_count_processed": len(images_dict) # Track this for resume logic
+    }
 
 def refine_captions():
     # 1. Load Data
     dense_data = load_json(INPUT_FILE)
     refined_data = load_json(OUTPUT_FILE)
-    global GPU_ID
-    GPU_ID = GPU_ID-1
-    dense_data = dict(list(dense_data.items())[len(dense_data)//3*GPU_ID : len(dense_data)//3*(GPU_ID+1) if GPU_ID != 2 else len(dense_data)])
+    # Items refined by an interrupted run (last record per item wins)
+    for record in iter_jsonl(JOURNAL_FILE):
+        refined_data[record['item_id']] = record['entry']
 
     if not dense_data:
         print("❌ No dense captions found to refine.")
@@ -81,77 +267,46 @@ def refine_captions():
             work_queue.append((item_id, images_dict))
 
     if not work_queue:
+        compact_journal(refined_data) # An interrupted run may have finished the last items
         print("✅ All captions are up to date. No refining needed.")
         return
 
     print(f"🚀 Refining {len(work_queue)} products...")
 
+    global merge_cache
+    exact_cache.update(load_json(EXACT_CACHE_FILE))
+    if SEMANTIC_CACHE:
+        merge_cache = CaptionMergeCache(SEMANTIC_CACHE_FILE)
+
     # 3. Processing Loop
-    for item_id, images_dict in tqdm(work_queue, desc="Merging Captions"):
-        
-        # A. Collect all raw captions
-        # We prefer PRODUCT_SOLO, but we take everything to be safe.
-        raw_texts = []
-        for img_key, details in images_dict.items():
-            
-            # Skip errors or empty captions
-            if not isinstance(details, dict) or 'caption' not in details:
+    # Items are independent: keep PARALLEL_PER_SHARD merges in flight on every shard (each
+    # server batches them, see OLLAMA_NUM_PARALLEL); results are merged and saved from this thread only
+    journal = Checkpointer(JOURNAL_FILE, append=True)
+    with ThreadPoolExecutor(max_workers=PARALLEL_PER_SHARD * len(OLLAMA_PORTS), initializer=pin_worker_to_shard) as ex:
+        futures = {ex.submit(merge_item_captions, item_id, images_dict): item_id for item_id, images_dict in work_queue}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Merging Captions"):
+            item_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"   ⚠️ Error refining {item_id}: {e}")
+                continue
+            if result is None:
                 continue
-                
-            c_type = details.get('type', 'UNKNOWN')
-            caption = details.get('caption', '').strip()
-            
-            # Skip useless "No caption" entries
-            # if len(caption) < 5: 
-                # continue
-
-            # Tag it for the LLM so it knows the source context (optional, but helps)
-            # Actually, per your instruction, we just want the LLM to merge. 
-            # We filter OUT purely "INFOGRAPHIC" text if it's just measurement numbers, 
-            # but usually, we pass it all and let the System Prompt filter "Noise".
-            raw_texts.append(f"- [{c_type}] {caption}")
-
-        if not raw_texts:
-            continue
-
-        # B. Construct User Prompt
-        joined_captions = "\n".join(raw_texts)
-        user_msg = f"""
-Here are the visual descriptions derived from multiple images of Item ID: {item_id}.
-Merge them into one strictly physical product description.
-
-INPUTS:
-{joined_captions}
-
-MERGED DESCRIPTION:
-"""
-
-        # C. Call LLM
-        try:
-            messages = [
-                {"role": "system", "content": sys_msg},
-                {"role": "user", "content": user_msg}
-            ]
-            merged_caption = call_ollama_chat(
-                messages=messages,
-                temperature=0.1 # Very low temp for strict merging
-            )
-            
-            # Clean any potential quotes added by LLM
-            merged_caption = merged_caption.strip().strip('"')
 
             # D. Update Data
-            refined_data[item_id] = {
-                "caption": merged_caption,
-                "image_count_processed": len(images_dict) # Track this for resume logic
-            }
+            refined_data[item_id] = result
+
+            # Save incrementally: one appended line per item instead of rewriting the whole file
+            journal.add({"item_id": item_id, "entry": result})
+            journal.flush()
 
-            # Save incrementally (every item or every 10 items)
-            # For safety, we save every item since LLM calls are slow.
-            save_json(refined_data, OUTPUT_FILE)
+    journal.close()
+    compact_journal(refined_data)
+    save_json(exact_cache, EXACT_CACHE_FILE)
 
-        except Exception as e:
-            print(f"   ⚠️ Error refining {item_id}: {e}")
+    if merge_cache is not None:
+        merge_cache.save()
 
     print(f"\n✅ Refinement Complete. Saved to {OUTPUT_FILE}")
 
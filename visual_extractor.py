@@ -1,18 +1,38 @@
-import torch
-from transformers import AutoProcessor, LlavaForConditionalGeneration
 from PIL import Image
 import os
-import json
 from tqdm import tqdm
 import argparse
 import sys
 import re
+import base64
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from checkpointer import Checkpointer
+from fast_json import iter_jsonl, iter_json_array, load_json, dump_json
+from ollama_utils import call_ollama_chat
+from parallel_utils import unordered_map
 
 # --- CONFIGURATION ---
 IMAGE_DIR = "data/images"          # Where your images are stored
+LLAVA_IMAGE_SIZE = 336             # Vision tower input (CLIP ViT-L/14-336)
+PIXEL_DIR = "data/pixels"          # Resized 336x336 uint8 images (precompute_llava_pixels.py); images without one are decoded as usual
 OUTPUT_FILE = "data/dense_captions.json"
 MODEL_ID = "llava-hf/llava-1.5-13b-hf" 
-BATCH_SAVE_INTERVAL = 10           # Save more frequently for safety
+LOAD_IN_4BIT = True                # bitsandbytes NF4 weights; False = plain fp16 (~26 GB)
+AWQ_MODEL_DIR = "models/llava-13b-awq"  # AWQ checkpoint from quantize_llava_awq.py; used instead of the above when present
+COMPILE_MODE = "default"           # torch.compile mode for the decoder (None = eager); no CUDA graphs, the KV cache grows every step
+KV_CACHE_BITS = 8                  # int8 KV cache (HQQ backend, needs `hqq`); None = fp16 cache
+JOURNAL_FILE = "data/dense_captions.partial.jsonl"  # Captions appended as they finish (replayed on resume)
+CAPTION_BATCH_SIZE = 8             # Images per generate() call (lower if VRAM runs out)
+PREFETCH_BATCHES = 2               # Batches decoded/preprocessed ahead of the GPU
+MAX_NEW_TOKENS = 300               # Hard cap on caption length
+LENGTH_WARMUP_CAPTIONS = 100       # After this many captions the cap follows the observed p99 length
+LENGTH_HEADROOM_TOKENS = 20        # Added on top of that p99
+STOP_STRINGS = ["USER:"]           # The model starting a new turn means the caption is over
+# --backend ollama: LLaVA served by Ollama, which batches concurrent requests continuously
+OLLAMA_CAPTION_MODEL = "llava:13b"
+OLLAMA_CAPTION_WORKERS = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))  # Requests in flight (match the server)
 
 # --- HYBRID PROMPT: Classification + Your Strict Extraction Rules ---
 SYSTEM_PROMPT = """
@@ -43,58 +63,321 @@ CONSTRAINT:
 - Use dry, clinical language (e.g., "The object is..." NOT "This lovely item...").
 - Do NOT interpret the product's use (e.g., do not say "good for parties"). Focus only on appearance.
 """
+CAPTION_PROMPT = f"USER: <image>\n{SYSTEM_PROMPT}\nASSISTANT:"
+
+def load_llava(attn_implementation):
+    model_path = MODEL_ID
+    if os.path.isdir(AWQ_MODEL_DIR):
+        # Pre-quantized AWQ decoder (vision tower stays fp16): fused int4 GEMM kernels,
+        # faster per decode step than bitsandbytes' dequantize-then-matmul
+        model_path = AWQ_MODEL_DIR
+        weights = {"torch_dtype": torch.float16}
+    elif LOAD_IN_4BIT:
+        # NF4 weights (fp16 compute): a quarter of the weight bandwidth per decode step
+        weights = {"quantization_config": BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True
+        )}
+    else:
+        weights = {"torch_dtype": torch.float16}
+    return LlavaForConditionalGeneration.from_pretrained(
+        model_path, 
+        low_cpu_mem_usage=True, 
+        device_map="auto",
+        attn_implementation=attn_implementation,
+        **weights
+    )
+
+def compile_decoder(model, processor):
+    """
+    Compiles the language model's forward (called once per generated token) so its small
+    norm/matmul/attention ops run as fused kernels; generate() itself stays eager.
+    torch.compile is lazy, so a one-image warm-up generate runs inside the try: if dynamo /
+    inductor fail on these weights or this cache, the eager forward is put back here
+    instead of every batch failing later.
+    """
+    if not COMPILE_MODE:
+        return
+    eager_forward = model.language_model.forward
+    try:
+        torch.set_float32_matmul_precision("high")
+        model.language_model.forward = torch.compile(eager_forward, mode=COMPILE_MODE, dynamic=True)
+        size = processor.image_processor.crop_size
+        placeholder = Image.new("RGB", (size["width"], size["height"]))
+        inputs = processor(text=[CAPTION_PROMPT], images=[placeholder], return_tensors="pt").to("cuda", torch.float16)
+        with torch.inference_mode():
+            model.generate(**inputs, max_new_tokens=4, do_sample=False, use_cache=True, **kv_cache_kwargs())
+        print(f"   ⚙️ Decoder compiled with torch.compile (mode={COMPILE_MODE}).")
+    except Exception as e:
+        model.language_model.forward = eager_forward
+        print(f"   ⚠️ torch.compile failed ({e}). Running eager.")
+
+def import_model_libs():
+    """
+    torch / transformers are imported on first use, so runs with nothing left to caption
+    exit before paying for library + CUDA initialization.
+    """
+    global torch, AutoProcessor, LlavaForConditionalGeneration, BitsAndBytesConfig, BatchFeature
+    import torch
+    from transformers import AutoProcessor, LlavaForConditionalGeneration, BitsAndBytesConfig, BatchFeature
+    # TF32 for the fp32 parts of the forward (vision tower residuals, norms); no effect on fp16 matmuls
+    torch.backends.cuda.matmul.allow_tf32 = True
+
+def kv_cache_kwargs():
+    """
+    generate() kwargs for the quantized KV cache: the ~576 image tokens of every prompt
+    dominate it, so int8 halves the cache traffic of each decode step.
+    """
+    if not KV_CACHE_BITS:
+        return {}
+    return {"cache_implementation": "quantized", "cache_config": {"backend": "HQQ", "nbits": KV_CACHE_BITS}}
+
+def check_kv_cache_backend():
+    global KV_CACHE_BITS
+    if not KV_CACHE_BITS:
+        return
+    try:
+        import hqq
+    except ImportError:
+        print("   ⚠️ hqq not installed. Using the fp16 KV cache.")
+        KV_CACHE_BITS = None
 
 def setup_model():
+    import_model_libs()
     print(f"🚀 Loading {MODEL_ID} to GPU...")
     try:
-        model = LlavaForConditionalGeneration.from_pretrained(
-            MODEL_ID, 
-            torch_dtype=torch.float16, 
-            low_cpu_mem_usage=True, 
-            device_map="auto"
-        )
+        try:
+            # FlashAttention-2 kernels only exist for Ampere (SM 8.0) and newer
+            if torch.cuda.get_device_capability()[0] < 8:
+                raise ValueError("GPU older than SM 8.0")
+            model = load_llava("flash_attention_2") # Fused, tiled attention kernels
+        except (ImportError, ValueError) as e:
+            print(f"   ⚠️ FlashAttention-2 unavailable ({e}). Falling back to SDPA.")
+            model = load_llava("sdpa")
+        model.config.use_cache = True
+        model.eval()
+        check_kv_cache_backend()
         processor = AutoProcessor.from_pretrained(MODEL_ID)
+        processor.tokenizer.padding_side = "left" # Batched generation continues right after each prompt
+        compile_decoder(model, processor) # Warm-up uses the processor and the final cache settings
         print("✅ Model loaded successfully.")
         return model, processor
     except Exception as e:
         print(f"❌ Error loading model: {e}")
         sys.exit(1)
 
-def generate_caption(model, processor, image_path):
+def parse_caption(raw_response):
+    """Splits a raw model answer into {type, caption}."""
+    # --- PARSING LOGIC ---
+    # We look for the [TYPE] tag at the start
+    classification = "UNKNOWN"
+    description = raw_response
+    
+    # Regex to find [TAG] at the start
+    match = re.match(r"\[(PRODUCT_SOLO|LIFESTYLE|MODEL|INFOGRAPHIC)\]", raw_response)
+    if match:
+        classification = match.group(1) # Extract text inside brackets
+        # Remove the tag from the description to keep your dense paragraph clean
+        description = raw_response.replace(match.group(0), "").strip()
+    
+    return {
+        "type": classification, 
+        "caption": description
+    }
+
+# Generated tokens per caption so far (feeds caption_token_budget)
+caption_lengths = []
+
+def caption_token_budget():
+    """max_new_tokens for the next batch: p99 of the captions seen so far plus headroom."""
+    if len(caption_lengths) < LENGTH_WARMUP_CAPTIONS:
+        return MAX_NEW_TOKENS
+    p99 = sorted(caption_lengths)[int(0.99 * (len(caption_lengths) - 1))]
+    return min(MAX_NEW_TOKENS, p99 + LENGTH_HEADROOM_TOKENS)
+
+def open_rgb(image_path, min_size=LLAVA_IMAGE_SIZE):
+    """
+    Decodes an image to RGB. JPEGs are decoded straight at the smallest 1/2, 1/4 or 1/8
+    scale that still covers min_size (libjpeg DCT scaling), since the processor would
+    downsample them anyway: far less decode work for large product photos.
+    """
+    image = Image.open(image_path)
+    image.draft("RGB", (min_size, min_size))
+    return image.convert("RGB")
+
+def pixel_cache_path(image_path):
+    """data/images/<item>/<n>.jpg -> data/pixels/<item>/<n>.npy"""
+    rel_path = os.path.relpath(image_path, IMAGE_DIR)
+    return os.path.join(PIXEL_DIR, os.path.splitext(rel_path)[0] + ".npy")
+
+def resized_rgb(image_processor, image):
+    """
+    The processor's resize + center crop only, as a uint8 HxWxC array: what the pixel
+    cache stores (a third of the bytes of fp16 pixel_values, no codec on load).
+    """
+    pixels = image_processor(image, do_rescale=False, do_normalize=False, return_tensors="np")["pixel_values"][0]
+    return pixels.round().clip(0, 255).astype(np.uint8).transpose(1, 2, 0)
+
+def load_pixel_values(processor, image_path):
+    """Preprocessed pixels for one image: the pre-resized array if there is one, else decode + resize now."""
+    cache_path = pixel_cache_path(image_path)
+    if os.path.exists(cache_path):
+        # Already at the crop size: only rescale + normalize are left
+        image = np.load(cache_path)
+        pixels = processor.image_processor(image, do_resize=False, do_center_crop=False, return_tensors="pt")
+    else:
+        pixels = processor.image_processor(open_rgb(image_path), return_tensors="pt")
+    return pixels["pixel_values"][0].to(torch.float16)
+
+# Tokenized CAPTION_PROMPT (with its expanded <image> tokens); identical for every image
+_prompt_inputs = None
+
+def caption_prompt_inputs(processor):
+    global _prompt_inputs
+    if _prompt_inputs is None:
+        # The processor only expands <image> when given an image; any image gives the same ids
+        size = processor.image_processor.crop_size
+        placeholder = Image.new("RGB", (size["width"], size["height"]))
+        inputs = processor(text=[CAPTION_PROMPT], images=[placeholder], return_tensors="pt")
+        _prompt_inputs = {k: v for k, v in inputs.items() if k != "pixel_values"}
+    return _prompt_inputs
+
+def prepare_caption_batch(processor, image_paths):
+    """
+    CPU side of a batch: loads (or decodes and preprocesses) the images' pixel values.
+    Returns (inputs or None, slots) where slots are the indices of the images that loaded.
+    """
+    pixels, slots = [], []
+    for i, image_path in enumerate(image_paths):
+        try:
+            pixels.append(load_pixel_values(processor, image_path))
+            slots.append(i)
+        except Exception as e:
+            print(f"   ⚠️ Error processing {image_path}: {e}")
+    if not pixels:
+        return None, slots
+
     try:
-        image = Image.open(image_path).convert("RGB")
-        
-        # Prepare Inputs
-        prompt = f"USER: <image>\n{SYSTEM_PROMPT}\nASSISTANT:"
-        inputs = processor(text=prompt, images=image, return_tensors="pt").to("cuda", torch.float16)
+        # Prepare Inputs (same prompt for every image, so no padding is needed)
+        prompt_inputs = caption_prompt_inputs(processor)
+        data = {k: v.expand(len(pixels), -1) for k, v in prompt_inputs.items()}
+        data["pixel_values"] = torch.stack(pixels)
+        # Page-locked, so the copy to the GPU can run asynchronously
+        return BatchFeature(data={k: v.pin_memory() for k, v in data.items()}), slots
+    except Exception as e:
+        print(f"   ⚠️ Error processing batch {[image_paths[i] for i in slots]}: {e}")
+        return None, slots
+
+# Largest batch generate() has fit so far; halved on CUDA OOM and kept for the rest of the run
+generate_batch_limit = CAPTION_BATCH_SIZE
+
+def slice_inputs(inputs, start, end):
+    return BatchFeature(data={k: v[start:end] for k, v in inputs.items()})
+
+def generate_texts(model, processor, inputs):
+    """generate() + decode for a prepared batch (already on the GPU), split to fit in VRAM."""
+    global generate_batch_limit
+    n = inputs["input_ids"].shape[0]
+    if n > generate_batch_limit:
+        texts = []
+        for start in range(0, n, generate_batch_limit):
+            texts += generate_texts(model, processor, slice_inputs(inputs, start, start + generate_batch_limit))
+        return texts
+
+    out_of_memory = False
+    try:
+        # No autograd bookkeeping (version counters, saved activations) during decode
+        with torch.inference_mode():
+            # A batch runs until its longest caption ends: a tight cap keeps one rambling image from stalling the rest
+            generate_ids = model.generate(
+                **inputs,
+                max_new_tokens=caption_token_budget(),
+                do_sample=False,
+                use_cache=True,
+                eos_token_id=processor.tokenizer.eos_token_id,
+                stop_strings=STOP_STRINGS,
+                tokenizer=processor.tokenizer,
+                **kv_cache_kwargs()
+            )
+    except torch.cuda.OutOfMemoryError:
+        if n == 1:
+            raise
+        out_of_memory = True
+
+    if out_of_memory:
+        # Retried outside the except block so the failed attempt's tensors can be freed
+        torch.cuda.empty_cache()
+        generate_batch_limit = max(1, n // 2)
+        print(f"   ⚠️ CUDA out of memory on a batch of {n}. Continuing with batches of {generate_batch_limit}.")
+        return generate_texts(model, processor, inputs)
+
+    new_tokens = generate_ids[:, inputs["input_ids"].shape[1]:]
+    caption_lengths.extend((new_tokens != processor.tokenizer.pad_token_id).sum(dim=1).tolist())
+    return processor.batch_decode(generate_ids, skip_special_tokens=True)
+
+def generate_captions_batch(model, processor, image_paths, prepared):
+    """
+    Captions several images with one generate() call (prefill and kernel launches are shared).
+    prepared: the (inputs, slots) from prepare_caption_batch for these paths.
+    Returns one result per path, None where the image or the batch failed.
+    """
+    results = [None] * len(image_paths)
+    inputs, slots = prepared
+    if inputs is None:
+        return results
+
+    try:
+        inputs = inputs.to("cuda", torch.float16, non_blocking=True)
 
         # Generate
-        generate_ids = model.generate(**inputs, max_new_tokens=300, do_sample=False)
-        output_text = processor.batch_decode(generate_ids, skip_special_tokens=True)[0]
+        output_texts = generate_texts(model, processor, inputs)
         
         # Cleanup response (Remove Prompt)
-        raw_response = output_text.split("ASSISTANT:")[-1].strip()
-        
-        # --- PARSING LOGIC ---
-        # We look for the [TYPE] tag at the start
-        classification = "UNKNOWN"
-        description = raw_response
-        
-        # Regex to find [TAG] at the start
-        match = re.match(r"\[(PRODUCT_SOLO|LIFESTYLE|MODEL|INFOGRAPHIC)\]", raw_response)
-        if match:
-            classification = match.group(1) # Extract text inside brackets
-            # Remove the tag from the description to keep your dense paragraph clean
-            description = raw_response.replace(match.group(0), "").strip()
-        
-        return {
-            "type": classification, 
-            "caption": description
-        }
+        for i, output_text in zip(slots, output_texts):
+            response = output_text.split("ASSISTANT:")[-1]
+            for stop in STOP_STRINGS:
+                response = response.split(stop)[0]
+            results[i] = parse_caption(response.strip())
         
+    except Exception as e:
+        print(f"   ⚠️ Error processing batch {[image_paths[i] for i in slots]}: {e}")
+    return results
+
+def caption_with_ollama(image_path):
+    """Captions one image through the Ollama server. Returns {type, caption} or None."""
+    try:
+        with open(image_path, 'rb') as f:
+            image_b64 = base64.b64encode(f.read()).decode()
     except Exception as e:
         print(f"   ⚠️ Error processing {image_path}: {e}")
         return None
+    reply = call_ollama_chat(
+        messages=[{"role": "user", "content": SYSTEM_PROMPT, "images": [image_b64]}],
+        model=OLLAMA_CAPTION_MODEL,
+        temperature=0.0
+    )
+    for stop in STOP_STRINGS:
+        reply = reply.split(stop)[0]
+    return parse_caption(reply.strip()) if reply.strip() else None
+
+def store_caption(captions, item_id, sub_key, result):
+    # --- NEW OUTPUT FORMAT: Nested Dict ---
+    if sub_key is not None:
+        if item_id not in captions or not isinstance(captions[item_id], dict):
+            captions[item_id] = {}
+        captions[item_id][sub_key] = result # {type: "...", caption: "..."}
+    
+    # --- OLD OUTPUT FORMAT: Flat Dict ---
+    else:
+        captions[item_id] = result # {type: "...", caption: "..."}
+
+def save_captions(captions):
+    # Write-then-rename: an interrupted save never leaves a truncated file behind
+    tmp_path = f"{OUTPUT_FILE}.tmp"
+    dump_json(captions, tmp_path)
+    os.replace(tmp_path, OUTPUT_FILE)
 
 def extract_target_ids(query_repo_path):
     """Parses a query repo JSON file to get all involved item_ids."""
@@ -103,24 +386,67 @@ def extract_target_ids(query_repo_path):
         sys.exit(1)
         
     print(f"📂 Parsing target items from: {query_repo_path}")
-    with open(query_repo_path, 'r') as f:
-        repo_data = json.load(f)
-        
-    target_ids = set()
-    for entry in repo_data:
-        results = entry.get('results', [])
-        for item in results:
-            if 'item_id' in item:
-                target_ids.add(item['item_id'])
+    # Streamed one query group at a time (ijson when installed): the repo is never held whole
+    repo_data = iter_json_array(query_repo_path)
+    target_ids = {item['item_id'] for entry in repo_data for item in entry.get('results', []) if 'item_id' in item}
                 
     print(f"   Found {len(target_ids)} unique items in repo.")
     return target_ids
 
+def caption_queue_hf(queue, captions, journal):
+    # Load Model (Only if we have work to do)
+    model, processor = setup_model()
+    
+    batches = [queue[start:start + CAPTION_BATCH_SIZE] for start in range(0, len(queue), CAPTION_BATCH_SIZE)]
+    batch_paths = [[os.path.join(IMAGE_DIR, rel_path) for _, rel_path, _ in batch] for batch in batches]
+    # Disk reads / JPEG decode / preprocessing for the next batches run on a background
+    # thread while the GPU generates the current one
+    loader = ThreadPoolExecutor(max_workers=1)
+    prefetched = deque(loader.submit(prepare_caption_batch, processor, paths) for paths in batch_paths[:PREFETCH_BATCHES])
+    
+    try:
+        with tqdm(total=len(queue), desc="Classifying & Captioning") as pbar:
+            for b, batch in enumerate(batches):
+                image_paths = batch_paths[b]
+                prepared = prefetched.popleft().result()
+                if b + PREFETCH_BATCHES < len(batches):
+                    prefetched.append(loader.submit(prepare_caption_batch, processor, batch_paths[b + PREFETCH_BATCHES]))
+                
+                # Generate the structured results
+                results = generate_captions_batch(model, processor, image_paths, prepared)
+                
+                for (item_id, rel_path, sub_key), result in zip(batch, results):
+                    if not result:
+                        continue
+                    store_caption(captions, item_id, sub_key, result)
+                    journal.add({"item_id": item_id, "sub_key": sub_key, "result": result})
+                pbar.update(len(batch))
+                
+                # Periodic Save (only the new captions, written off the main thread)
+                journal.flush()
+    finally:
+        loader.shutdown(wait=False, cancel_futures=True)
+
+def caption_queue_ollama(queue, captions, journal):
+    # No model in this process: keep OLLAMA_CAPTION_WORKERS images in flight and let the
+    # server batch them, so a long caption never holds a slot the others are waiting on
+    def caption(entry):
+        item_id, rel_path, sub_key = entry
+        return entry, caption_with_ollama(os.path.join(IMAGE_DIR, rel_path))
+
+    for (item_id, rel_path, sub_key), result in tqdm(unordered_map(caption, queue, OLLAMA_CAPTION_WORKERS), total=len(queue), desc="Classifying & Captioning"):
+        if not result:
+            continue
+        store_caption(captions, item_id, sub_key, result)
+        journal.add({"item_id": item_id, "sub_key": sub_key, "result": result})
+        journal.flush()
+
 def main():
     # 1. Argument Parsing
     parser = argparse.ArgumentParser(description="Generate classified visual captions for products.")
     parser.add_argument("query_repo", help="Path to query_repo.json OR 'all' to process every image.")
     parser.add_argument("--flat_structure", action="store_true", help="Use old flat directory structure (images directly in root).")
+    parser.add_argument("--backend", choices=["hf", "ollama"], default="hf", help="hf: LLaVA in this process (batched generate); ollama: OLLAMA_CAPTION_MODEL on the Ollama server.")
     args = parser.parse_args()
 
     product_has_dir = not args.flat_structure
@@ -134,22 +460,29 @@ def main():
     captions = {}
     if os.path.exists(OUTPUT_FILE):
         print(f"📂 Found existing captions file ({OUTPUT_FILE}). Loading...")
-        with open(OUTPUT_FILE, 'r') as f:
-            captions = json.load(f)
+        captions = load_json(OUTPUT_FILE)
         print(f"   Loaded {len(captions)} existing entries.")
+    # Captions finished by an interrupted run, not yet folded into OUTPUT_FILE
+    for record in iter_jsonl(JOURNAL_FILE):
+        store_caption(captions, record['item_id'], record['sub_key'], record['result'])
     
     # 4 & 5. Map Directory & Build Queue
     queue = [] # Format: (item_id, full_relative_path, sub_key_or_none)
 
+    # One scandir pass over IMAGE_DIR: dirents carry the file type, so no stat() per entry
+    with os.scandir(IMAGE_DIR) as it:
+        top_entries = list(it)
+    product_dirs = {e.name: e.path for e in top_entries if e.is_dir()}
+
     # Determine Targets
     if args.query_repo.lower() == 'all':
         print("🌍 Mode: ALL. Processing entire directory.")
         if product_has_dir:
             # Scan subdirectories
-            target_ids = [d for d in os.listdir(IMAGE_DIR) if os.path.isdir(os.path.join(IMAGE_DIR, d))]
+            target_ids = list(product_dirs)
         else:
             # Scan files
-            target_ids = [os.path.splitext(f)[0] for f in os.listdir(IMAGE_DIR) if f.endswith(('.jpg', '.png'))]
+            target_ids = [os.path.splitext(e.name)[0] for e in top_entries if e.name.endswith(('.jpg', '.png'))]
     else:
         print(f"🎯 Mode: TARGETED. Processing items from {args.query_repo}")
         target_ids = extract_target_ids(args.query_repo)
@@ -159,9 +492,9 @@ def main():
     # --- NEW LOGIC: Directory per Product ---
     if product_has_dir:
         for tid in target_ids:
-            product_folder = os.path.join(IMAGE_DIR, tid)
+            product_folder = product_dirs.get(tid)
             
-            if not os.path.isdir(product_folder):
+            if product_folder is None:
                 continue
             
             # Ensure output structure is dict for this item
@@ -169,7 +502,9 @@ def main():
                 pass 
 
             # Scan for all images inside
-            for img_file in os.listdir(product_folder):
+            with os.scandir(product_folder) as it:
+                img_files = [e.name for e in it if e.is_file()]
+            for img_file in img_files:
                 if img_file.lower().endswith(('.jpg', '.jpeg', '.png')):
                     img_key = os.path.splitext(img_file)[0] # e.g., "0", "1"
                     
@@ -187,10 +522,10 @@ def main():
     # --- OLD LOGIC: Flat Structure (Backward Compatibility) ---
     else:
         available_files = {} 
-        for f in os.listdir(IMAGE_DIR):
-            if f.lower().endswith(('.jpg', '.jpeg', '.png')):
-                item_id = os.path.splitext(f)[0]
-                available_files[item_id] = f
+        for e in top_entries:
+            if e.name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                item_id = os.path.splitext(e.name)[0]
+                available_files[item_id] = e.name
         
         for tid in target_ids:
             if tid in available_files:
@@ -198,48 +533,31 @@ def main():
                     queue.append((tid, available_files[tid], None))
 
     if not queue:
+        if os.path.exists(JOURNAL_FILE): # An interrupted run may have finished the last images
+            save_captions(captions)
+            os.remove(JOURNAL_FILE)
         print("✅ No new images to process. All targets are already captioned.")
         return
 
     print(f"📋 Processing Queue: {len(queue)} new images.")
     
-    # 6. Load Model (Only if we have work to do)
-    model, processor = setup_model()
-    
-    # 7. Processing Loop
-    processed_count = 0
+    # 6 & 7. Processing Loop
+    # Each caption is appended to the journal as it finishes; the full JSON is written once at the end
+    journal = Checkpointer(JOURNAL_FILE, append=True)
     
     try:
-        for item_id, rel_path, sub_key in tqdm(queue, desc="Classifying & Captioning"):
-            image_path = os.path.join(IMAGE_DIR, rel_path)
-            
-            # Generate the structured result
-            result = generate_caption(model, processor, image_path)
-            
-            if result:
-                # --- NEW OUTPUT FORMAT: Nested Dict ---
-                if product_has_dir:
-                    if item_id not in captions or not isinstance(captions[item_id], dict):
-                        captions[item_id] = {}
-                    captions[item_id][sub_key] = result # {type: "...", caption: "..."}
-                
-                # --- OLD OUTPUT FORMAT: Flat Dict ---
-                else:
-                    captions[item_id] = result # {type: "...", caption: "..."}
-                
-                processed_count += 1
-            
-            # Periodic Save
-            if processed_count % BATCH_SAVE_INTERVAL == 0:
-                with open(OUTPUT_FILE, 'w') as f:
-                    json.dump(captions, f, indent=4)
+        if args.backend == "ollama":
+            caption_queue_ollama(queue, captions, journal)
+        else:
+            caption_queue_hf(queue, captions, journal)
                     
     except KeyboardInterrupt:
         print("\n🛑 Interrupted by user. Saving progress...")
     finally:
-        # Final Save
-        with open(OUTPUT_FILE, 'w') as f:
-            json.dump(captions, f, indent=4)
+        # Final Save: fold the journal into OUTPUT_FILE, then drop it
+        journal.close()
+        save_captions(captions)
+        os.remove(JOURNAL_FILE)
         print(f"✅ Saved {len(captions)} total items to {OUTPUT_FILE}")
 
 if __name__ == "__main__":
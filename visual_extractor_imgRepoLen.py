@@ -1,5 +1,3 @@
-import torch
-from transformers import AutoProcessor, LlavaForConditionalGeneration
 from PIL import Image
 import os
 import json
@@ -7,13 +5,33 @@ from tqdm import tqdm
 import argparse
 import sys
 import re
-import random
 import time
+import sqlite3
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fast_json import dumps, loads, iter_json_array
 
 # --- CONFIGURATION ---
 IMAGE_DIR = "data/images"          
 OUTPUT_FILE = "data/test_dense_captions.json"
+# Work queue shared by every GPU process: images are claimed in batches, captions stored as they
+# finish, and folded into OUTPUT_FILE when a process finishes (or with --compact)
+WORK_DB = "data/test_dense_captions.sqlite"
+# One full model per GPU, all claiming from WORK_DB: torchrun --nproc_per_node=<gpus> visual_extractor_imgRepoLen.py ...
+# (each process pins itself to its LOCAL_RANK; without torchrun a single process spreads over every visible GPU)
+LOCAL_RANK = os.environ.get("LOCAL_RANK")
+STALE_CLAIM_SECONDS = 1800         # Claims older than this (crashed worker) go back to the queue
 MODEL_ID = "llava-hf/llava-1.5-13b-hf" 
+LOAD_IN_4BIT = True                # bitsandbytes NF4 weights; False = plain fp16 (~26 GB)
+AWQ_MODEL_DIR = "models/llava-13b-awq"  # AWQ checkpoint from quantize_llava_awq.py; used instead of the above when present
+LLAVA_IMAGE_SIZE = 336             # Vision tower input (CLIP ViT-L/14-336)
+PIXEL_DIR = "data/pixels"          # Resized 336x336 uint8 images (precompute_llava_pixels.py); images without one are decoded as usual
+CAPTION_BATCH_SIZE = 4             # Images per generate() call (default for --batch_size)
+PREFETCH_BATCHES = 2               # Batches decoded/preprocessed ahead of the GPU
+COMPILE_MODE = "default"           # torch.compile mode for the decoder (None = eager); no CUDA graphs, the KV cache grows every step
+TAG_ONLY_MAX_TOKENS = 8            # An answer still this short may be a bare [INFOGRAPHIC] tag (see TagOnlyStop)
+KV_CACHE_BITS = 8                  # int8 KV cache (HQQ backend, needs `hqq`); None = fp16 cache
 
 # --- SYSTEM PROMPT ---
 SYSTEM_PROMPT = """
@@ -48,54 +66,230 @@ CONSTRAINT:
 - Do NOT interpret the product's use (e.g., do not say "good for parties"). Focus only on appearance.
 """
 
+def load_llava(attn_implementation):
+    model_path = MODEL_ID
+    if os.path.isdir(AWQ_MODEL_DIR):
+        # Pre-quantized AWQ decoder (vision tower stays fp16): fused int4 GEMM kernels,
+        # faster per decode step than bitsandbytes' dequantize-then-matmul
+        model_path = AWQ_MODEL_DIR
+        weights = {"torch_dtype": torch.float16}
+    elif LOAD_IN_4BIT:
+        # NF4 weights (fp16 compute): a quarter of the weight bandwidth per decode step
+        weights = {"quantization_config": BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True
+        )}
+    else:
+        weights = {"torch_dtype": torch.float16}
+    return LlavaForConditionalGeneration.from_pretrained(
+        model_path, 
+        low_cpu_mem_usage=True, 
+        # Whole model on this process's GPU: a layer split across GPUs passes activations
+        # between them on every decode step, while one replica per GPU scales with the GPU count
+        device_map={"": int(LOCAL_RANK)} if LOCAL_RANK is not None else "auto",
+        attn_implementation=attn_implementation,
+        **weights
+    )
+
+def compile_decoder(model, processor):
+    """
+    Compiles the language model's forward (called once per generated token) so its small
+    norm/matmul/attention ops run as fused kernels; generate() itself stays eager.
+    torch.compile is lazy, so a one-image warm-up generate runs inside the try: if dynamo /
+    inductor fail on these weights or this cache, the eager forward is put back here
+    instead of every batch failing later.
+    """
+    if not COMPILE_MODE:
+        return
+    eager_forward = model.language_model.forward
+    try:
+        torch.set_float32_matmul_precision("high")
+        model.language_model.forward = torch.compile(eager_forward, mode=COMPILE_MODE, dynamic=True)
+        size = processor.image_processor.crop_size
+        placeholder = Image.new("RGB", (size["width"], size["height"]))
+        inputs = processor(text=[f"USER: <image>\n{SYSTEM_PROMPT}\nASSISTANT:"], images=[placeholder], return_tensors="pt").to("cuda", torch.float16)
+        with torch.inference_mode():
+            model.generate(**inputs, max_new_tokens=4, do_sample=False, use_cache=True, **kv_cache_kwargs())
+        print(f"   ⚙️ Decoder compiled with torch.compile (mode={COMPILE_MODE}).")
+    except Exception as e:
+        model.language_model.forward = eager_forward
+        print(f"   ⚠️ torch.compile failed ({e}). Running eager.")
+
+def import_model_libs():
+    """
+    torch / transformers are imported on first use, so runs with nothing left to caption
+    exit before paying for library + CUDA initialization.
+    """
+    global torch, AutoProcessor, LlavaForConditionalGeneration, BitsAndBytesConfig, BatchFeature
+    import torch
+    from transformers import AutoProcessor, LlavaForConditionalGeneration, BitsAndBytesConfig, BatchFeature
+
+def kv_cache_kwargs():
+    """
+    generate() kwargs for the quantized KV cache: the ~576 image tokens of every prompt
+    dominate it, so int8 halves the cache traffic of each decode step.
+    """
+    if not KV_CACHE_BITS:
+        return {}
+    return {"cache_implementation": "quantized", "cache_config": {"backend": "HQQ", "nbits": KV_CACHE_BITS}}
+
+def check_kv_cache_backend():
+    global KV_CACHE_BITS
+    if not KV_CACHE_BITS:
+        return
+    try:
+        import hqq
+    except ImportError:
+        print("   ⚠️ hqq not installed. Using the fp16 KV cache.")
+        KV_CACHE_BITS = None
+
 def setup_model():
-    print(f"🚀 Loading {MODEL_ID} to GPU...")
+    import_model_libs()
+    if LOCAL_RANK is not None:
+        torch.cuda.set_device(int(LOCAL_RANK)) # Plain "cuda" below (inputs, capability check) now means this GPU
+    print(f"🚀 Loading {MODEL_ID} to GPU {LOCAL_RANK if LOCAL_RANK is not None else '(auto)'}...")
     try:
-        model = LlavaForConditionalGeneration.from_pretrained(
-            MODEL_ID, 
-            torch_dtype=torch.float16, 
-            low_cpu_mem_usage=True, 
-            device_map="auto"
-        )
+        try:
+            # FlashAttention-2 kernels only exist for Ampere (SM 8.0) and newer
+            if torch.cuda.get_device_capability()[0] < 8:
+                raise ValueError("GPU older than SM 8.0")
+            model = load_llava("flash_attention_2") # Fused, tiled attention kernels
+        except (ImportError, ValueError) as e:
+            print(f"   ⚠️ FlashAttention-2 unavailable ({e}). Falling back to SDPA.")
+            model = load_llava("sdpa")
+        model.config.use_cache = True
+        model.eval()
+        check_kv_cache_backend()
         processor = AutoProcessor.from_pretrained(MODEL_ID)
+        processor.tokenizer.padding_side = "left" # Batched generation continues right after each prompt
+        compile_decoder(model, processor) # Warm-up uses the processor and the final cache settings
         print("✅ Model loaded successfully.")
         return model, processor
     except Exception as e:
         print(f"❌ Error loading model: {e}")
         sys.exit(1)
 
-def generate_caption(model, processor, image_path):
+def parse_caption(raw_response):
+    """Splits a raw model answer into {type, caption}."""
+    classification = "UNKNOWN"
+    description = raw_response
+    
+    match = re.match(r"\[(PRODUCT_SOLO|LIFESTYLE|MODEL|INFOGRAPHIC)\]", raw_response)
+    if match:
+        classification = match.group(1) 
+        description = raw_response.replace(match.group(0), "").strip()
+    
+    return {
+        "type": classification, 
+        "caption": description
+    }
+
+def open_rgb(image_path, min_size=LLAVA_IMAGE_SIZE):
+    """
+    Decodes an image to RGB. JPEGs are decoded straight at the smallest 1/2, 1/4 or 1/8
+    scale that still covers min_size (libjpeg DCT scaling), since the processor would
+    downsample them anyway: far less decode work for large product photos.
+    """
+    image = Image.open(image_path)
+    image.draft("RGB", (min_size, min_size))
+    return image.convert("RGB")
+
+def pixel_cache_path(image_path):
+    """data/images/<item>/<n>.jpg -> data/pixels/<item>/<n>.npy"""
+    rel_path = os.path.relpath(image_path, IMAGE_DIR)
+    return os.path.join(PIXEL_DIR, os.path.splitext(rel_path)[0] + ".npy")
+
+def load_image(image_path):
+    """The pre-resized array if there is one (the processor's resize is then a no-op), else the decoded image."""
+    cache_path = pixel_cache_path(image_path)
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+    return open_rgb(image_path)
+
+class TagOnlyStop:
+    """
+    Stopping criterion (passed in stopping_criteria): ends a row as soon as its answer is
+    exactly the [INFOGRAPHIC] tag, which the prompt says to output alone. Those rows stop
+    after a handful of tokens instead of idling to max_new_tokens while the batch finishes.
+    """
+    def __init__(self, tokenizer, prompt_len):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids[:, self.prompt_len:]
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if generated.shape[1] > TAG_ONLY_MAX_TOKENS:
+            return done # Past the tag: a full description is being written
+        for row, text in enumerate(self.tokenizer.batch_decode(generated, skip_special_tokens=True)):
+            done[row] = text.strip() == "[INFOGRAPHIC]"
+        return done
+
+def prepare_caption_batch(processor, image_paths):
+    """
+    CPU side of a batch: decodes the images and runs the processor (runs on the prefetch thread).
+    Returns (inputs or None, slots) where slots are the indices of the images that loaded.
+    """
+    images, slots = [], []
+    for i, image_path in enumerate(image_paths):
+        try:
+            images.append(load_image(image_path))
+            slots.append(i)
+        except Exception as e:
+            print(f"   ⚠️ Error processing {image_path}: {e}")
+    if not images:
+        return None, slots
+
     try:
-        image = Image.open(image_path).convert("RGB")
-        
         prompt = f"USER: <image>\n{SYSTEM_PROMPT}\nASSISTANT:"
-        inputs = processor(text=prompt, images=image, return_tensors="pt").to("cuda", torch.float16)
+        inputs = processor(text=[prompt] * len(images), images=images, return_tensors="pt", padding=True)
+        # Page-locked, so the copy to the GPU can run asynchronously
+        return BatchFeature(data={k: v.pin_memory() for k, v in inputs.items()}), slots
+    except Exception as e:
+        print(f"   ⚠️ Error processing batch {[image_paths[i] for i in slots]}: {e}")
+        return None, slots
 
-        generate_ids = model.generate(**inputs, max_new_tokens=300, do_sample=False)
-        output_text = processor.batch_decode(generate_ids, skip_special_tokens=True)[0]
-        
-        raw_response = output_text.split("ASSISTANT:")[-1].strip()
-        
-        classification = "UNKNOWN"
-        description = raw_response
-        
-        match = re.match(r"\[(PRODUCT_SOLO|LIFESTYLE|MODEL|INFOGRAPHIC)\]", raw_response)
-        if match:
-            classification = match.group(1) 
-            description = raw_response.replace(match.group(0), "").strip()
+def generate_captions_batch(model, processor, image_paths, prepared):
+    """
+    Captions several images with one generate() call (same prompt, padded on the left).
+    prepared: the (inputs, slots) from prepare_caption_batch for these paths.
+    Returns one result per path, None where the image or the batch failed.
+    """
+    results = [None] * len(image_paths)
+    inputs, slots = prepared
+    if inputs is None:
+        return results
+
+    try:
+        inputs = inputs.to("cuda", torch.float16, non_blocking=True)
+
+        with torch.inference_mode(): # No autograd bookkeeping during decode
+            generate_ids = model.generate(
+                **inputs,
+                max_new_tokens=300,
+                min_new_tokens=1,
+                do_sample=False,
+                use_cache=True,
+                stopping_criteria=[TagOnlyStop(processor.tokenizer, inputs["input_ids"].shape[1])],
+                **kv_cache_kwargs()
+            )
+        output_texts = processor.batch_decode(generate_ids, skip_special_tokens=True)
         
-        return {
-            "type": classification, 
-            "caption": description
-        }
+        for i, output_text in zip(slots, output_texts):
+            results[i] = parse_caption(output_text.split("ASSISTANT:")[-1].strip())
         
     except Exception as e:
-        print(f"   ⚠️ Error processing {image_path}: {e}")
-        return None
+        print(f"   ⚠️ Error processing batch {[image_paths[i] for i in slots]}: {e}")
+    return results
 
 # --- SAFE FILE OPERATIONS ---
-def safe_load_json(filepath):
-    """Safely loads JSON, retrying if it's being written to."""
+def safe_load_json(filepath, strict=False):
+    """
+    Safely loads JSON, retrying if it's being written to.
+    strict: raise instead of returning {} if the file stays unreadable (callers about to overwrite it).
+    """
     if not os.path.exists(filepath):
         return {}
     
@@ -107,32 +301,111 @@ def safe_load_json(filepath):
         except json.JSONDecodeError:
             time.sleep(0.1 * (i+1)) # Exponential backoff
             continue
+    if strict:
+        raise ValueError(f"{filepath} is not valid JSON; not overwriting it")
     return {}
 
-def atomic_merge_and_save(new_data_item, item_id, sub_key, filepath, product_has_dir):
+def merge_captions(data, records, product_has_dir):
+    """Merges (item_id, sub_key, result) records into a captions dict in place."""
+    for item_id, sub_key, result in records:
+        if product_has_dir:
+            if item_id not in data or not isinstance(data[item_id], dict):
+                data[item_id] = {}
+            data[item_id][sub_key] = result
+        else:
+            data[item_id] = result
+
+class CaptionWorkQueue:
     """
-    Loads the LATEST file from disk, merges the NEW item, and saves.
-    This prevents overwriting work done by other GPUs.
+    The images to caption, shared by every GPU process through one sqlite file (WAL).
+    Batches are claimed atomically, so no image is captioned twice and nobody
+    re-reads OUTPUT_FILE to find out what the other GPUs have done.
+    status: pending -> running (claimed) -> done (result stored) -> compacted (in OUTPUT_FILE)
     """
-    # 1. Load latest state from disk
-    current_data = safe_load_json(filepath)
-    
-    # 2. Merge our new specific item
-    if product_has_dir:
-        if item_id not in current_data or not isinstance(current_data[item_id], dict):
-            current_data[item_id] = {}
-        current_data[item_id][sub_key] = new_data_item
-    else:
-        current_data[item_id] = new_data_item
+    def __init__(self, path=WORK_DB):
+        self.worker = str(os.getpid())
+        # Autocommit; writes take the lock explicitly with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS images (item_id TEXT, sub_key TEXT, rel_path TEXT, status TEXT, "
+            "worker TEXT, claimed_at REAL, result TEXT, PRIMARY KEY (item_id, sub_key))"
+        )
 
-    # 3. Save atomically
-    temp_path = filepath + ".tmp"
-    try:
-        with open(temp_path, 'w') as f:
-            json.dump(current_data, f, indent=4)
-        os.replace(temp_path, filepath) # Atomic move
-    except Exception as e:
-        print(f"⚠️ Save failed: {e}")
+    def add(self, entries):
+        """
+        Queues (item_id, rel_path, sub_key) entries missing from OUTPUT_FILE; failed ones from
+        earlier runs are retried, as are compacted ones since removed from OUTPUT_FILE.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany(
+            "INSERT INTO images (item_id, sub_key, rel_path, status) VALUES (?, ?, ?, 'pending') "
+            "ON CONFLICT (item_id, sub_key) DO UPDATE SET status = 'pending' WHERE status IN ('failed', 'compacted')",
+            [(item_id, sub_key, rel_path) for item_id, rel_path, sub_key in entries]
+        )
+        self.conn.execute("COMMIT")
+
+    def pending_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM images WHERE status = 'pending'").fetchone()[0]
+
+    def claim(self, n):
+        """Atomically takes up to n pending (or stale) images. Returns [(item_id, rel_path, sub_key)]."""
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        rows = self.conn.execute(
+            "SELECT item_id, rel_path, sub_key FROM images "
+            "WHERE status = 'pending' OR (status = 'running' AND claimed_at < ?) LIMIT ?",
+            (now - STALE_CLAIM_SECONDS, n)
+        ).fetchall()
+        self.conn.executemany(
+            "UPDATE images SET status = 'running', worker = ?, claimed_at = ? WHERE item_id = ? AND sub_key = ?",
+            [(self.worker, now, item_id, sub_key) for item_id, _, sub_key in rows]
+        )
+        self.conn.execute("COMMIT")
+        return rows
+
+    def finish(self, batch, results):
+        """Stores a claimed batch's results (None = failed, retried on the next run)."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany(
+            "UPDATE images SET status = ?, result = ? WHERE item_id = ? AND sub_key = ?",
+            [("done", dumps(result), item_id, sub_key) if result else ("failed", None, item_id, sub_key)
+             for (item_id, _, sub_key), result in zip(batch, results)]
+        )
+        self.conn.execute("COMMIT")
+
+    def release(self):
+        """Hands this worker's unfinished claims back to the queue (e.g. prefetched batches on exit)."""
+        self.conn.execute("UPDATE images SET status = 'pending' WHERE status = 'running' AND worker = ?", (self.worker,))
+
+    def compact(self, product_has_dir):
+        """
+        Folds every stored caption into OUTPUT_FILE. The write lock is held throughout,
+        so two finishing processes never overwrite each other's merge. Rows only turn
+        'compacted' in the transaction that wrote them out, so nothing is tracked by file
+        size / offset, and an unreadable OUTPUT_FILE aborts the fold (rows stay 'done').
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.conn.execute("SELECT item_id, sub_key, result FROM images WHERE status = 'done'").fetchall()
+            if rows:
+                current_data = safe_load_json(OUTPUT_FILE, strict=True)
+                merge_captions(current_data, [(item_id, sub_key, loads(result)) for item_id, sub_key, result in rows], product_has_dir)
+                temp_path = OUTPUT_FILE + ".tmp"
+                with open(temp_path, 'w') as f:
+                    json.dump(current_data, f, indent=4)
+                os.replace(temp_path, OUTPUT_FILE) # Atomic move
+                # Results now live in OUTPUT_FILE only
+                self.conn.execute("UPDATE images SET status = 'compacted', result = NULL WHERE status = 'done'")
+                print(f"💾 Folded {len(rows)} captions into {OUTPUT_FILE}")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        self.conn.close()
 
 def extract_target_ids(query_repo_path):
     if not os.path.exists(query_repo_path):
@@ -140,42 +413,47 @@ def extract_target_ids(query_repo_path):
         sys.exit(1)
         
     print(f"📂 Parsing target items from: {query_repo_path}")
-    with open(query_repo_path, 'r') as f:
-        repo_data = json.load(f)
-        
-    target_ids = set()
-    for entry in repo_data:
-        results = entry.get('results', [])
-        for item in results:
-            if 'item_id' in item:
-                target_ids.add(item['item_id'])
-    return target_ids
+    # Streamed one query group at a time (ijson when installed): the repo is never held whole
+    repo_data = iter_json_array(query_repo_path)
+    return {item['item_id'] for entry in repo_data for item in entry.get('results', []) if 'item_id' in item}
 
 def main():
     parser = argparse.ArgumentParser(description="Generate classified visual captions for products.")
     parser.add_argument("query_repo", help="Path to query_repo.json OR 'all' to process every image.")
     parser.add_argument("--flat_structure", action="store_true", help="Use old flat directory structure.")
+    parser.add_argument("--batch_size", type=int, default=CAPTION_BATCH_SIZE, help="Images per generate() call (4-8 for 13B on 80GB).")
+    parser.add_argument("--compact", action="store_true", help=f"Only fold finished captions from {WORK_DB} into {OUTPUT_FILE} and exit.")
     args = parser.parse_args()
 
     product_has_dir = not args.flat_structure
 
+    work = CaptionWorkQueue()
+    if args.compact:
+        work.compact(product_has_dir)
+        return
+
     if not os.path.exists(IMAGE_DIR):
         print(f"❌ Error: Image directory '{IMAGE_DIR}' not found.")
         return
         
-    # Load Initial State (Just for queue building)
+    # Load Initial State (Just for queue building; images finished but not yet compacted are skipped by the queue)
     captions_snapshot = safe_load_json(OUTPUT_FILE)
     print(f"📂 Initial Load: {len(captions_snapshot)} items.")
     
     # Build Queue
     queue = [] 
 
+    # One scandir pass over IMAGE_DIR: dirents carry the file type, so no stat() per entry
+    with os.scandir(IMAGE_DIR) as it:
+        top_entries = list(it)
+    product_dirs = {e.name: e.path for e in top_entries if e.is_dir()}
+
     if args.query_repo.lower() == 'all':
         print("🌍 Mode: ALL.")
         if product_has_dir:
-            target_ids = [d for d in os.listdir(IMAGE_DIR) if os.path.isdir(os.path.join(IMAGE_DIR, d))]
+            target_ids = list(product_dirs)
         else:
-            target_ids = [os.path.splitext(f)[0] for f in os.listdir(IMAGE_DIR) if f.endswith(('.jpg', '.png'))]
+            target_ids = [os.path.splitext(e.name)[0] for e in top_entries if e.name.endswith(('.jpg', '.png'))]
     else:
         print(f"🎯 Mode: TARGETED.")
         target_ids = extract_target_ids(args.query_repo)
@@ -184,14 +462,16 @@ def main():
     
     if product_has_dir:
         for tid in target_ids:
-            product_folder = os.path.join(IMAGE_DIR, tid)
-            if not os.path.isdir(product_folder): continue
+            product_folder = product_dirs.get(tid)
+            if product_folder is None: continue
             
             # Local memory check (fast pre-filter)
             if tid not in captions_snapshot or not isinstance(captions_snapshot[tid], dict):
                 pass 
 
-            for img_file in os.listdir(product_folder):
+            with os.scandir(product_folder) as it:
+                img_files = [e.name for e in it if e.is_file()]
+            for img_file in img_files:
                 if img_file.lower().endswith(('.jpg', '.jpeg', '.png')):
                     img_key = os.path.splitext(img_file)[0]
                     
@@ -209,54 +489,56 @@ def main():
         # (Flat structure logic skipped for brevity, works similarly)
         pass
 
-    if not queue:
+    # --- SHARED QUEUE FOR MULTI-GPU ---
+    # Every process adds what it found; duplicates collapse on (item_id, sub_key)
+    work.add(queue)
+    pending = work.pending_count()
+    if not pending:
+        work.compact(product_has_dir)
         print("✅ No new images to process.")
         return
 
-    # --- RANDOMIZE QUEUE FOR MULTI-GPU ---
-    random.shuffle(queue)
-    print(f"📋 Processing Queue: {len(queue)} new images (Randomized Order).")
+    print(f"📋 Processing Queue: {pending} images pending across all workers.")
     
     model, processor = setup_model()
     
-    try:
-        # Loop through randomized queue
-        for item_id, rel_path, sub_key in tqdm(queue, desc="Classifying & Captioning"):
-            
-            # --- JIT CHECK: Has the other GPU finished this EXACT item? ---
-            # We load the file again to check the specific item
-            latest_on_disk = safe_load_json(OUTPUT_FILE)
-            
-            is_done_by_other = False
-            if product_has_dir:
-                if item_id in latest_on_disk and isinstance(latest_on_disk[item_id], dict):
-                    if sub_key in latest_on_disk[item_id]:
-                        is_done_by_other = True
-            
-            if is_done_by_other:
-                # SKIP: The other GPU finished this while we were processing the previous one
-                continue 
+    # Disk reads / JPEG decode / preprocessing for the next claimed batches run on a background
+    # thread while the GPU generates the current one
+    loader = ThreadPoolExecutor(max_workers=1)
+    prefetched = deque()
 
-            # Process
-            image_path = os.path.join(IMAGE_DIR, rel_path)
-            result = generate_caption(model, processor, image_path)
-            
-            if result:
-                # --- ATOMIC MERGE & SAVE ---
+    def claim_next():
+        batch = work.claim(args.batch_size)
+        if batch:
+            image_paths = [os.path.join(IMAGE_DIR, rel_path) for _, rel_path, _ in batch]
+            prefetched.append((batch, image_paths, loader.submit(prepare_caption_batch, processor, image_paths)))
+    
+    try:
+        for _ in range(PREFETCH_BATCHES):
+            claim_next()
+        # Claim batches until no worker has anything left
+        with tqdm(total=pending, desc="Classifying & Captioning") as pbar:
+            while prefetched:
+                batch, image_paths, future = prefetched.popleft()
+                claim_next()
+                
+                # Process
+                results = generate_captions_batch(model, processor, image_paths, future.result())
+                
+                # --- SAVE ---
                 # We do NOT save a local 'captions' dict. 
-                # We load-merge-save to preserve other GPU's work.
-                atomic_merge_and_save(
-                    new_data_item=result, 
-                    item_id=item_id, 
-                    sub_key=sub_key, 
-                    filepath=OUTPUT_FILE, 
-                    product_has_dir=product_has_dir
-                )
+                # The results go to the shared queue, which preserves other GPU's work.
+                work.finish(batch, results)
+                pbar.update(len(batch))
                     
     except KeyboardInterrupt:
         print("\n🛑 Interrupted.")
     finally:
+        loader.shutdown(wait=False, cancel_futures=True)
+        work.release()
+        work.compact(product_has_dir)
+        work.close()
         print(f"✅ Finished.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,20 +1,103 @@
 import torch
+import torch.nn.functional as F
 from PIL import Image
 from transformers import CLIPProcessor, CLIPModel
 import os
+import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from io import BytesIO
+from parallel_utils import unordered_map
+from fast_json import load_json
 
 # --- CONFIGURATION ---
 IMAGE_DIR = "data/images"  # Path where you store product images (B07....jpg)
 CLIP_MODEL_ID = "openai/clip-vit-base-patch32"
+CLIP_IMAGE_SIZE = 224  # JPEGs are decoded at the smallest DCT scale that still covers this
+# torch.compile mode for the CLIP towers on GPU (None = eager). Off by default: calculate_vgs is called
+# from worker threads, and every call has a new (windows, length) shape; never "reduce-overhead" (CUDA graphs)
+CLIP_COMPILE_MODE = None
+# Image embeddings persisted between runs (one fp16 file per item, per CLIP model)
+IMAGE_EMBED_CACHE_DIR = os.path.join("data", ".cache", "vgs_img", CLIP_MODEL_ID.replace("/", "__"))
+
+IMAGE_FETCH_WORKERS = 16  # Concurrent image loads/downloads in prewarm_images
+
+# Keep-alive connections for image downloads (product images mostly come from the same CDN host);
+# the pool is sized for the prewarm threads, transient failures are retried twice
+IMAGE_SESSION = requests.Session()
+_image_adapter = HTTPAdapter(pool_connections=IMAGE_FETCH_WORKERS, pool_maxsize=IMAGE_FETCH_WORKERS,
+                             max_retries=Retry(total=2, backoff_factor=0.2))
+IMAGE_SESSION.mount("https://", _image_adapter)
+IMAGE_SESSION.mount("http://", _image_adapter)
+
+# Image classes (the `type` visual_extractor assigns) CLIP grounding says nothing about
+UNGROUNDED_IMAGE_TYPES = {"INFOGRAPHIC"}
+# The extractor's raw output: the refined / compressed captions files the evaluators read as
+# visual descriptions are plain strings and no longer carry the class
+IMAGE_TYPES_FILE = "data/test_dense_captions.json"
+MAIN_IMAGE_KEY = "0"  # Per-product-folder layout: the listing's main image, the one VGS scores
+TYPE_TAG = re.compile(r"\[([A-Z_]+)\]")  # Unparsed replies kept as strings still start with "[TYPE]"
+
+def caption_entry_type(entry):
+    if isinstance(entry, dict):
+        return entry.get('type')
+    if isinstance(entry, str):
+        match = TYPE_TAG.match(entry)
+        return match.group(1) if match else None
+    return None
+
+def load_image_types(path=IMAGE_TYPES_FILE):
+    """
+    {item_id: class of the item's main image} from the extractor's raw captions. Handles both
+    layouts: flat ({item_id: {type, caption}}, one image per item) and per-product-folder
+    ({item_id: {img_key: {type, caption}}}, where MAIN_IMAGE_KEY is the image scored here).
+    Items without a class are left out, so their images are scored as usual.
+    """
+    if not os.path.exists(path):
+        print(f"   ⚠️ {path} not found. Infographics will be scored like any other image.")
+        return {}
+    image_types = {}
+    for item_id, entry in load_json(path).items():
+        if isinstance(entry, dict) and 'caption' not in entry:
+            entry = entry.get(MAIN_IMAGE_KEY, entry.get(f"{MAIN_IMAGE_KEY}.jpg"))
+        image_type = caption_entry_type(entry)
+        if image_type:
+            image_types[item_id] = image_type
+    return image_types
 
 class VisualGroundingScorer:
     def __init__(self):
         print(f"👁️ Initializing CLIP Utility Judge ({CLIP_MODEL_ID})...")
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = CLIPModel.from_pretrained(CLIP_MODEL_ID).to(self.device)
+        # fp16 on GPU (inference only: scores are far coarser than the rounding); CPU stays fp32
+        self.dtype = torch.float16 if self.device == "cuda" else torch.float32
+        self.model = CLIPModel.from_pretrained(CLIP_MODEL_ID, torch_dtype=self.dtype).to(self.device).eval()
         self.processor = CLIPProcessor.from_pretrained(CLIP_MODEL_ID)
+        if self.device == "cuda" and CLIP_COMPILE_MODE:
+            self._compile_towers()
+        # item_id -> normalized image embedding (None if the image is missing)
+        self.image_embedding_cache = {}
+        os.makedirs(IMAGE_EMBED_CACHE_DIR, exist_ok=True)
+
+    def _compile_towers(self):
+        """
+        Compiles the towers themselves (get_*_features call them directly). torch.compile is lazy,
+        so one warm-up pass per tower runs inside the try; on failure the eager towers are put back.
+        """
+        text_model, vision_model = self.model.text_model, self.model.vision_model
+        try:
+            self.model.text_model = torch.compile(text_model, mode=CLIP_COMPILE_MODE, dynamic=True)
+            self.model.vision_model = torch.compile(vision_model, mode=CLIP_COMPILE_MODE)
+            size = self.processor.image_processor.crop_size
+            placeholder = Image.new("RGB", (size["width"], size["height"]))
+            inputs = self.processor(text=["a product photo"], images=placeholder, return_tensors="pt").to(self.device)
+            with torch.inference_mode():
+                self.model.get_text_features(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])
+                self.model.get_image_features(pixel_values=inputs["pixel_values"].to(self.dtype))
+        except Exception as e:
+            self.model.text_model, self.model.vision_model = text_model, vision_model
+            print(f"   ⚠️ torch.compile failed ({e}). Running eager.")
 
     def _load_image(self, item_id, image_url=None):
         """
@@ -23,79 +106,152 @@ class VisualGroundingScorer:
         # 1. Local Check
         local_path = os.path.join(IMAGE_DIR, f"{item_id}.jpg")
         if os.path.exists(local_path):
-            return Image.open(local_path)
+            image = Image.open(local_path)
         
         # 2. URL Check
-        if image_url:
+        elif image_url:
             try:
-                response = requests.get(image_url, timeout=5)
-                return Image.open(BytesIO(response.content))
+                response = IMAGE_SESSION.get(image_url, timeout=5)
+                image = Image.open(BytesIO(response.content))
             except:
-                pass
-                
-        return None
+                return None
+        else:
+            return None
+
+        # The processor downsamples to CLIP_IMAGE_SIZE anyway: skip decoding full-size JPEGs
+        image.draft("RGB", (CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE))
+        image.load() # Decode now (on the prewarm thread), not lazily inside the processor
+        return image
+
+    def encode_image(self, item_id, image_url=None):
+        """
+        Returns the normalized CLIP image embedding for an item.
+        The image side is invariant per item_id, so it is encoded only once.
+        """
+        if self._cached_embedding(item_id):
+            return self.image_embedding_cache[item_id]
+        return self._encode_loaded(item_id, self._load_image(item_id, image_url))
+
+    def _cached_embedding(self, item_id):
+        """
+        True if item_id's embedding is in memory, loading it from an earlier run's file if needed.
+        """
+        if item_id in self.image_embedding_cache:
+            return True
+
+        # Encoded by an earlier run?
+        cache_path = os.path.join(IMAGE_EMBED_CACHE_DIR, f"{item_id}.pt")
+        if os.path.exists(cache_path):
+            try:
+                self.image_embedding_cache[item_id] = torch.load(cache_path, map_location=self.device).to(self.dtype)
+                return True
+            except Exception:
+                pass # Corrupt/partial file: re-encode
+        return False
+
+    def _encode_loaded(self, item_id, image):
+        """
+        Encodes an image from _load_image (None if missing), caching the result.
+        """
+        cache_path = os.path.join(IMAGE_EMBED_CACHE_DIR, f"{item_id}.pt")
+        image_embeds = None
+        if image:
+            inputs = self.processor(images=image, return_tensors="pt").to(self.device, self.dtype)
+            with torch.inference_mode():
+                image_embeds = self.model.get_image_features(**inputs)
+            image_embeds = image_embeds / image_embeds.norm(dim=-1, keepdim=True)
+
+            # Write-then-rename so parallel workers never read a half-written file
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            # fp16 on disk: half the bytes per item, far below CLIP's own similarity noise
+            torch.save(image_embeds.half().cpu(), tmp_path)
+            os.replace(tmp_path, cache_path)
+
+        # Missing images are only remembered in memory (they may be downloaded later)
+        self.image_embedding_cache[item_id] = image_embeds
+        return image_embeds
+
+    def prewarm_images(self, items, image_types=None):
+        """
+        Encodes every distinct (item_id, image_url) up front, so scoring loops
+        (and concurrent battles) only ever hit the cache.
+        Given load_image_types(), infographics (never scored, see calculate_vgs) are skipped.
+        """
+        image_types = image_types or {}
+        pending = {
+            item_id: image_url for item_id, image_url in items
+            if image_types.get(item_id) not in UNGROUNDED_IMAGE_TYPES
+            and not self._cached_embedding(item_id)
+        }
+        if pending:
+            print(f"   🖼️ Encoding {len(pending)} product images...")
+        # Disk reads / downloads overlap on worker threads; CLIP runs here as each image arrives
+        load = lambda entry: (entry[0], self._load_image(*entry))
+        for item_id, image in unordered_map(load, pending.items(), IMAGE_FETCH_WORKERS):
+            self._encode_loaded(item_id, image)
 
-    def calculate_vgs(self, item_id, text, image_url=None):
+    def calculate_vgs(self, item_id, text, image_url=None, image_type=None):
         """
         Calculates Cosine Similarity between Text and Image using Sliding Window.
         Returns: Score 0.0 to 1.0 (Max across chunks)
+        image_type: the extractor's class for the image; infographics get the neutral
+        score without loading or encoding the image.
         """
-        image = self._load_image(item_id, image_url)
-        
-        if not image:
+        if image_type in UNGROUNDED_IMAGE_TYPES:
+            return 0.5 # Text/charts: CLIP similarity there is noise, not grounding
+        return self.calculate_vgs_from_embed(self.encode_image(item_id, image_url), text)
+
+    def calculate_vgs_from_embed(self, image_embeds, text):
+        """
+        Same as calculate_vgs, for callers already holding the image embedding.
+        """
+        if image_embeds is None:
             # print(f"   ⚠️ VGS Warning: Image for {item_id} not found. Skipping Visual Check.")
             return 0.5 # Neutral score penalty for missing data
 
         # --- SLIDING WINDOW LOGIC ---
-        # 1. Tokenize full text first to handle splitting correctly
-        inputs = self.processor.tokenizer(text, return_tensors="pt")
-        input_ids = inputs['input_ids'][0] # Flatten to 1D tensor
+        # 1. Tokenize full text once (windows are cut from these ids, never decoded / re-tokenized)
+        tokenizer = self.processor.tokenizer
+        content_ids = tokenizer(text, add_special_tokens=False)['input_ids']
 
         # 2. Define Window Parameters
-        window_size = 77  # CLIP limit
-        stride = 50       # Overlap to catch phrases cut in half
-        chunks = []
+        window_size = 77 - 2  # CLIP limit, minus the start / end tokens wrapped around each window
+        stride = 50           # Overlap to catch phrases cut in half
+        windows = []
 
         # 3. Create Chunks
-        if len(input_ids) <= window_size:
+        if len(content_ids) <= window_size:
             # Short text: Take it all
-            chunks.append(text)
+            windows.append(content_ids)
         else:
             # Long text: Slide
-            for i in range(0, len(input_ids), stride):
-                chunk_ids = input_ids[i : i + window_size]
-                if len(chunk_ids) < 10: continue # Skip tiny fragments at end
-                
-                # Decode back to string for the processor
-                chunk_str = self.processor.tokenizer.decode(chunk_ids, skip_special_tokens=True)
-                chunks.append(chunk_str)
-
-        # 4. Score Each Chunk
-        chunk_scores = []
-        
-        for chunk_text in chunks:
-            inputs = self.processor(
-                text=[chunk_text], 
-                images=image, 
-                return_tensors="pt", 
-                padding=True,
-                truncation=True,
-                max_length=77
-            ).to(self.device)
-
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-            
-            # Raw cosine similarity
-            image_embeds = outputs.image_embeds / outputs.image_embeds.norm(dim=-1, keepdim=True)
-            text_embeds = outputs.text_embeds / outputs.text_embeds.norm(dim=-1, keepdim=True)
+            for i in range(0, len(content_ids), stride):
+                window = content_ids[i : i + window_size]
+                if len(window) < 10: continue # Skip tiny fragments at end
+                windows.append(window)
+
+        # 4. Score All Chunks (one batched text-encoder pass; image side comes from the cache)
+        best_similarity = 0.0
+        if windows:
+            # Right-padded batch; CLIP pools at each row's first end token, so padding never leaks in
+            longest = max(len(w) for w in windows) + 2
+            input_ids = torch.full((len(windows), longest), tokenizer.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(windows), longest), dtype=torch.long)
+            for row, window in enumerate(windows):
+                ids = [tokenizer.bos_token_id] + window + [tokenizer.eos_token_id]
+                input_ids[row, :len(ids)] = torch.tensor(ids)
+                attention_mask[row, :len(ids)] = 1
+            inputs = {"input_ids": input_ids.to(self.device), "attention_mask": attention_mask.to(self.device)}
+
+            with torch.inference_mode():
+                text_embeds = self.model.get_text_features(**inputs)
             
-            similarity = torch.matmul(text_embeds, image_embeds.t()).item()
-            chunk_scores.append(similarity)
+            # Raw cosine similarity of every chunk at once (one fused op; the [1, D] image row broadcasts)
+            chunk_scores = F.cosine_similarity(text_embeds, image_embeds, dim=-1)
 
-        # 5. Aggregation (MAX Pooling)
-        # We take the BEST matching chunk as the representatitve score
-        best_similarity = max(chunk_scores) if chunk_scores else 0.0
+            # 5. Aggregation (MAX Pooling)
+            # We take the BEST matching chunk as the representatitve score
+            best_similarity = chunk_scores.max().item()
         
         # 6. Normalize
         # Clip similarity is usually 0.2-0.3 for consistent pairs. 